@@ -1,15 +1,18 @@
 # basic.py -- K8s 对象的基础定义与配置解析
 #
 # Copyright (C) 2024 KAAAsS
+import collections
 from pathlib import Path
 from pprint import pprint
-from typing import Optional
+from typing import Optional, Iterable, NamedTuple
 
-import yaml
-from tinydb import TinyDB, where
-from tinydb.queries import QueryLike, Query
+from tinydb import TinyDB
+from tinydb.queries import QueryLike
 from tinydb.storages import MemoryStorage
 
+from analyse.k8s import loader
+from analyse.k8s.index import ObjectIndex
+from analyse.k8s.selector import LabelSelector
 from utils.log import log_funcs
 
 debug, info, warn, error, fatal = log_funcs(from_file=__file__)
@@ -18,10 +21,24 @@ debug, info, warn, error, fatal = log_funcs(from_file=__file__)
 class Object:
     """K8s 对象"""
 
+    __slots__ = ('data', 'store', 'source_path', 'source_index', 'projected', '_digest', 'duplicate_sources')
+
+    # 投影加载时保留在内存中的顶层字段，子类按分析需要扩充
+    RESIDENT_FIELDS = ('apiVersion', 'kind')
+    RESIDENT_METADATA_FIELDS = ('name', 'namespace', 'labels')
+
     def __init__(self, data: dict, store=None, source_path: Optional[Path] = None):
         self.data = data
         self.store = store
         self.source_path = source_path
+        # 对象在源文件中是第几个文档
+        self.source_index: Optional[int] = None
+        # data 是否只包含投影后的字段
+        self.projected = False
+        # 完整数据的内容摘要，加载时计算或第一次使用时计算
+        self._digest: Optional[str] = None
+        # 内容完全相同、加载时被合并的其他副本的位置 (源文件, 文档下标)
+        self.duplicate_sources: list[tuple[Path, int]] = []
 
     def _repr_data(self):
         result = self.data.copy()
@@ -48,10 +65,49 @@ class Object:
         return 'apiVersion' in self.data and 'kind' in self.data and 'metadata' in self.data
 
     def __eq__(self, other):
-        return self.data == other.data
+        if not isinstance(other, Object):
+            return NotImplemented
+        return self.digest == other.digest
 
     def __hash__(self):
-        return hash(repr(self.data))
+        return hash(self.digest)
+
+    @property
+    def digest(self) -> str:
+        """对象内容的规范化摘要，内容相同的对象摘要相同"""
+        if self._digest is None:
+            self._digest = loader.content_digest(self.full_data)
+        return self._digest
+
+    @property
+    def source_paths(self) -> list[Path]:
+        """对象出现过的所有源文件，包括被合并的副本"""
+        paths = [self.source_path] if self.source_path is not None else []
+        return paths + [path for path, _ in self.duplicate_sources]
+
+    @property
+    def identity(self) -> tuple:
+        """对象的稳定标识 (kind, namespace, name, 源文件)"""
+        metadata = self.data.get('metadata', None) or {}
+        return (self.data.get('kind', None), metadata.get('namespace', None), metadata.get('name', None),
+                str(self.source_path) if self.source_path is not None else None)
+
+    def projected_data(self) -> dict:
+        """只包含分析需要的字段的数据"""
+        result = {k: self.data[k] for k in self.RESIDENT_FIELDS if k in self.data}
+        metadata = self.data.get('metadata', None)
+        if isinstance(metadata, dict):
+            result['metadata'] = {k: metadata[k] for k in self.RESIDENT_METADATA_FIELDS if k in metadata}
+        return result
+
+    @property
+    def full_data(self) -> dict:
+        """完整的对象数据，投影加载时从源文件重新读取"""
+        if not self.projected:
+            return self.data
+        assert self.source_path is not None and self.source_index is not None, \
+            'Projected object without source location'
+        return loader.load_document(self.source_path, self.source_index)
 
     @property
     def kind(self):
@@ -61,6 +117,11 @@ class Object:
     def name(self):
         return self.data['metadata']['name']
 
+    @property
+    def namespace(self) -> Optional[str]:
+        """对象的命名空间，未指定时为 None"""
+        return (self.data.get('metadata', None) or {}).get('namespace', None)
+
     @staticmethod
     def from_dict(data: dict):
         if data is None:
@@ -68,7 +129,8 @@ class Object:
 
         from analyse.k8s.rbac import ServiceAccount, RoleBinding, Role
         from analyse.k8s.workload import Pod, Workload
-        specialize_objs = [ServiceAccount, RoleBinding, Role, Pod, Workload]
+        from analyse.k8s.crd import CustomResourceDefinition
+        specialize_objs = [ServiceAccount, RoleBinding, Role, Pod, Workload, CustomResourceDefinition]
         for cls in specialize_objs:
             try:
                 obj = cls.from_dict(data)
@@ -79,16 +141,81 @@ class Object:
         return Object(data, source_path=None)
 
 
+def namespace_matches(a: Optional[str], b: Optional[str]) -> bool:
+    """两个命名空间是否可能相同，None 表示未指定，可以是任意命名空间"""
+    return a is None or b is None or a == b
+
+
+class ObjectConflict(NamedTuple):
+    """(kind, namespace, name) 相同但内容不同的一组对象"""
+    kind: str
+    namespace: Optional[str]
+    name: str
+    objects: list[Object]
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'namespace': self.namespace,
+            'name': self.name,
+            'sources': [[str(path) for path in obj.source_paths] for obj in self.objects],
+        }
+
+
+def deduplicate_objects(objects: list[Object]) -> tuple[list[Object], list[ObjectConflict]]:
+    """
+    合并内容完全相同的对象，被合并的副本记录在保留对象的 duplicate_sources 中。
+    同时找出 (kind, namespace, name) 相同但内容不同的对象
+    """
+    results = []
+    by_digest: dict[str, Object] = {}
+    by_identity: dict[tuple, list[Object]] = collections.defaultdict(list)
+    for obj in objects:
+        kept = by_digest.get(obj.digest, None)
+        if kept is not None:
+            kept.duplicate_sources.append((obj.source_path, obj.source_index))
+            kept.duplicate_sources += obj.duplicate_sources
+            continue
+        by_digest[obj.digest] = obj
+        results.append(obj)
+        kind, namespace, name, _ = obj.identity
+        if name is not None:
+            by_identity[(kind, namespace, name)].append(obj)
+
+    conflicts = [
+        ObjectConflict(kind, namespace, name, objs)
+        for (kind, namespace, name), objs in by_identity.items()
+        if len(objs) > 1
+    ]
+    return results, conflicts
+
+
 class ObjectStore:
     """一系列 K8s 对象"""
 
-    def __init__(self, objects: list[Object]):
+    def __init__(self, objects: list[Object], index: Optional[ObjectIndex] = None,
+                 conflicts: Optional[list[ObjectConflict]] = None):
+        """
+        :param index: 预先构建好的索引（如从快照中加载），为 None 则重新构建
+        :param conflicts: 加载时发现的冲突对象，见 deduplicate_objects
+        """
         self.objects = objects
+        self._index = index if index is not None else ObjectIndex.build(objects)
+        self.conflicts = conflicts or []
+        # store 的版本，内容变化后递增，用于使依赖 store 的缓存失效
+        self.generation = 0
+        # 由 store 计算出的派生数据，见 cached
+        self._derived = {}
+        # tinydb 只作为通用查询的后备，在第一次使用时构建
         self._db_obj_map = {}
-        self._db = self._make_db()
+        self._db = None
+
+    def _get_objects(self, positions: list[int]) -> list[Object]:
+        return [self.objects[pos] for pos in positions]
 
     def search(self, cond: QueryLike):
-        docs = self._db.search(cond)
+        """通用查询，需要全表扫描。常用查询应使用下面带索引的方法"""
+        docs = self._get_db().search(cond)
         results = []
         for doc in docs:
             results.append(self._db_obj_map[doc.doc_id])
@@ -96,20 +223,92 @@ class ObjectStore:
 
     def search_by_kind(self, kind: str):
         """根据 kind 搜索对象"""
-        return self.search(where('kind') == kind)
+        return self._get_objects(self._index.by_kind.get(kind, []))
 
     def search_by_name(self, name: str):
         """根据 name 搜索对象"""
-        return self.search(Query().metadata.name == name)
+        return self._get_objects(self._index.by_name.get(name, []))
 
     def search_by_kind_and_name(self, kind: str, name: str):
         """根据 kind 和 name 搜索对象"""
-        results = self.search(Query().kind == kind and Query().metadata.name == name)
+        results = self.find_by_kind_and_name(kind, name)
         assert len(results) <= 1
         return results[0] if results else None
 
+    def find_by_kind_and_name(self, kind: str | Iterable[str], name: str) -> list[Object]:
+        """根据 kind 和 name 查找所有对象，kind 可以是多个"""
+        kinds = (kind,) if isinstance(kind, str) else kind
+        return self._get_objects(self._index.lookup_kind_and_name(kinds, name))
+
+    def find_by_identity(self, kind: str, namespace: Optional[str], name: str) -> list[Object]:
+        """根据 (kind, namespace, name) 查找对象，namespace 为 None 表示对象未指定命名空间"""
+        return self._get_objects(self._index.by_identity.get((kind, namespace, name), []))
+
+    def find_in_namespace(self, kind: str, namespace: Optional[str], name: str) -> list[Object]:
+        """
+        在命名空间中查找对象，优先返回命名空间完全一致的对象。
+        未指定命名空间的对象（如未渲染命名空间的 Helm 模板）视为可能属于任意命名空间；
+        namespace 为 None 时则在所有命名空间中查找
+        """
+        results = self.find_by_identity(kind, namespace, name)
+        if results:
+            return results
+        if namespace is not None:
+            return self.find_by_identity(kind, None, name)
+        return self.find_by_kind_and_name(kind, name)
+
+    def search_by_namespace(self, namespace: Optional[str]) -> list[Object]:
+        """返回命名空间分区中的所有对象，namespace 为 None 时返回未指定命名空间的对象"""
+        return self._get_objects(self._index.by_namespace.get(namespace, []))
+
+    def namespaces(self) -> list[Optional[str]]:
+        """所有出现过的命名空间"""
+        return list(self._index.by_namespace.keys())
+
+    def find_bindings_by_subject(self, kind: str, name: str) -> list[Object]:
+        """查找 subjects 中包含指定主体的 RoleBinding 与 ClusterRoleBinding"""
+        return self._get_objects(self._index.by_subject.get((kind, name), []))
+
+    def find_bindings_by_role_ref(self, role_name: str) -> list[Object]:
+        """查找 roleRef 指向指定名称的 RoleBinding 与 ClusterRoleBinding"""
+        return self._get_objects(self._index.by_role_ref.get(role_name, []))
+
+    def find_by_labels(self, labels: dict, kind: Optional[str] = None) -> list[Object]:
+        """查找具有所有指定 label 的对象"""
+        return self._get_objects(self._index.lookup_labels(labels, kind))
+
+    def find_by_selector(self, selector: 'dict | LabelSelector', kind: Optional[str] = None) -> list[Object]:
+        """查找满足 LabelSelector（matchLabels 与 matchExpressions）的对象"""
+        if isinstance(selector, dict):
+            selector = LabelSelector.compile(selector)
+        return self._get_objects(selector.select(self._index, kind))
+
+    def invalidate(self):
+        """直接修改 objects 后调用，重建索引并使依赖 store 的缓存（如 Role 的规则表）失效"""
+        self._index = ObjectIndex.build(self.objects)
+        self._db = None
+        self._db_obj_map = {}
+        self._derived = {}
+        self.generation += 1
+
+    def cached(self, key: str, factory):
+        """
+        由整个 store 计算出的派生数据（如 ClusterRole 的聚合关系），第一次使用时通过 factory(store) 计算，
+        invalidate 后重新计算
+        """
+        value = self._derived.get(key, None)
+        if value is None:
+            value = factory(self)
+            self._derived[key] = value
+        return value
+
     def contains(self, cond: QueryLike):
-        return self._db.contains(cond)
+        return self._get_db().contains(cond)
+
+    def _get_db(self):
+        if self._db is None:
+            self._db = self._make_db()
+        return self._db
 
     def _make_db(self):
         """生成 tinydb 数据库"""
@@ -123,46 +322,69 @@ class ObjectStore:
         state = self.__dict__.copy()
         # 不序列化 DB
         state['_db'] = None
-        state['_db_obj_map'] = None
+        state['_db_obj_map'] = {}
+        state['_derived'] = {}
         return state
 
     def __setstate__(self, state):
+        # 对象与 store 循环引用，从某个对象开始反序列化时，此时 objects 中的对象可能还没有恢复状态，
+        # 因此这里不能访问对象的内容。索引随 state 一起恢复，不需要重建
         self.__dict__.update(state)
-        # FIXME: 不知道为什么，有时候 objects 会是一个全空的对象
-        self.objects = [
-            obj
-            for obj in self.objects
-            if hasattr(obj, 'data')
-        ]
-        # 重建 DB
-        self._db_obj_map = {}
-        self._db = self._make_db()
 
     def __iter__(self):
         return iter(self.objects)
 
     @staticmethod
-    def from_config_dir(dir: Path):
-        """从配置目录加载对象"""
-        objects = []
+    def from_config_dir(dir: Path, workers: Optional[int] = None, cache_path: Optional[Path] = None,
+                        projected: bool = False, deduplicate: bool = True):
+        """
+        从配置目录加载对象
+        :param workers: 解析配置使用的进程数，为 None 则使用 loader.LOADER_WORKERS
+        :param cache_path: 已解析配置的缓存文件，只重新解析有变化的文件。为 None 则不使用缓存
+        :param projected: 只在内存中保留分析需要的字段，完整数据通过 Object.full_data 按需读取
+        :param deduplicate: 是否合并内容完全相同的对象，见 deduplicate_objects
+        """
+        return ObjectStore.from_files(loader.find_config_files(dir), workers=workers, cache_path=cache_path,
+                                      projected=projected, deduplicate=deduplicate)
 
-        # 遍历所有 yaml 文件
-        for path in dir.rglob('*.yaml'):
-            with path.open() as f:
-                # 解析文件（多文档）
-                data = yaml.full_load_all(f)
-                if data is None:
+    @staticmethod
+    def from_files(paths: list[Path], workers: Optional[int] = None, cache_path: Optional[Path] = None,
+                   projected: bool = False, deduplicate: bool = True):
+        """
+        从一系列配置文件加载对象，文件可以是 `kubectl get -o json/yaml` 导出的 List。参数同 from_config_dir
+        :param deduplicate: 是否合并内容完全相同的对象（如多个 Helm chart 渲染出的同一个 ClusterRole）
+        """
+        objects = []
+        cache = loader.ConfigCache(cache_path, projected=projected) if cache_path is not None else None
+
+        # 解析文件（多文档）
+        paths = [path.absolute() for path in paths]
+        for path, data in loader.load_config_files(paths, workers=workers, cache=cache, projected=projected):
+            for index, (item, digest) in enumerate(data):
+                loader.intern_document(item)
+                obj = Object.from_dict(item)
+                if obj is None:
                     continue
-                for item in data:
-                    obj = Object.from_dict(item)
-                    if obj is None:
-                        continue
-                    if not obj.simple_check():
-                        debug(f'Invalid object in {path}, obj = {obj}')
-                    obj.source_path = path.absolute()
-                    objects.append(obj)
-
-        store = ObjectStore(objects)
+                if not obj.simple_check():
+                    debug(f'Invalid object in {path}, obj = {obj}')
+                obj.source_path = path
+                obj.source_index = index
+                obj.projected = projected
+                obj._digest = digest
+                objects.append(obj)
+
+        conflicts = []
+        if deduplicate:
+            count = len(objects)
+            objects, conflicts = deduplicate_objects(objects)
+            if len(objects) != count:
+                info('merged duplicated objects', before=count, after=len(objects))
+            for conflict in conflicts:
+                warn('found conflicting objects with different content', kind=conflict.kind,
+                     namespace=conflict.namespace, name=conflict.name,
+                     sources=[str(obj.source_path) for obj in conflict.objects])
+
+        store = ObjectStore(objects, conflicts=conflicts)
         for obj in store.objects:
             obj.bind_store(store)
         return store
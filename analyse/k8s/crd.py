@@ -0,0 +1,62 @@
+# crd.py -- 实现 CustomResourceDefinition 对象
+#
+# Copyright (C) 2024 KAAAsS
+from analyse.k8s.basic import Object
+from analyse.k8s.rbac.permission import Permission
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 自定义资源支持的动词，与 kube-apiserver 为 CRD 注册的动词一致
+CUSTOM_RESOURCE_VERBS = 'create', 'delete', 'deletecollection', 'get', 'list', 'patch', 'update', 'watch'
+
+
+class CustomResourceDefinition(Object):
+    """CRD 对象，用于推导自定义资源的权限"""
+    __slots__ = ()
+
+    @staticmethod
+    def from_dict(data: dict):
+        if data['kind'] != 'CustomResourceDefinition':
+            return None
+        return CustomResourceDefinition(data)
+
+    def projected_data(self) -> dict:
+        result = super().projected_data()
+        # 只保留组、名称与版本，丢弃体积很大的 schema
+        spec = self.data.get('spec', None) or {}
+        projected = {k: spec[k] for k in ('group', 'scope', 'version') if k in spec}
+        if 'names' in spec:
+            projected['names'] = {'plural': spec['names'].get('plural', None)}
+        if 'versions' in spec:
+            projected['versions'] = [{k: v[k] for k in ('name', 'served') if k in v} for v in spec['versions']]
+        result['spec'] = projected
+        return result
+
+    @property
+    def group(self) -> str:
+        return self.data['spec']['group']
+
+    @property
+    def plural(self) -> str:
+        return self.data['spec']['names']['plural']
+
+    @property
+    def served_versions(self) -> list[str]:
+        spec = self.data['spec']
+        versions = [v['name'] for v in spec.get('versions', None) or [] if v.get('served', True)]
+        # apiextensions.k8s.io/v1beta1 的 CRD 可以只有 version 字段
+        if not versions and spec.get('version', None):
+            versions = [spec['version']]
+        return versions
+
+    def permissions(self) -> list[Permission]:
+        """自定义资源的所有权限，格式同 get_all_perms"""
+        try:
+            group, plural, versions = self.group, self.plural, self.served_versions
+        except (KeyError, TypeError):
+            warn('Malformed CustomResourceDefinition, ignored', name=self.name)
+            return []
+        return [Permission(plural, verb, api_group=group, api_version=version)
+                for version in versions
+                for verb in CUSTOM_RESOURCE_VERBS]
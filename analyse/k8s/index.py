@@ -0,0 +1,108 @@
+# index.py -- ObjectStore 的哈希索引
+#
+# Copyright (C) 2024 KAAAsS
+import collections
+from typing import Iterable, Optional
+
+BINDING_KINDS = 'RoleBinding', 'ClusterRoleBinding'
+
+
+def _metadata(data: dict) -> dict:
+    metadata = data.get('metadata', None)
+    return metadata if isinstance(metadata, dict) else {}
+
+
+class ObjectIndex:
+    """
+    ObjectStore 的哈希索引，一次遍历构建。索引中只保存对象在 store 中的下标，查询结果保持 store 中的原始顺序
+    """
+
+    def __init__(self):
+        # kind -> 下标
+        self.by_kind: dict[str, list[int]] = collections.defaultdict(list)
+        # name -> 下标
+        self.by_name: dict[str, list[int]] = collections.defaultdict(list)
+        # (kind, name) -> 下标
+        self.by_kind_name: dict[tuple[str, str], list[int]] = collections.defaultdict(list)
+        # namespace -> 下标，即按命名空间的分区
+        self.by_namespace: dict[Optional[str], list[int]] = collections.defaultdict(list)
+        # (kind, namespace, name) -> 下标
+        self.by_identity: dict[tuple[str, Optional[str], str], list[int]] = collections.defaultdict(list)
+        # subject (kind, name) -> binding 下标
+        self.by_subject: dict[tuple[str, str], list[int]] = collections.defaultdict(list)
+        # roleRef name -> binding 下标
+        self.by_role_ref: dict[str, list[int]] = collections.defaultdict(list)
+        # label (key, value) -> 下标
+        self.by_label: dict[tuple[str, str], list[int]] = collections.defaultdict(list)
+        # label key -> 下标
+        self.by_label_key: dict[str, list[int]] = collections.defaultdict(list)
+
+    def add(self, pos: int, data: dict):
+        """将 store 中第 pos 个对象加入索引"""
+        if not isinstance(data, dict):
+            return
+        kind = data.get('kind', None)
+        metadata = _metadata(data)
+        name = metadata.get('name', None)
+        namespace = metadata.get('namespace', None)
+
+        self.by_kind[kind].append(pos)
+        self.by_name[name].append(pos)
+        self.by_kind_name[(kind, name)].append(pos)
+        self.by_namespace[namespace].append(pos)
+        self.by_identity[(kind, namespace, name)].append(pos)
+
+        labels = metadata.get('labels', None)
+        if isinstance(labels, dict):
+            for k, v in labels.items():
+                self.by_label_key[k].append(pos)
+                try:
+                    self.by_label[(k, v)].append(pos)
+                except TypeError:
+                    # 不可哈希的 label 值不可能被 selector 匹配
+                    continue
+
+        if kind in BINDING_KINDS:
+            seen = set()
+            for subject in data.get('subjects', None) or []:
+                if not isinstance(subject, dict):
+                    continue
+                key = (subject.get('kind', None), subject.get('name', None))
+                if key in seen:
+                    continue
+                seen.add(key)
+                self.by_subject[key].append(pos)
+            role_ref = data.get('roleRef', None)
+            if isinstance(role_ref, dict) and 'name' in role_ref:
+                self.by_role_ref[role_ref['name']].append(pos)
+
+    def lookup_kind_and_name(self, kinds: Iterable[str], name: str) -> list[int]:
+        positions = []
+        for kind in kinds:
+            positions += self.by_kind_name.get((kind, name), [])
+        return sorted(positions)
+
+    def lookup_labels(self, labels: dict, kind: Optional[str] = None) -> list[int]:
+        """查找同时具有所有 label 的对象，labels 为空时匹配所有对象"""
+        candidates = None
+        if kind is not None:
+            candidates = set(self.by_kind.get(kind, []))
+        for k, v in labels.items():
+            try:
+                matched = self.by_label.get((k, v), [])
+            except TypeError:
+                return []
+            candidates = set(matched) if candidates is None else candidates & set(matched)
+            if not candidates:
+                return []
+        if candidates is None:
+            # 既无 kind 也无 label 限制
+            return sorted(pos for positions in self.by_kind.values() for pos in positions)
+        return sorted(candidates)
+
+    @staticmethod
+    def build(objects: list) -> 'ObjectIndex':
+        index = ObjectIndex()
+        for pos, obj in enumerate(objects):
+            index.add(pos, obj.data)
+        return index
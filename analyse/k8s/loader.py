@@ -0,0 +1,492 @@
+# loader.py -- 配置文件的解析
+#
+# Copyright (C) 2024 KAAAsS
+import hashlib
+import json
+import functools
+import os
+import pickle
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, NamedTuple, Any, Callable, IO, TextIO, BinaryIO
+
+
+try:
+    # 优先使用 libyaml 实现的 C 解析器
+    from yaml import CSafeLoader as _YamlLoader
+except ImportError:
+    from yaml import SafeLoader as _YamlLoader
+
+from utils.json_stream import JsonStream
+from utils.yaml_stream import YamlStream, MERGE_KEY
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+CONFIG_SUFFIXES = '.yaml', '.yml', '.json'
+
+# 解析配置使用的进程数，0 表示使用全部 CPU，1 表示不使用进程池
+LOADER_WORKERS = int(os.getenv('LOADER_WORKERS', 0))
+# 文件数少于该值时不启动进程池
+_PARALLEL_MIN_FILES = 32
+# 超过该大小的文件（一般是整个集群导出的 List）在主进程中流式解析，避免在进程间传递大量对象
+_LARGE_FILE_SIZE = 64 << 20
+
+
+def find_config_files(dir: Path) -> list[Path]:
+    """查找目录下的所有配置文件，按路径排序以保证顺序确定"""
+    return sorted(
+        path.absolute()
+        for path in dir.rglob('*')
+        if path.suffix in CONFIG_SUFFIXES and path.is_file()
+    )
+
+
+class ParsedDocument(NamedTuple):
+    """解析后的文档"""
+    data: Any
+    # 完整文档的内容摘要，见 content_digest
+    digest: Optional[str]
+
+
+def content_digest(data) -> str:
+    """文档内容的规范化摘要，与 dict 中 key 的顺序无关"""
+    canonical = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+def iter_config_file(path: Path, projected: bool = False) -> Iterable[ParsedDocument]:
+    """
+    逐个解析单个配置文件中的文档（可能为 None），List 文档的元素逐个产生
+    :param projected: 是否只保留分析需要的字段，见 Object.projected_data。摘要总是基于完整文档计算
+    """
+    for doc in _iter_documents(path):
+        digest = content_digest(doc) if doc is not None else None
+        if projected:
+            doc = _project_document(doc)
+        yield ParsedDocument(doc, digest)
+
+
+def parse_config_file(path: Path, projected: bool = False) -> list[ParsedDocument]:
+    """解析单个配置文件，返回其中的所有文档，用于在进程池中解析。参数同 iter_config_file"""
+    return list(iter_config_file(path, projected))
+
+
+def intern_document(doc):
+    """
+    驻留文档中大量重复的字符串（kind、命名空间、label、RBAC 规则等），减少对象占用的内存并加快比较。原地修改
+    """
+    if not isinstance(doc, dict):
+        return
+    _intern_values(doc, ('apiVersion', 'kind'))
+    metadata = doc.get('metadata', None)
+    if isinstance(metadata, dict):
+        _intern_values(metadata, ('name', 'namespace'))
+        labels = metadata.get('labels', None)
+        if isinstance(labels, dict):
+            metadata['labels'] = {_intern(k): _intern(v) for k, v in labels.items()}
+    for rule in doc.get('rules', None) or []:
+        if not isinstance(rule, dict):
+            continue
+        for field in ('apiGroups', 'resources', 'verbs'):
+            values = rule.get(field, None)
+            if isinstance(values, list):
+                rule[field] = [_intern(v) for v in values]
+    for subject in doc.get('subjects', None) or []:
+        if isinstance(subject, dict):
+            _intern_values(subject, ('kind', 'name', 'namespace', 'apiGroup'))
+    role_ref = doc.get('roleRef', None)
+    if isinstance(role_ref, dict):
+        _intern_values(role_ref, ('kind', 'name', 'apiGroup'))
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _intern_values(d: dict, keys: tuple[str, ...]):
+    for key in keys:
+        if key in d:
+            d[key] = _intern(d[key])
+
+
+def load_document(path: Path, index: int):
+    """读取配置文件中的第 index 个文档"""
+    for i, doc in enumerate(_iter_documents(path)):
+        if i == index:
+            return doc
+    raise IndexError(f'Document {index} not found in {path}')
+
+
+def _iter_documents(path: Path) -> Iterable:
+    """依次返回文件中的文档，List 文档会被展开为其中的元素"""
+    if path.suffix == '.json':
+        with path.open(encoding='utf-8') as f:
+            yield from iter_json_documents(f, reopen=lambda: path.open(encoding='utf-8'))
+    else:
+        with path.open('rb') as f:
+            yield from iter_yaml_documents(f, reopen=lambda: path.open('rb'))
+
+
+def _is_list_kind(kind) -> bool:
+    # kubectl get -o yaml/json 的输出为 List，API 的返回为 PodList 等
+    return kind is None or (isinstance(kind, str) and kind.endswith('List'))
+
+
+def _is_list_document(doc) -> bool:
+    return isinstance(doc, dict) and isinstance(doc.get('items', None), list) and _is_list_kind(doc.get('kind', None))
+
+
+# 无法提前读取 kind，此时 items 整体读入，读完对象后再判断是否为 List
+_UNKNOWN_KIND = object()
+
+
+class _KindLookahead:
+    """
+    在重新打开的同一文件中提前读取各顶层值的 kind。kubectl 的输出按键排序，items 在 kind 之前，
+    流式展开 items 前需要先确定文档是否为 List
+    """
+
+    def __init__(self, reopen: Optional[Callable[[], IO]], iter_kinds: Callable[[IO], Iterator]):
+        self._reopen = reopen
+        self._iter_kinds = iter_kinds
+        self._kinds: Optional[Iterator] = None
+        self._index = -1
+        self._kind = _UNKNOWN_KIND
+
+    def kind_of(self, index: int):
+        """第 index 个顶层值的 kind，没有 kind 时为 None，无法读取时为 _UNKNOWN_KIND"""
+        if self._reopen is None or index < self._index:
+            return _UNKNOWN_KIND
+        try:
+            if self._kinds is None:
+                self._kinds = self._iter_kinds(self._reopen())
+            while self._index < index:
+                self._kind = next(self._kinds)
+                self._index += 1
+        except Exception as e:
+            # 如 items 中定义的锚点在 items 之外被引用，或文件在读取时被修改
+            debug('failed to read kind ahead, load items as a whole', index=index, error=e)
+            self._reopen = None
+            return _UNKNOWN_KIND
+        return self._kind
+
+    def close(self):
+        if self._kinds is not None:
+            self._kinds.close()
+
+
+def iter_json_documents(f: TextIO, reopen: Optional[Callable[[], TextIO]] = None) -> Iterable:
+    """
+    流式解析 JSON 文件中的文档，支持多个顶层值、顶层数组与 List 文档。
+    List 文档的 items 逐个解析，不需要一次性读入整个文件
+    :param reopen: 重新打开同一文件，用于 items 在 kind 之前时提前读取 kind。为 None 则这类文档的 items 整体读入
+    """
+    stream = JsonStream(f)
+    lookahead = _KindLookahead(reopen, _iter_json_kinds)
+    try:
+        index = 0
+        while True:
+            ch = stream.peek()
+            if ch == '':
+                return
+            if ch == '[':
+                yield from stream.iter_array()
+            elif ch == '{':
+                yield from _iter_json_object(stream, functools.partial(lookahead.kind_of, index))
+            else:
+                raise ValueError(f'Unexpected {ch!r} at top level of JSON document')
+            index += 1
+    finally:
+        lookahead.close()
+
+
+def _iter_json_object(stream: JsonStream, kind_of: Callable[[], Any]) -> Iterable:
+    fields = {}
+    expanded = False
+    for key in stream.iter_object():
+        if key == 'items' and stream.peek() == '[' \
+                and _is_list_kind(fields['kind'] if 'kind' in fields else kind_of()):
+            yield from stream.iter_array()
+            expanded = True
+        else:
+            fields[key] = stream.value()
+    if expanded:
+        return
+    if _is_list_document(fields):
+        yield from fields['items']
+    else:
+        yield fields
+
+
+def _iter_json_kinds(f: TextIO) -> Iterator:
+    """JSON 文件中各顶层值的 kind，不构造 items 与顶层数组"""
+    with f:
+        stream = JsonStream(f)
+        while (ch := stream.peek()) != '':
+            kind = None
+            if ch == '{':
+                for key in stream.iter_object():
+                    if key == 'kind':
+                        kind = stream.value()
+                    elif stream.peek() == '[':
+                        for _ in stream.iter_array():
+                            pass
+                    else:
+                        stream.value()
+            else:
+                for _ in stream.iter_array():
+                    pass
+            yield kind
+
+
+def iter_yaml_documents(f: BinaryIO, reopen: Optional[Callable[[], BinaryIO]] = None) -> Iterable:
+    """
+    流式解析 YAML 文件中的文档，支持多文档与 List 文档。
+    List 文档的 items 逐个构造，不需要一次性构造整个文档
+    :param reopen: 同 iter_json_documents
+    """
+    stream = YamlStream(f, _YamlLoader)
+    lookahead = _KindLookahead(reopen, _iter_yaml_kinds)
+    try:
+        index = 0
+        while stream.next_document():
+            if stream.peek() == 'mapping':
+                yield from _iter_yaml_object(stream, functools.partial(lookahead.kind_of, index))
+            else:
+                doc = stream.value()
+                if _is_list_document(doc):
+                    yield from doc['items']
+                else:
+                    yield doc
+            stream.end_document()
+            index += 1
+    finally:
+        lookahead.close()
+        stream.close()
+
+
+def _iter_yaml_object(stream: YamlStream, kind_of: Callable[[], Any]) -> Iterable:
+    fields = {}
+    merged = []
+    expanded = False
+    for key in stream.iter_mapping():
+        if key == 'items' and stream.peek() == 'sequence' \
+                and _is_list_kind(fields['kind'] if 'kind' in fields else kind_of()):
+            yield from stream.iter_sequence()
+            expanded = True
+        elif key is MERGE_KEY:
+            value = stream.value()
+            merged += value if isinstance(value, list) else [value]
+        else:
+            fields[key] = stream.value()
+    if expanded:
+        return
+    fields = _merge(fields, merged)
+    if _is_list_document(fields):
+        yield from fields['items']
+    else:
+        yield fields
+
+
+def _iter_yaml_kinds(f: BinaryIO) -> Iterator:
+    """YAML 文件中各文档的 kind，不构造 items"""
+    with f:
+        stream = YamlStream(f, _YamlLoader)
+        try:
+            while stream.next_document():
+                fields = {}
+                if stream.peek() == 'mapping':
+                    merged = []
+                    for key in stream.iter_mapping():
+                        if key == 'items':
+                            stream.skip()
+                        elif key is MERGE_KEY:
+                            value = stream.value()
+                            merged += value if isinstance(value, list) else [value]
+                        else:
+                            fields[key] = stream.value()
+                    fields = _merge(fields, merged)
+                else:
+                    stream.skip()
+                yield fields.get('kind', None)
+                stream.end_document()
+        finally:
+            stream.close()
+
+
+def _merge(fields: dict, merged: list) -> dict:
+    """合并 `<<` 引用的映射，显式的键优先，多个合并的映射中靠前的优先"""
+    for value in reversed(merged):
+        fields = {**value, **fields}
+    return fields
+
+
+def _project_document(doc):
+    from analyse.k8s.basic import Object
+
+    obj = Object.from_dict(doc)
+    if obj is None:
+        return None
+    return obj.projected_data()
+
+
+class ConfigCache:
+    """
+    已解析配置文件的磁盘缓存，以 (路径, 大小, mtime, 内容哈希) 作为键
+
+    大小与 mtime 都没有变化时直接使用缓存，否则计算内容哈希，哈希相同时仍然使用缓存
+    """
+
+    VERSION = 3
+
+    def __init__(self, path: Path, projected: bool = False):
+        self.path = path
+        # 缓存的是完整文档还是投影后的文档
+        self.projected = projected
+        # 路径 -> (大小, mtime, 内容哈希, 文档列表)
+        self._entries: dict[str, tuple[int, int, str, list[ParsedDocument]]] = {}
+        self._dirty = False
+        self._load()
+
+    def _load(self):
+        if not self.path.exists():
+            return
+        try:
+            with self.path.open('rb') as f:
+                version, projected, entries = pickle.load(f)
+        except Exception as e:
+            warn('failed to load config cache, ignored', cache=self.path, error=e)
+            return
+        if version != self.VERSION or projected != self.projected:
+            info('config cache version mismatch, ignored', cache=self.path)
+            return
+        self._entries = entries
+
+    def lookup(self, path: Path) -> Optional[list[ParsedDocument]]:
+        """查找文件的缓存，文件有变化时返回 None"""
+        entry = self._entries.get(str(path), None)
+        if entry is None:
+            return None
+        size, mtime, digest, docs = entry
+        stat = path.stat()
+        if stat.st_size != size:
+            return None
+        if stat.st_mtime_ns == mtime:
+            return docs
+        # mtime 变化但内容可能没变
+        if _file_digest(path) != digest:
+            return None
+        self._entries[str(path)] = (size, stat.st_mtime_ns, digest, docs)
+        self._dirty = True
+        return docs
+
+    def put(self, path: Path, docs: list[ParsedDocument]):
+        stat = path.stat()
+        self._entries[str(path)] = (stat.st_size, stat.st_mtime_ns, _file_digest(path), docs)
+        self._dirty = True
+
+    def retain(self, paths: Iterable[Path]):
+        """删除不在 paths 中的文件的缓存"""
+        keys = {str(path) for path in paths}
+        for key in list(self._entries.keys()):
+            if key not in keys:
+                del self._entries[key]
+                self._dirty = True
+
+    def save(self):
+        if not self._dirty:
+            return
+        # 先写临时文件再替换，避免中断时留下损坏的缓存
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump((self.VERSION, self.projected, self._entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def _file_digest(path: Path) -> str:
+    digest = hashlib.sha256()
+    with path.open('rb') as f:
+        while chunk := f.read(1 << 20):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def config_fingerprint(paths: list[Path]) -> str:
+    """一系列配置文件的指纹，由路径、大小与 mtime 计算（同 ConfigCache 的快速检查），文件增删或修改后变化"""
+    digest = hashlib.sha256()
+    for path in sorted(paths):
+        stat = path.stat()
+        digest.update(f'{path}\0{stat.st_size}\0{stat.st_mtime_ns}\n'.encode())
+    return digest.hexdigest()
+
+
+def load_config_files(paths: list[Path], workers: Optional[int] = None, cache: Optional[ConfigCache] = None,
+                      projected: bool = False) -> Iterable[tuple[Path, Iterable[ParsedDocument]]]:
+    """
+    解析一系列配置文件，按 paths 的顺序逐个返回 (路径, 文档)。在主进程中解析的文件（进程数为 1、文件较少或文件较大时）
+    的文档在迭代时逐个解析，因此调用者应在处理下一个文件前消费完当前文件的文档，缓存也只记录消费完的文件
+    :param workers: 进程数，为 None 则使用 LOADER_WORKERS
+    :param cache: 已解析配置的缓存，为 None 则不使用缓存
+    :param projected: 是否只保留分析需要的字段
+    """
+    assert cache is None or cache.projected == projected, 'Config cache projection mode mismatch'
+
+    hits: dict[Path, list[ParsedDocument]] = {}
+    if cache is not None:
+        for path in paths:
+            docs = cache.lookup(path)
+            if docs is not None:
+                hits[path] = docs
+        debug('config cache lookup finished', hit=len(hits), miss=len(paths) - len(hits))
+
+    missed = _parse_config_files([path for path in paths if path not in hits], workers, projected)
+    for path in paths:
+        if path in hits:
+            yield path, hits.pop(path)
+            continue
+        parsed_path, docs = next(missed)
+        assert parsed_path == path
+        yield path, _put_when_done(cache, path, docs) if cache is not None else docs
+
+    if cache is not None:
+        cache.retain(paths)
+        cache.save()
+
+
+def _put_when_done(cache: ConfigCache, path: Path, docs: Iterable[ParsedDocument]) -> Iterable[ParsedDocument]:
+    collected = []
+    for doc in docs:
+        collected.append(doc)
+        yield doc
+    cache.put(path, collected)
+
+
+def _parse_config_files(paths: list[Path], workers: Optional[int],
+                        projected: bool) -> Iterable[tuple[Path, Iterable[ParsedDocument]]]:
+    """按 paths 的顺序返回 (路径, 文档)，较小的文件在进程池中解析，其他文件在主进程中流式解析"""
+    if workers is None:
+        workers = LOADER_WORKERS
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if workers == 1 or len(paths) < _PARALLEL_MIN_FILES:
+        for path in paths:
+            yield path, iter_config_file(path, projected)
+        return
+
+    large = {path for path in paths if path.stat().st_size >= _LARGE_FILE_SIZE}
+    pooled = [path for path in paths if path not in large]
+    debug('parse config files in process pool', files=len(pooled), workers=workers, large=len(large))
+    chunk_size = max(1, len(pooled) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parse = functools.partial(parse_config_file, projected=projected)
+        results = executor.map(parse, pooled, chunksize=chunk_size)
+        for path in paths:
+            if path in large:
+                debug('stream large config file in main process', path=path)
+                yield path, iter_config_file(path, projected)
+            else:
+                yield path, next(results)
@@ -4,9 +4,10 @@
 from enum import Enum
 from typing import Optional
 
-from tinydb import Query
-
-from analyse.k8s.basic import Object, ObjectStore
+from analyse.k8s.basic import Object, ObjectStore, namespace_matches
+from analyse.k8s.rbac.aggregation import AggregationGraph
+from analyse.k8s.rbac.graph import RbacGraph
+from analyse.k8s.rbac.rule_table import RuleTable
 from utils.log import log_funcs
 
 debug, info, warn, error, fatal = log_funcs(from_file=__file__)
@@ -48,36 +49,15 @@ RESOURCE_SPECIFIC = PermissionScope.RESOURCE_SPECIFIC
 
 
 class ServiceAccount(Object):
-
-    def __init__(self, data: dict, store=None):
-        super().__init__(data, store)
-        self._cached_role_bindings = None
-        self._cached_roles = None
+    __slots__ = ()
 
     def find_role_bindings(self):
         """查找关联的 RoleBinding"""
-        if self._cached_role_bindings is not None:
-            return self._cached_role_bindings
-
-        self._cached_role_bindings = self.store.search(
-            Query().subjects.any(
-                (Query().kind == 'ServiceAccount') &
-                (Query().name == self.name)
-            )
-        )
-        return self._cached_role_bindings
+        return self.store.cached('rbac', RbacGraph).bindings_of(self)
 
     def find_roles(self):
         """查找关联的 Role"""
-        if self._cached_roles is not None:
-            return self._cached_roles
-
-        binds = self.find_role_bindings()
-        results = []
-        for bind in binds:
-            results += bind.find_role()
-        self._cached_roles = results
-        return results
+        return self.store.cached('rbac', RbacGraph).roles_of(self)
 
     def can_i(self, *args, **kwargs):
         """判断是否有权限"""
@@ -98,36 +78,53 @@ class ServiceAccount(Object):
 
 
 class DefaultServiceAccount(ServiceAccount):
-    def __init__(self, store=None):
+    __slots__ = ()
+
+    def __init__(self, store=None, namespace: Optional[str] = None):
         super().__init__({
             'apiVersion': 'v1',
             'kind': 'ServiceAccount',
             'metadata': {
                 'name': 'default',
-                'namespace': None,  # 实际上 default 应该属于某个命名空间
+                'namespace': namespace,  # 为 None 时表示不确定属于哪个命名空间
             }
         }, store)
 
 
-def get_service_account_by_name(store: ObjectStore, sa_name: str) -> ServiceAccount:
-    """根据名称查找 ServiceAccount"""
-    # 默认 SA
-    if sa_name == 'default' or sa_name == '':
-        return DefaultServiceAccount(store)
-
-    sas = store.search((Query().metadata.name == sa_name) & (Query().kind == 'ServiceAccount'))
-    assert len(sas) == 1, f'Found {len(sas)} ServiceAccount with name {sa_name}'
-    return sas[0]
+def get_service_account_by_name(store: ObjectStore, sa_name: str, namespace: Optional[str] = None) -> ServiceAccount:
+    """
+    根据名称查找 ServiceAccount，默认 ServiceAccount 在每个 store 的每个命名空间中只有一个对象
+    :param namespace: ServiceAccount 所在的命名空间，一般为工作负载的命名空间。为 None 则在所有命名空间中查找
+    """
+    return store.cached('rbac', RbacGraph).service_account(sa_name, namespace)
 
 
 class RoleBinding(Object):
+    __slots__ = ()
+    RESIDENT_FIELDS = Object.RESIDENT_FIELDS + ('subjects', 'roleRef')
 
     def find_role(self):
         """查找关联的 Role"""
-        return self.store.search(
-            (Query().kind.one_of(['Role', 'ClusterRole'])) &
-            (Query().metadata.name == self.data['roleRef']['name'])
-        )
+        return self.store.cached('rbac', RbacGraph).roles_of_binding(self)
+
+    def resolve_roles(self):
+        """根据 roleRef 在 store 中查找 Role，Role 只在 RoleBinding 所在的命名空间中查找。用于构建 RbacGraph"""
+        role_ref = self.data['roleRef']
+        ref_kind = role_ref.get('kind', None)
+        if ref_kind == 'ClusterRole':
+            return self.store.find_by_kind_and_name('ClusterRole', role_ref['name'])
+        if ref_kind == 'Role':
+            return self.store.find_in_namespace('Role', self.namespace, role_ref['name'])
+        return self.store.find_by_kind_and_name(('Role', 'ClusterRole'), role_ref['name'])
+
+    def has_subject(self, kind: str, name: str, namespace: Optional[str] = None) -> bool:
+        """subjects 中是否包含指定主体，未指定的命名空间视为匹配"""
+        for subject in self.data.get('subjects', None) or []:
+            if subject.get('kind', None) != kind or subject.get('name', None) != name:
+                continue
+            if namespace_matches(subject.get('namespace', None), namespace):
+                return True
+        return False
 
     def __repr__(self):
         return f'RoleBinding({self.data})'
@@ -144,14 +141,23 @@ class RoleBinding(Object):
 
 
 class Role(Object):
+    __slots__ = ('_rule_tables',)
+    RESIDENT_FIELDS = Object.RESIDENT_FIELDS + ('rules', 'aggregationRule')
+
+    def __init__(self, data: dict, store=None):
+        super().__init__(data, store)
+        # 编译后的规则表 (store 版本, scope -> RuleTable)
+        self._rule_tables = None
+
+    def bind_store(self, store):
+        super().bind_store(store)
+        self._rule_tables = None
 
     def list_rules(self, scope: Optional[PermissionScope] = None):
         """
         列出所有规则
         :param scope: 只返回指定 scope 的规则，不会考虑范围之间的偏序关系，为 None 则不限制
         """
-        rules = []
-
         # cluster scope 规则不可能出现在 Role 中
         if scope == PermissionScope.CLUSTER and not self.is_cluster:
             return []
@@ -159,32 +165,28 @@ class Role(Object):
         if scope == PermissionScope.NAMESPACE and self.is_cluster:
             return []
 
-        explicit_rules = self.data.get('rules', None)
-        if explicit_rules:
-            rules += explicit_rules
+        is_resource_specific = scope == PermissionScope.RESOURCE_SPECIFIC
+        rules = self.explicit_rules(resource_specific=is_resource_specific)
 
-        if self.is_cluster:
-            # 如果是集群角色，需要考虑合并规则
-            agg_roles = self.find_matched_aggregation_roles()
-            for role in agg_roles:
-                rules += role.list_rules()
+        if self.is_cluster and not is_resource_specific:
+            # 如果是集群角色，需要考虑合并规则。聚合只继承非 resource-specific 规则
+            rules = rules + self.store.cached('aggregation', AggregationGraph).inherited_rules(self)
+
+        return rules
 
-        # 过滤 resource-specific scope 的规则
+    def explicit_rules(self, resource_specific: bool = False) -> list[dict]:
+        """
+        自身声明的规则，不包括聚合的规则
+        :param resource_specific: 为 True 则只返回 resource-specific 规则，否则只返回其他规则
+        """
         filtered_rules = []
-        for rule in rules:
+        for rule in self.data.get('rules', None) or []:
             norm_rule = _normalize_rule(rule)
             if norm_rule is None:
                 continue
-            is_resource_specific_rule = norm_rule['resourceNames'] is not None
-
-            if scope == PermissionScope.RESOURCE_SPECIFIC and is_resource_specific_rule:
+            if (norm_rule['resourceNames'] is not None) == resource_specific:
                 filtered_rules.append(rule)
-            elif scope != PermissionScope.RESOURCE_SPECIFIC and not is_resource_specific_rule:
-                filtered_rules.append(rule)
-
-        rules = filtered_rules
-
-        return rules
+        return filtered_rules
 
     def can_i(self, api_group: str, verb: str, resource: str, resource_name: str = None,
               strict_scope: Optional[PermissionScope] = None):
@@ -199,25 +201,23 @@ class Role(Object):
         if strict_scope is not None:
             assert isinstance(strict_scope, PermissionScope), 'strict_scope must be an instance of PermissionScope'
 
-        rules = self.list_rules(scope=strict_scope)
-        for rule in rules:
-            norm_rule = _normalize_rule(rule)
-
-            # 强制匹配的字段们
-            if not _check_rule(norm_rule, 'apiGroups', api_group):
-                continue
-            if not _check_rule(norm_rule, 'resources', resource):
-                continue
-            if not _check_rule(norm_rule, 'verbs', verb):
-                continue
-
-            # 参数不指定就不限制的字段们
-            if resource_name is not None and not _check_rule(norm_rule, 'resourceNames', resource_name):
-                continue
+        return self.rule_table(strict_scope).can_i(api_group, verb, resource, resource_name)
 
-            # 匹配一条规则
-            return True
-        return False
+    def rule_table(self, scope: Optional[PermissionScope] = None) -> RuleTable:
+        """
+        list_rules(scope) 编译后的规则表。规则表缓存在对象上，store 变化（见 ObjectStore.invalidate）后重新编译
+        """
+        generation = self.store.generation if self.store is not None else None
+        if self._rule_tables is None or self._rule_tables[0] != generation:
+            self._rule_tables = (generation, {})
+        tables = self._rule_tables[1]
+
+        table = tables.get(scope, None)
+        if table is None:
+            norm_rules = (_normalize_rule(rule) for rule in self.list_rules(scope=scope))
+            table = RuleTable.compile(rule for rule in norm_rules if rule is not None)
+            tables[scope] = table
+        return table
 
     def find_matched_aggregation_roles(self):
         """查找聚合条件匹配到的 ClusterRole 对象"""
@@ -230,19 +230,11 @@ class Role(Object):
         if 'clusterRoleSelectors' not in self.data['aggregationRule']:
             return result
 
-        for match_rules in self.data['aggregationRule']['clusterRoleSelectors']:
-            if 'matchLabels' in match_rules:
-                match_labels = match_rules['matchLabels']
-
-                cond = Query().kind == 'ClusterRole'
-                for k, v in match_labels.items():
-                    cond &= Query().metadata.labels[k] == v
-
-                roles = self.store.search(cond)
-                result += roles
-
-            if 'matchExpressions' in match_rules:
-                raise NotImplementedError('matchExpressions not supported yet')
+        for selector in self.data['aggregationRule']['clusterRoleSelectors']:
+            for role in self.store.find_by_selector(selector, kind='ClusterRole'):
+                # 多个选择器可能匹配同一个 ClusterRole
+                if not any(role is r for r in result):
+                    result.append(role)
 
         return result
 
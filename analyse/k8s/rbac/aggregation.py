@@ -0,0 +1,142 @@
+# aggregation.py -- ClusterRole 的聚合关系
+#
+# Copyright (C) 2024 KAAAsS
+from typing import Optional
+
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+
+def strongly_connected_components(edges: list[list[int]]) -> list[list[int]]:
+    """Tarjan 算法（非递归），按逆拓扑序返回强连通分量，即分量总是在其前驱之前返回"""
+    n = len(edges)
+    index: list[Optional[int]] = [None] * n
+    low = [0] * n
+    on_stack = [False] * n
+    stack = []
+    result = []
+    counter = 0
+
+    for root in range(n):
+        if index[root] is not None:
+            continue
+        index[root] = low[root] = counter
+        counter += 1
+        stack.append(root)
+        on_stack[root] = True
+        work = [(root, 0)]
+        while work:
+            v, i = work[-1]
+            if i < len(edges[v]):
+                work[-1] = (v, i + 1)
+                w = edges[v][i]
+                if index[w] is None:
+                    index[w] = low[w] = counter
+                    counter += 1
+                    stack.append(w)
+                    on_stack[w] = True
+                    work.append((w, 0))
+                elif on_stack[w]:
+                    low[v] = min(low[v], index[w])
+                continue
+
+            work.pop()
+            if work:
+                u = work[-1][0]
+                low[u] = min(low[u], low[v])
+            if low[v] == index[v]:
+                component = []
+                while True:
+                    w = stack.pop()
+                    on_stack[w] = False
+                    component.append(w)
+                    if w == v:
+                        break
+                result.append(component)
+    return result
+
+
+class AggregationGraph:
+    """
+    store 中所有 ClusterRole 的聚合关系图。构建时一次性求出每个 ClusterRole 经聚合（可传递）能到达的所有 ClusterRole，
+    聚合关系中存在环时给出警告，环中的 ClusterRole 互相包含对方的规则
+    """
+
+    def __init__(self, store):
+        self.roles = store.search_by_kind('ClusterRole')
+        self._ids = {id(role): i for i, role in enumerate(self.roles)}
+        # 聚合选择器无效（如不支持的运算符）的 ClusterRole，查询到它时再抛出
+        self._errors: dict[int, Exception] = {}
+        self.edges: list[list[int]] = [self._find_edges(i, role) for i, role in enumerate(self.roles)]
+
+        # 每个 ClusterRole 的传递闭包（包括自身）
+        self._closures: list[frozenset[int]] = [frozenset()] * len(self.roles)
+        # 存在环的 ClusterRole 名称
+        self.cycles: list[list[str]] = []
+        self._compute_closures()
+        # ClusterRole -> 从聚合的 ClusterRole 继承的规则
+        self._inherited_rules: dict[int, list[dict]] = {}
+
+    def _find_edges(self, i: int, role) -> list[int]:
+        try:
+            children = role.find_matched_aggregation_roles()
+        except ValueError as e:
+            self._errors[i] = e
+            return []
+        edges = []
+        for child in children:
+            j = self._ids[id(child)]
+            if j not in edges:
+                edges.append(j)
+        return edges
+
+    def _compute_closures(self):
+        components = strongly_connected_components(self.edges)
+        component_of = {}
+        for c, component in enumerate(components):
+            for v in component:
+                component_of[v] = c
+
+        # 分量按逆拓扑序排列，计算到某个分量时其后继已经计算完成
+        component_closures = []
+        for c, component in enumerate(components):
+            closure = set(component)
+            for v in component:
+                for w in self.edges[v]:
+                    if component_of[w] != c:
+                        closure |= component_closures[component_of[w]]
+            closure = frozenset(closure)
+            component_closures.append(closure)
+            for v in component:
+                self._closures[v] = closure
+
+            if len(component) > 1 or component[0] in self.edges[component[0]]:
+                names = sorted(self.roles[v].name for v in component)
+                warn('aggregation cycle found in ClusterRoles', roles=names)
+                self.cycles.append(names)
+
+    def closure(self, role) -> list:
+        """ClusterRole 经聚合能到达的所有其他 ClusterRole，按 store 中的顺序"""
+        i = self._ids[id(role)]
+        closure = self._closures[i] | {i}
+        for j in sorted(closure):
+            if j in self._errors:
+                raise self._errors[j]
+        return [self.roles[j] for j in sorted(closure) if j != i]
+
+    def aggregated_by(self, role) -> list:
+        """经聚合（可传递）包含该 ClusterRole 的其他 ClusterRole，按 store 中的顺序"""
+        i = self._ids[id(role)]
+        return [self.roles[j] for j, closure in enumerate(self._closures) if j != i and i in closure]
+
+    def inherited_rules(self, role) -> list[dict]:
+        """ClusterRole 从聚合的 ClusterRole 继承的规则，只包含非 resource-specific 规则，结果被缓存"""
+        i = self._ids[id(role)]
+        rules = self._inherited_rules.get(i, None)
+        if rules is None:
+            rules = []
+            for child in self.closure(role):
+                rules += child.explicit_rules(resource_specific=False)
+            self._inherited_rules[i] = rules
+        return rules
@@ -0,0 +1,138 @@
+# dependency.py -- ServiceAccount 有效权限的依赖追踪
+#
+# Copyright (C) 2024 KAAAsS
+import collections
+from typing import Iterable, Optional
+
+from analyse.k8s.basic import namespace_matches
+from analyse.k8s.rbac.aggregation import AggregationGraph
+from analyse.k8s.rbac.graph import RbacGraph
+
+# 对象标识 (kind, namespace, name)
+Identity = tuple[str, Optional[str], str]
+# ServiceAccount 键 (namespace, name)
+SaKey = tuple[Optional[str], str]
+
+RBAC_KINDS = 'ServiceAccount', 'Role', 'ClusterRole', 'RoleBinding', 'ClusterRoleBinding'
+
+
+def identity_of(obj) -> Identity:
+    return obj.kind, obj.namespace, obj.name
+
+
+def sa_key(sa) -> SaKey:
+    return sa.namespace, sa.name
+
+
+def requested_sa_key(pod) -> SaKey:
+    """工作负载请求的 ServiceAccount，即其命名空间与 serviceAccountName，可能与查找到的 ServiceAccount 不同"""
+    return pod.namespace, pod.sa_name
+
+
+def store_fingerprints(store) -> dict[Identity, frozenset[str]]:
+    """对象标识 -> 具有该标识的所有对象的内容摘要，用于比较两个 store 之间变化的对象"""
+    digests = collections.defaultdict(set)
+    for obj in store:
+        digests[identity_of(obj)].add(obj.digest)
+    return {identity: frozenset(d) for identity, d in digests.items()}
+
+
+def changed_identities(old: dict[Identity, frozenset[str]], new: dict[Identity, frozenset[str]]) -> set[Identity]:
+    """新增、删除或内容变化的对象标识，参数为 store_fingerprints 的结果"""
+    return {identity for identity in old.keys() | new.keys() if old.get(identity, None) != new.get(identity, None)}
+
+
+def _role_ref_identities(bind) -> list[Identity]:
+    """RoleBinding 引用的 Role 的标识，Role 不存在时也记录，之后加入的 Role 同样会影响权限"""
+    role_ref = bind.data.get('roleRef', None) or {}
+    name = role_ref.get('name', None)
+    if name is None:
+        return []
+    kind = role_ref.get('kind', None)
+    kinds = (kind,) if kind in ('Role', 'ClusterRole') else ('Role', 'ClusterRole')
+    return [(k, bind.namespace if k == 'Role' else None, name) for k in kinds]
+
+
+class RbacDependencies:
+    """
+    ServiceAccount 的有效权限依赖的 RBAC 对象，以及反向的依赖键 -> ServiceAccount 索引。
+
+    ServiceAccount 的权限只由它本身、以它为主体的 binding、binding 引用的 Role 以及 ClusterRole 经聚合到达的
+    ClusterRole 决定。对象变化时，依赖它的 ServiceAccount 与新版本 binding 的主体需要重新计算；
+    ClusterRole 变化时，经聚合包含它的 ClusterRole 也视为变化（聚合选择器可能新匹配到它）
+    """
+
+    def __init__(self):
+        self._deps: dict[SaKey, set[Identity]] = {}
+        # (kind, name) -> {(依赖对象的命名空间, ServiceAccount 键)}，命名空间按 namespace_matches 比较
+        self._dependents: dict[tuple[str, str], set[tuple[Optional[str], SaKey]]] = collections.defaultdict(set)
+
+    def track(self, sa):
+        """记录 ServiceAccount 在其所在 store 中的依赖，已记录时覆盖"""
+        key = sa_key(sa)
+        graph: RbacGraph = sa.store.cached('rbac', RbacGraph)
+        deps = {('ServiceAccount', sa.namespace, sa.name)}
+        for bind in graph.bindings_of(sa):
+            deps.add(identity_of(bind))
+            deps.update(_role_ref_identities(bind))
+        for role in graph.roles_of(sa):
+            for r in [role] + graph.aggregated_roles(role):
+                deps.add(identity_of(r))
+
+        self.forget(key)
+        self._deps[key] = deps
+        for kind, namespace, name in deps:
+            self._dependents[kind, name].add((namespace, key))
+
+    def forget(self, key: SaKey):
+        for kind, namespace, name in self._deps.pop(key, ()):
+            self._dependents[kind, name].discard((namespace, key))
+
+    def deps_of(self, key: SaKey) -> set[Identity]:
+        return self._deps.get(key, set())
+
+    def __contains__(self, key: SaKey):
+        return key in self._deps
+
+    def affected(self, changed: Iterable[Identity], new_store) -> tuple[set[SaKey], list[SaKey]]:
+        """
+        对象变化后需要重新计算的 ServiceAccount
+        :param changed: 变化的对象标识，见 changed_identities
+        :param new_store: 变化后的 store
+        :return: (已记录的受影响 ServiceAccount, 新版本 binding 的主体)。主体的命名空间为 None 时匹配任意命名空间
+        """
+        deps = set()
+        subjects = []
+        aggregation = None
+        for kind, namespace, name in changed:
+            if kind not in RBAC_KINDS:
+                continue
+            deps.add((kind, namespace, name))
+            if kind in ('RoleBinding', 'ClusterRoleBinding'):
+                for bind in new_store.find_by_identity(kind, namespace, name):
+                    for subject in bind.data.get('subjects', None) or []:
+                        if subject.get('kind', None) == 'ServiceAccount' and subject.get('name', None):
+                            subjects.append((subject.get('namespace', None), subject['name']))
+            elif kind == 'ClusterRole':
+                if aggregation is None:
+                    aggregation = new_store.cached('aggregation', AggregationGraph)
+                for role in new_store.find_by_identity(kind, namespace, name):
+                    deps.update(identity_of(r) for r in aggregation.aggregated_by(role))
+
+        affected = set()
+        for kind, namespace, name in deps:
+            for dep_namespace, key in self._dependents.get((kind, name), ()):
+                if namespace_matches(dep_namespace, namespace):
+                    affected.add(key)
+        return affected, subjects
+
+
+def changed_service_accounts(changed: Iterable[Identity]) -> list[SaKey]:
+    """变化的对象中新增、删除或修改的 ServiceAccount，可能改变同名 ServiceAccount 的查找结果"""
+    return [(namespace, name) for kind, namespace, name in changed if kind == 'ServiceAccount']
+
+
+def sa_matches(key: SaKey, subjects: list[SaKey]) -> bool:
+    """ServiceAccount 是否为 subjects 中的某个主体"""
+    namespace, name = key
+    return any(name == s_name and namespace_matches(s_namespace, namespace) for s_namespace, s_name in subjects)
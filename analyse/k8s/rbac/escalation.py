@@ -0,0 +1,174 @@
+# escalation.py -- 权限提升的传递闭包
+#
+# Copyright (C) 2024 KAAAsS
+import collections
+from typing import Optional
+
+from analyse.k8s.rbac import PermissionScope, ServiceAccount
+from analyse.k8s.rbac.graph import RbacGraph
+from analyse.k8s.rbac.matrix import PermissionMatrix, SCOPES, PermissionKey
+from analyse.k8s.workload import WORKLOAD_RESOURCES
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 可以获得其他 ServiceAccount 身份的权限：以任意 ServiceAccount 运行工作负载、读取 token、扮演
+IDENTITY_PERMS: tuple[PermissionKey, ...] = tuple((resource, 'create') for resource in WORKLOAD_RESOURCES) + (
+    ('secrets', 'get'),
+    ('secrets', 'list'),
+    ('serviceaccounts', 'impersonate'),
+)
+
+# 可以获得任意权限的权限组合：escalate 可以直接修改 Role，bind 需要同时能创建 binding，扮演用户与组可以成为管理员
+GRANT_PERMS: tuple[tuple[PermissionKey, ...], ...] = (
+    (('roles', 'escalate'),),
+    (('clusterroles', 'escalate'),),
+    (('roles', 'bind'), ('rolebindings', 'create')),
+    (('clusterroles', 'bind'), ('clusterrolebindings', 'create')),
+    (('users', 'impersonate'),),
+    (('groups', 'impersonate'),),
+)
+
+Masks = tuple[int, ...]
+
+
+def _or(a: Masks, b: Masks) -> Masks:
+    return tuple(x | y for x, y in zip(a, b))
+
+
+class EscalationClosure:
+    """
+    每个 ServiceAccount 经权限提升能获得的身份与权限，以工作表算法求不动点。
+
+    身份之间的可达关系依赖已经获得的权限，获得新的权限后可能到达新的身份，因此可达关系与权限一起迭代直到不再变化。
+    集群范围的权限可以到达所有 ServiceAccount，命名空间范围的权限可以到达同一命名空间中的 ServiceAccount，
+    resource-specific 权限只能作用于特定的资源，不考虑。为了避免 O(n^2) 的边，"所有 ServiceAccount" 与
+    "命名空间中的 ServiceAccount" 各用一个虚拟节点表示
+    """
+
+    def __init__(self, store, matrix: Optional[PermissionMatrix] = None):
+        self.matrix = matrix if matrix is not None else PermissionMatrix()
+        self.graph: RbacGraph = store.cached('rbac', RbacGraph)
+        universe = self.matrix.universe
+
+        # 各命名空间中的默认 ServiceAccount 也是可以到达的身份
+        for namespace in store.namespaces():
+            self.graph.default_service_account(namespace)
+        # 节点下标与 RbacGraph 中的 ServiceAccount 节点一致
+        self.sas: list[ServiceAccount] = list(self.graph.sas)
+
+        # 虚拟节点：所有 ServiceAccount 与各命名空间的 ServiceAccount
+        n = len(self.sas)
+        self._all_node = n
+        namespaces = sorted({sa.namespace for sa in self.sas if sa.namespace is not None})
+        self._ns_nodes = {namespace: n + 1 + i for i, namespace in enumerate(namespaces)}
+        node_count = n + 1 + len(namespaces)
+
+        empty = (0,) * len(SCOPES)
+        self._base: list[Masks] = [self.matrix.sa_masks(sa) for sa in self.sas] + [empty] * (node_count - n)
+        self._succ: list[set[int]] = [set() for _ in range(node_count)]
+        self._succ[self._all_node] = set(range(n))
+        for node, sa in enumerate(self.sas):
+            if sa.namespace is None:
+                # 命名空间不确定的 ServiceAccount 可能属于任意命名空间
+                for ns_node in self._ns_nodes.values():
+                    self._succ[ns_node].add(node)
+            else:
+                self._succ[self._ns_nodes[sa.namespace]].add(node)
+
+        self._identity_masks = [universe.perms_of_key(*key) for key in IDENTITY_PERMS]
+        self._grant_masks = [[universe.perms_of_key(*key) for key in group] for group in GRANT_PERMS]
+        self._all_mask = universe.all_mask
+
+        self._values = self._solve()
+
+    def _held_scope(self, masks: Masks, perm_mask: int) -> Optional[int]:
+        """持有权限的最大范围在 SCOPES 中的下标，不持有时返回 None"""
+        for i, mask in enumerate(masks):
+            if mask & perm_mask:
+                return i
+        return None
+
+    def _targets(self, node: int, masks: Masks) -> set[int]:
+        """根据已有权限，ServiceAccount 能直接到达的节点"""
+        scope_index = min((i for i in (self._held_scope(masks, m) for m in self._identity_masks) if i is not None),
+                          default=None)
+        if scope_index is None or SCOPES[scope_index] == PermissionScope.RESOURCE_SPECIFIC:
+            return set()
+        namespace = self.sas[node].namespace
+        if SCOPES[scope_index] == PermissionScope.CLUSTER or namespace is None:
+            return {self._all_node}
+        return {self._ns_nodes[namespace]}
+
+    def _grants(self, masks: Masks) -> Masks:
+        """根据已有权限，能直接授予自己的权限"""
+        result = [0] * len(SCOPES)
+        for group in self._grant_masks:
+            # 组合中的每个权限都需要持有，授予的范围为其中最小的范围
+            indices = [self._held_scope(masks, m) for m in group]
+            if any(i is None for i in indices):
+                continue
+            scope_index = max(indices)
+            if SCOPES[scope_index] != PermissionScope.RESOURCE_SPECIFIC:
+                result[scope_index] = self._all_mask
+        return tuple(result)
+
+    def _solve(self) -> list[Masks]:
+        values = list(self._base)
+        preds: dict[int, set[int]] = collections.defaultdict(set)
+        for node, succ in enumerate(self._succ):
+            for target in succ:
+                preds[target].add(node)
+
+        worklist = collections.deque(range(len(values)))
+        queued = [True] * len(values)
+        iterations = 0
+        while worklist:
+            node = worklist.popleft()
+            queued[node] = False
+            iterations += 1
+
+            value = values[node]
+            if node < len(self.sas):
+                for target in self._targets(node, value) - self._succ[node]:
+                    self._succ[node].add(target)
+                    preds[target].add(node)
+                value = _or(value, self._grants(value))
+            for target in self._succ[node]:
+                value = _or(value, values[target])
+
+            if value != values[node]:
+                values[node] = value
+                # 获得新权限的节点本身也可能到达新的节点
+                for pred in list(preds[node]) + [node]:
+                    if not queued[pred]:
+                        queued[pred] = True
+                        worklist.append(pred)
+
+        debug('escalation closure solved', nodes=len(values), iterations=iterations)
+        return values
+
+    def _node(self, sa: ServiceAccount) -> int:
+        node = self.graph.node_of(sa)
+        assert node < len(self.sas), f'ServiceAccount {sa.name} not found when building escalation closure'
+        return node
+
+    def masks(self, sa: ServiceAccount) -> Masks:
+        """ServiceAccount 经权限提升后的权限位集，按 SCOPES 的顺序"""
+        return self._values[self._node(sa)]
+
+    def list_perms(self, sa: ServiceAccount) -> list[tuple[PermissionKey, PermissionScope]]:
+        """ServiceAccount 经权限提升后的权限，格式同 PermissionMatrix.list_perms"""
+        return self.matrix.list_masks(self.masks(sa))
+
+    def reachable(self, sa: ServiceAccount) -> list[ServiceAccount]:
+        """ServiceAccount 经权限提升能获得的其他身份"""
+        start = self._node(sa)
+        seen = {start}
+        stack = [start]
+        while stack:
+            for target in self._succ[stack.pop()]:
+                if target not in seen:
+                    seen.add(target)
+                    stack.append(target)
+        return [self.sas[node] for node in sorted(seen) if node < len(self.sas) and node != start]
@@ -0,0 +1,120 @@
+# graph.py -- RBAC 关系图
+#
+# Copyright (C) 2024 KAAAsS
+from typing import Optional
+
+from analyse.k8s.rbac.aggregation import AggregationGraph
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+
+class RbacGraph:
+    """
+    store 中 ServiceAccount -> RoleBinding -> Role 的关系图，以邻接数组保存，每个 store 只构建一次（见 ObjectStore.cached）。
+
+    ServiceAccount 节点是驻留的：同一个 ServiceAccount（包括各命名空间的默认 ServiceAccount）只对应一个节点与一个对象，
+    使用同一 ServiceAccount 的工作负载共享其查询结果
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self.bindings = store.search_by_kind('RoleBinding') + store.search_by_kind('ClusterRoleBinding')
+        self.roles = store.search_by_kind('Role') + store.search_by_kind('ClusterRole')
+        self._binding_ids = {id(bind): i for i, bind in enumerate(self.bindings)}
+        self._role_ids = {id(role): i for i, role in enumerate(self.roles)}
+        # binding -> role
+        self.binding_roles: list[list[int]] = [
+            [self._role_ids[id(role)] for role in bind.resolve_roles()]
+            for bind in self.bindings
+        ]
+
+        # ServiceAccount 节点
+        self.sas = []
+        # id(sa) -> 节点
+        self._sa_nodes: dict[int, int] = {}
+        # 命名空间 -> 默认 ServiceAccount 节点
+        self._default_sa_nodes: dict[Optional[str], int] = {}
+        # ServiceAccount -> binding
+        self.sa_bindings: list[list[int]] = []
+        # ServiceAccount -> role，第一次查询时计算
+        self._sa_roles: list[Optional[list[int]]] = []
+        # 未找到的 ServiceAccount (namespace, name)，只警告一次
+        self._unresolved: set[tuple[Optional[str], str]] = set()
+        for sa in store.search_by_kind('ServiceAccount'):
+            self._add_sa(sa)
+
+    def _add_sa(self, sa) -> int:
+        node = len(self.sas)
+        self.sas.append(sa)
+        self._sa_nodes[id(sa)] = node
+        self.sa_bindings.append([
+            self._binding_ids[id(bind)]
+            for bind in self.store.find_bindings_by_subject('ServiceAccount', sa.name)
+            if bind.has_subject('ServiceAccount', sa.name, sa.namespace)
+        ])
+        self._sa_roles.append(None)
+        return node
+
+    def node_of(self, sa) -> int:
+        """ServiceAccount 对应的节点，不在图中时加入"""
+        from analyse.k8s.rbac import DefaultServiceAccount
+
+        node = self._sa_nodes.get(id(sa), None)
+        if node is not None:
+            return node
+        if isinstance(sa, DefaultServiceAccount):
+            return self._sa_nodes[id(self.default_service_account(sa.namespace))]
+        # 不在 store 中的 ServiceAccount
+        return self._add_sa(sa)
+
+    def default_service_account(self, namespace: Optional[str] = None):
+        """命名空间中的默认 ServiceAccount，namespace 为 None 表示不确定属于哪个命名空间"""
+        from analyse.k8s.rbac import DefaultServiceAccount
+
+        node = self._default_sa_nodes.get(namespace, None)
+        if node is None:
+            node = self._add_sa(DefaultServiceAccount(self.store, namespace))
+            self._default_sa_nodes[namespace] = node
+        return self.sas[node]
+
+    def service_account(self, sa_name: str, namespace: Optional[str] = None):
+        """根据名称查找 ServiceAccount，参数同 get_service_account_by_name"""
+        if sa_name == 'default' or sa_name == '':
+            return self.default_service_account(namespace)
+
+        sas = self.store.find_in_namespace('ServiceAccount', namespace, sa_name)
+        if not sas:
+            # 不使用其他命名空间中的同名 ServiceAccount，否则工作负载会获得其他租户的权限
+            if (namespace, sa_name) not in self._unresolved:
+                self._unresolved.add((namespace, sa_name))
+                warn('ServiceAccount not found, use the default ServiceAccount instead', name=sa_name,
+                     namespace=namespace)
+            return self.default_service_account(namespace)
+        assert len(sas) == 1, f'Found {len(sas)} ServiceAccount with name {sa_name} in namespace {namespace}'
+        return sas[0]
+
+    def bindings_of(self, sa) -> list:
+        """ServiceAccount 关联的 RoleBinding 与 ClusterRoleBinding"""
+        return [self.bindings[b] for b in self.sa_bindings[self.node_of(sa)]]
+
+    def roles_of_binding(self, bind) -> list:
+        return [self.roles[r] for r in self.binding_roles[self._binding_ids[id(bind)]]]
+
+    def roles_of(self, sa) -> list:
+        """ServiceAccount 通过 binding 关联的 Role，不包括聚合的 ClusterRole"""
+        node = self.node_of(sa)
+        roles = self._sa_roles[node]
+        if roles is None:
+            roles = []
+            for b in self.sa_bindings[node]:
+                roles += self.binding_roles[b]
+            self._sa_roles[node] = roles
+        return [self.roles[r] for r in roles]
+
+    def aggregated_roles(self, role) -> list:
+        """ClusterRole 经聚合能到达的其他 ClusterRole"""
+        if not role.is_cluster:
+            return []
+        return self.store.cached('aggregation', AggregationGraph).closure(role)
+
@@ -0,0 +1,245 @@
+# matrix.py -- 基于位集的有效权限矩阵
+#
+# Copyright (C) 2024 KAAAsS
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Iterable, Iterator, Optional
+
+from analyse.k8s.rbac import PermissionScope, ServiceAccount, Role
+from analyse.k8s.rbac.memo import PermissionMemo, role_set_fingerprint
+from analyse.k8s.rbac.permission import Permission, get_all_perms, all_perms_csv
+from analyse.k8s.rbac.rule_table import RuleTable, ANY
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 按偏序从大到小排列的权限范围
+SCOPES = tuple(sorted(PermissionScope, reverse=True))
+
+PermissionKey = tuple[str, str]
+
+
+def iter_bits(mask: int) -> Iterator[int]:
+    """依次返回位集中为 1 的位的下标"""
+    while mask:
+        low = mask & -mask
+        yield low.bit_length() - 1
+        mask ^= low
+
+
+class PermissionUniverse:
+    """
+    权限全集。每个权限对应一个整数 id，即位集中的下标；去重键 (resource, verb) 也有各自的 id
+    """
+
+    def __init__(self, perms: Iterable[Permission]):
+        # 排序以保证 id 在不同进程中一致
+        self.perms: list[Permission] = sorted(perms, key=lambda p: tuple(x or '' for x in p))
+        self.all_mask = (1 << len(self.perms)) - 1
+        # 全集内容的摘要，全集不同时缓存的权限位集不能通用
+        self.fingerprint = hashlib.blake2b(json.dumps(self.perms).encode(), digest_size=16).hexdigest()
+
+        # 去重键
+        self.keys: list[PermissionKey] = []
+        key_ids: dict[PermissionKey, int] = {}
+        self._key_of: list[int] = []
+        # 去重键 -> 具有该键的权限位集
+        self._key_perm_masks: list[int] = []
+        # 各字段取值 -> 具有该取值的权限位集
+        self._group_masks: dict[str, int] = {}
+        self._resource_masks: dict[str, int] = {}
+        self._verb_masks: dict[str, int] = {}
+        self._key_ids = key_ids
+
+        for i, perm in enumerate(self.perms):
+            key = (perm.resource, perm.verb)
+            if key not in key_ids:
+                key_ids[key] = len(self.keys)
+                self.keys.append(key)
+                self._key_perm_masks.append(0)
+            self._key_of.append(key_ids[key])
+
+            bit = 1 << i
+            self._key_perm_masks[key_ids[key]] |= bit
+            for masks, value in ((self._group_masks, perm.api_group),
+                                 (self._resource_masks, perm.resource),
+                                 (self._verb_masks, perm.verb)):
+                masks[value] = masks.get(value, 0) | bit
+
+    def __len__(self):
+        return len(self.perms)
+
+    def _field_mask(self, masks: dict[str, int], value) -> int:
+        if value == ANY:
+            return self.all_mask
+        return masks.get(value, 0)
+
+    def mask_of(self, table: RuleTable) -> int:
+        """规则表允许的权限位集，不限制资源名称，语义同 RuleTable.can_i(..., resource_name=None)"""
+        mask = 0
+        for group, resource, verb in table.keys():
+            mask |= (self._field_mask(self._group_masks, group)
+                     & self._field_mask(self._resource_masks, resource)
+                     & self._field_mask(self._verb_masks, verb))
+            if mask == self.all_mask:
+                break
+        return mask
+
+    def perms_of_key(self, resource: str, verb: str) -> int:
+        """(resource, verb) 相同的所有权限的位集"""
+        key_id = self._key_ids.get((resource, verb), None)
+        return self._key_perm_masks[key_id] if key_id is not None else 0
+
+    def key_mask_of(self, mask: int) -> int:
+        """将权限位集投影到去重键的位集"""
+        key_mask = 0
+        for i in iter_bits(mask):
+            key_mask |= 1 << self._key_of[i]
+        return key_mask
+
+
+# CSV 路径 -> 权限全集
+_default_universes: dict[Path, PermissionUniverse] = {}
+
+
+def get_default_universe(k8s_version: Optional[str] = None) -> PermissionUniverse:
+    """由 get_all_perms 构成的权限全集"""
+    csv_path = all_perms_csv(k8s_version)
+    universe = _default_universes.get(csv_path, None)
+    if universe is None:
+        universe = PermissionUniverse(get_all_perms(k8s_version))
+        _default_universes[csv_path] = universe
+    return universe
+
+
+def _universe_key(csv_path: Path, crds: list) -> str:
+    """权限全集来源的摘要：资源发现快照的 (路径, 大小, mtime) 与所有 CRD 的内容摘要"""
+    stat = csv_path.stat()
+    canonical = json.dumps([str(csv_path), stat.st_size, stat.st_mtime_ns, sorted({crd.digest for crd in crds})])
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+class UniverseCache:
+    """
+    预编译的权限全集，保存构建好的 PermissionUniverse，来源不变时直接加载，不需要解析 CSV 与 CRD
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Path):
+        self.path = path
+
+    def load(self, key: str) -> Optional[PermissionUniverse]:
+        if not self.path.exists():
+            return None
+        try:
+            with self.path.open('rb') as f:
+                version, cached_key, universe = pickle.load(f)
+        except Exception as e:
+            warn('failed to load permission universe cache, ignored', cache=self.path, error=e)
+            return None
+        if version != self.VERSION or cached_key != key:
+            return None
+        return universe
+
+    def save(self, key: str, universe: PermissionUniverse):
+        # 先写临时文件再替换，避免中断时留下损坏的缓存
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump((self.VERSION, key, universe), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+
+
+def get_store_universe(store, k8s_version: Optional[str] = None,
+                       cache: Optional[UniverseCache] = None) -> PermissionUniverse:
+    """
+    store 的权限全集：K8s 版本对应的内置资源权限，加上 store 中 CRD 定义的自定义资源权限
+    :param k8s_version: 见 all_perms_csv
+    :param cache: 预编译全集的缓存，为 None 则不缓存
+    """
+    crds = store.search_by_kind('CustomResourceDefinition')
+    if not crds and cache is None:
+        return get_default_universe(k8s_version)
+
+    csv_path = all_perms_csv(k8s_version)
+    key = _universe_key(csv_path, crds)
+    universe = cache.load(key) if cache is not None else None
+    if universe is not None:
+        return universe
+
+    perms = set(get_all_perms(k8s_version))
+    for crd in crds:
+        perms.update(crd.permissions())
+    universe = PermissionUniverse(perms)
+    debug('permission universe built', perms=len(universe), crds=len(crds), source=csv_path.name)
+    if cache is not None:
+        cache.save(key, universe)
+    return universe
+
+
+class PermissionMatrix:
+    """
+    有效权限矩阵。每个 Role 在每个权限范围下的权限编译为一个位集，ServiceAccount 的权限为其所有 Role 位集的按位或。
+    Role 的位集依赖 store 中的聚合关系，因此一个矩阵只应用于同一个 store
+
+    ```python
+    matrix = PermissionMatrix()
+    perms = matrix.list_perms(sa)
+    ```
+    """
+
+    def __init__(self, universe: Optional[PermissionUniverse] = None, memo: Optional[PermissionMemo] = None):
+        """
+        :param memo: 按 Role 集合指纹缓存 list_perms 的结果，可以在多个矩阵（store）之间共享
+        """
+        self.universe = universe if universe is not None else get_default_universe()
+        self.memo = memo
+        # Role -> 按 SCOPES 顺序的位集
+        self._role_masks: dict[Role, tuple[int, ...]] = {}
+
+    def role_masks(self, role: Role) -> tuple[int, ...]:
+        """Role 在各个权限范围下的权限位集，按 SCOPES 的顺序"""
+        masks = self._role_masks.get(role, None)
+        if masks is None:
+            masks = tuple(self.universe.mask_of(role.rule_table(scope)) for scope in SCOPES)
+            self._role_masks[role] = masks
+        return masks
+
+    def sa_masks(self, sa: ServiceAccount) -> tuple[int, ...]:
+        """ServiceAccount 在各个权限范围下的权限位集，按 SCOPES 的顺序"""
+        result = [0] * len(SCOPES)
+        for role in sa.find_roles():
+            for i, mask in enumerate(self.role_masks(role)):
+                result[i] |= mask
+        return tuple(result)
+
+    def list_perms(self, sa: ServiceAccount) -> list[tuple[PermissionKey, PermissionScope]]:
+        """
+        列出 ServiceAccount 具有的所有权限。多个权限的 (resource, verb) 相同时，只保留范围最大的一个。
+        结果按去重键在全集中的顺序排列
+        """
+        if self.memo is None:
+            return self._list_perms(sa)
+        fingerprint = role_set_fingerprint(sa, self.universe.fingerprint)
+        perms = self.memo.lookup(fingerprint)
+        if perms is None:
+            perms = self._list_perms(sa)
+            self.memo.put(fingerprint, perms)
+        return perms
+
+    def _list_perms(self, sa: ServiceAccount) -> list[tuple[PermissionKey, PermissionScope]]:
+        return self.list_masks(self.sa_masks(sa))
+
+    def list_masks(self, masks: tuple[int, ...]) -> list[tuple[PermissionKey, PermissionScope]]:
+        """将按 SCOPES 顺序的位集转换为权限列表，去重方式同 list_perms"""
+        covered = 0
+        scope_of = {}
+        for scope, mask in zip(SCOPES, masks):
+            key_mask = self.universe.key_mask_of(mask) & ~covered
+            covered |= key_mask
+            for key_id in iter_bits(key_mask):
+                scope_of[key_id] = scope
+        return [(self.universe.keys[key_id], scope_of[key_id]) for key_id in sorted(scope_of)]
@@ -0,0 +1,115 @@
+# memo.py -- 按 Role 集合指纹缓存有效权限
+#
+# Copyright (C) 2024 KAAAsS
+import collections
+import hashlib
+import json
+import os
+import pickle
+from pathlib import Path
+from typing import Optional, Any
+
+from analyse.k8s.rbac.graph import RbacGraph
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 默认的最大条目数，超过时淘汰最久未使用的条目
+DEFAULT_MAX_ENTRIES = 50000
+
+
+def role_set_fingerprint(sa, universe_fingerprint: str) -> str:
+    """
+    ServiceAccount 绑定的 Role 集合的规范化指纹。每个 Role 由其内容摘要与聚合到的 ClusterRole 的摘要表示，
+    与绑定的顺序、重复以及 Role 所在的 store 无关
+    """
+    graph = sa.store.cached('rbac', RbacGraph)
+    roles = set()
+    for role in sa.find_roles():
+        aggregated = sorted({r.digest for r in graph.aggregated_roles(role)})
+        roles.add((role.digest, tuple(aggregated)))
+    canonical = json.dumps([universe_fingerprint, sorted(roles)], separators=(',', ':'))
+    return hashlib.blake2b(canonical.encode(), digest_size=16).hexdigest()
+
+
+class PermissionMemo:
+    """
+    有效权限的缓存，以 role_set_fingerprint 为键。绑定相同 Role 集合的 ServiceAccount 只计算一次。
+    指定 path 时可以持久化，在批量扫描的多个项目之间共享（常见 chart 中的 ClusterRole 完全相同）。
+    条目按最近使用的顺序保存，超过 max_entries 时淘汰最久未使用的条目。只有命中的运行不会重写文件，
+    其中的使用顺序随下一次写入保存
+    """
+
+    VERSION = 1
+
+    def __init__(self, path: Optional[Path] = None, max_entries: int = DEFAULT_MAX_ENTRIES):
+        assert max_entries > 0, f'Invalid max_entries: {max_entries}'
+        self.path = path
+        self.max_entries = max_entries
+        # 按最近使用的顺序排列，最久未使用的在前
+        self._entries: collections.OrderedDict[str, Any] = collections.OrderedDict()
+        self._dirty = False
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+    def _load(self):
+        if self.path is None or not self.path.exists():
+            return
+        try:
+            with self.path.open('rb') as f:
+                version, entries = pickle.load(f)
+        except Exception as e:
+            warn('failed to load permission memo, ignored', memo=self.path, error=e)
+            return
+        if version != self.VERSION:
+            info('permission memo version mismatch, ignored', memo=self.path)
+            return
+        self._entries = collections.OrderedDict(entries)
+        self._evict()
+
+    def lookup(self, fingerprint: str) -> Optional[Any]:
+        value = self._entries.get(fingerprint, None)
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self._entries.move_to_end(fingerprint)
+        return value
+
+    def put(self, fingerprint: str, value):
+        self._entries[fingerprint] = value
+        self._entries.move_to_end(fingerprint)
+        self._dirty = True
+        self._evict()
+
+    def _evict(self):
+        evicted = 0
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            evicted += 1
+        if evicted:
+            self._dirty = True
+            debug('permission memo entries evicted', count=evicted)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'entries': len(self._entries),
+        }
+
+    def save(self):
+        if self.path is None or not self._dirty:
+            return
+        # 先写临时文件再替换，避免中断时留下损坏的缓存
+        tmp_path = self.path.with_name(self.path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            pickle.dump((self.VERSION, dict(self._entries)), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+    def __len__(self):
+        return len(self._entries)
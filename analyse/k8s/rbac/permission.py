@@ -2,10 +2,19 @@
 #
 # Copyright (C) 2024 KAAAsS
 import csv
+import os
+import re
 from pathlib import Path
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
-_CSV_ALL_PERM = Path(__file__).parent / "data" / "all_perm.csv"
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+_DATA_DIR = Path(__file__).parent / "data"
+_CSV_ALL_PERM = _DATA_DIR / "all_perm.csv"
+# 默认使用的 K8s 版本，为空则使用 all_perm.csv
+ENV_K8S_VERSION = 'EP_SCAN_K8S_VERSION'
 
 
 class Permission(NamedTuple):
@@ -19,17 +28,47 @@ class Permission(NamedTuple):
                                 strict_scope=strict_scope)
 
 
-_cache_all_perms = None
+# CSV 路径 -> 权限列表
+_cache_all_perms: dict[Path, set[Permission]] = {}
+# 已经警告过没有快照的版本
+_missing_versions: set[str] = set()
+
+
+def _normalize_k8s_version(k8s_version: str) -> str:
+    """v1.28.3 -> 1.28"""
+    match = re.fullmatch(r'v?(\d+)\.(\d+)(\.\d+)?', k8s_version.strip())
+    assert match is not None, f'Invalid Kubernetes version: {k8s_version}'
+    return f'{match[1]}.{match[2]}'
+
 
+def all_perms_csv(k8s_version: Optional[str] = None, data_dir: Path = _DATA_DIR) -> Path:
+    """
+    K8s 版本对应的资源发现快照 all_perm-{major}.{minor}.csv，没有对应的快照时使用 all_perm.csv。
+    快照为 `kubectl api-resources -o wide` 输出的 CSV（NAME,SHORTNAMES,APIVERSION,NAMESPACED,KIND,VERBS...），
+    其他版本的快照可以直接放入 data 目录
+    :param k8s_version: K8s 版本，为 None 则使用环境变量 EP_SCAN_K8S_VERSION
+    """
+    if k8s_version is None:
+        k8s_version = os.environ.get(ENV_K8S_VERSION, None) or None
+    default = data_dir / _CSV_ALL_PERM.name
+    if k8s_version is None:
+        return default
+    csv_path = data_dir / f'all_perm-{_normalize_k8s_version(k8s_version)}.csv'
+    if not csv_path.exists():
+        if k8s_version not in _missing_versions:
+            _missing_versions.add(k8s_version)
+            warn('No discovery snapshot for Kubernetes version, use default', version=k8s_version)
+        return default
+    return csv_path
 
-def get_all_perms() -> set[Permission]:
-    """获取所有权限列表"""
-    global _cache_all_perms
-    if _cache_all_perms is not None:
-        return _cache_all_perms
 
-    perms = _load_perm_csv(_CSV_ALL_PERM)
-    _cache_all_perms = perms
+def get_all_perms(k8s_version: Optional[str] = None) -> set[Permission]:
+    """获取所有内置资源的权限列表，参数同 all_perms_csv"""
+    csv_path = all_perms_csv(k8s_version)
+    perms = _cache_all_perms.get(csv_path, None)
+    if perms is None:
+        perms = _load_perm_csv(csv_path)
+        _cache_all_perms[csv_path] = perms
     return perms
 
 
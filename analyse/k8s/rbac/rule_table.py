@@ -0,0 +1,84 @@
+# rule_table.py -- 编译后的 RBAC 规则表
+#
+# Copyright (C) 2024 KAAAsS
+from typing import Iterable, Optional
+
+# 通配符桶的键
+ANY = '*'
+
+_MISSING = object()
+
+
+def _keys(values: Optional[list]) -> Iterable:
+    """规则中某一字段对应的键，None 表示任意值"""
+    if values is None:
+        return ANY,
+    return values
+
+
+def _candidates(value) -> tuple:
+    """查询某一字段时需要查找的键：精确值与通配符桶"""
+    if value == ANY:
+        return ANY,
+    return value, ANY
+
+
+class RuleTable:
+    """
+    编译后的规则表，以 (apiGroup, resource, verb) 为键，值为允许的 resourceNames，None 表示不限制资源名称。
+    通配符规则放在键为 ANY 的桶中，一次查询最多查找 8 个键
+    """
+
+    __slots__ = ('_entries',)
+
+    def __init__(self, entries: dict[tuple, Optional[frozenset]]):
+        self._entries = entries
+
+    def can_i(self, api_group: str, verb: str, resource: str, resource_name: str = None) -> bool:
+        """语义同 Role.can_i"""
+        entries = self._entries
+        for group_key in _candidates(api_group):
+            for resource_key in _candidates(resource):
+                for verb_key in _candidates(verb):
+                    names = entries.get((group_key, resource_key, verb_key), _MISSING)
+                    if names is _MISSING:
+                        continue
+                    if resource_name is None or names is None or resource_name in names:
+                        return True
+        return False
+
+    def keys(self) -> Iterable[tuple]:
+        """表中的所有 (apiGroup, resource, verb)，可能包含 ANY"""
+        return self._entries.keys()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def compile(norm_rules: Iterable[dict]) -> 'RuleTable':
+        """编译一系列已规范化的规则，见 rbac._normalize_rule"""
+        entries: dict[tuple, Optional[frozenset]] = {}
+        for rule in norm_rules:
+            names = rule['resourceNames']
+            if names is not None:
+                names = frozenset(name for name in names if _hashable(name))
+            for group in _keys(rule['apiGroups']):
+                for resource in _keys(rule['resources']):
+                    for verb in _keys(rule['verbs']):
+                        key = (group, resource, verb)
+                        if not _hashable(key):
+                            # 不可哈希的值不可能与查询的字符串相等
+                            continue
+                        if key not in entries:
+                            entries[key] = names
+                        elif entries[key] is not None:
+                            entries[key] = None if names is None else entries[key] | names
+        return RuleTable(entries)
+
+
+def _hashable(value) -> bool:
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
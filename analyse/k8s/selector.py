@@ -0,0 +1,108 @@
+# selector.py -- K8s 标签选择器
+#
+# Copyright (C) 2024 KAAAsS
+from typing import NamedTuple, Optional
+
+from analyse.k8s.index import ObjectIndex
+
+IN = 'In'
+NOT_IN = 'NotIn'
+EXISTS = 'Exists'
+DOES_NOT_EXIST = 'DoesNotExist'
+
+_OPERATORS = IN, NOT_IN, EXISTS, DOES_NOT_EXIST
+# 可以通过索引直接得到候选集合的运算符，求值时先处理以尽快缩小候选集合
+_POSITIVE_OPERATORS = IN, EXISTS
+
+
+class Requirement(NamedTuple):
+    """选择器中的一个条件，matchLabels 中的 k: v 等价于 k In (v)"""
+    key: str
+    operator: str
+    values: frozenset
+
+    def matches(self, labels: dict) -> bool:
+        if self.operator == EXISTS:
+            return self.key in labels
+        if self.operator == DOES_NOT_EXIST:
+            return self.key not in labels
+        if self.key not in labels:
+            return self.operator == NOT_IN
+        try:
+            found = labels[self.key] in self.values
+        except TypeError:
+            found = False
+        return found if self.operator == IN else not found
+
+    def lookup(self, index: ObjectIndex) -> set[int]:
+        """满足条件的对象（In、Exists）或不满足条件的对象（NotIn、DoesNotExist）的下标"""
+        if self.operator in (EXISTS, DOES_NOT_EXIST):
+            return set(index.by_label_key.get(self.key, []))
+        positions = set()
+        for value in self.values:
+            positions.update(index.by_label.get((self.key, value), []))
+        return positions
+
+
+class LabelSelector:
+    """
+    编译后的标签选择器，支持 matchLabels 与 matchExpressions 的所有运算符，所有条件之间为与的关系。
+    没有任何条件的选择器匹配所有对象
+    :see: https://kubernetes.io/docs/concepts/overview/working-with-objects/labels/#resources-that-support-set-based-requirements
+    """
+
+    __slots__ = ('requirements',)
+
+    def __init__(self, requirements: list[Requirement]):
+        # 先处理能缩小候选集合的条件
+        self.requirements = sorted(requirements, key=lambda r: r.operator not in _POSITIVE_OPERATORS)
+
+    def matches(self, labels: Optional[dict]) -> bool:
+        """直接判断一组 label 是否满足选择器"""
+        labels = labels if isinstance(labels, dict) else {}
+        return all(requirement.matches(labels) for requirement in self.requirements)
+
+    def select(self, index: ObjectIndex, kind: Optional[str] = None) -> list[int]:
+        """通过索引查找满足选择器的对象，返回按顺序排列的下标"""
+        if kind is not None:
+            candidates = set(index.by_kind.get(kind, []))
+        else:
+            candidates = {pos for positions in index.by_kind.values() for pos in positions}
+
+        for requirement in self.requirements:
+            if not candidates:
+                break
+            if requirement.operator in _POSITIVE_OPERATORS:
+                candidates &= requirement.lookup(index)
+            else:
+                candidates -= requirement.lookup(index)
+        return sorted(candidates)
+
+    def __repr__(self):
+        return f'LabelSelector({self.requirements})'
+
+    @staticmethod
+    def compile(selector: dict) -> 'LabelSelector':
+        """编译 LabelSelector 对象，不支持的运算符抛出 ValueError"""
+        requirements = []
+        for key, value in (selector.get('matchLabels', None) or {}).items():
+            requirements.append(Requirement(key, IN, _values([value])))
+        for expression in selector.get('matchExpressions', None) or []:
+            operator = expression.get('operator', None)
+            if operator not in _OPERATORS:
+                raise ValueError(f'Unsupported label selector operator: {operator}')
+            values = expression.get('values', None) or []
+            requirements.append(Requirement(expression['key'], operator, _values(values)))
+        return LabelSelector(requirements)
+
+
+def _values(values: list) -> frozenset:
+    # 不可哈希的值不可能与 label 相等
+    result = []
+    for value in values:
+        try:
+            hash(value)
+        except TypeError:
+            continue
+        result.append(value)
+    return frozenset(result)
@@ -0,0 +1,164 @@
+# snapshot.py -- ObjectStore 的快照，用于在进程间传递
+#
+# Copyright (C) 2024 KAAAsS
+import mmap
+import pickle
+import struct
+from multiprocessing import shared_memory
+from pathlib import Path
+from typing import Optional
+
+from analyse.k8s.basic import Object, ObjectStore, ObjectConflict
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 快照头：魔数、版本号、负载长度
+_MAGIC = b'EPSS'
+_VERSION = 3
+_HEADER = struct.Struct('<4sBQ')
+
+
+def dumps(store: ObjectStore) -> bytes:
+    """
+    将 ObjectStore 序列化为快照。快照中每个对象只保存 (data, 源位置, 摘要)，不包含对象间的引用，
+    冲突的对象以下标保存。同时保存预先构建好的索引，加载时不需要重建
+    """
+    records = [
+        (obj.data, _path_str(obj.source_path), obj.source_index, obj.projected, obj._digest,
+         [(_path_str(path), index) for path, index in obj.duplicate_sources])
+        for obj in store.objects
+    ]
+    positions = {id(obj): pos for pos, obj in enumerate(store.objects)}
+    conflicts = [
+        (conflict.kind, conflict.namespace, conflict.name, [positions[id(obj)] for obj in conflict.objects])
+        for conflict in store.conflicts
+    ]
+    payload = pickle.dumps((records, conflicts, store._index), protocol=pickle.HIGHEST_PROTOCOL)
+    return _HEADER.pack(_MAGIC, _VERSION, len(payload)) + payload
+
+
+def loads(buf) -> ObjectStore:
+    """从快照中加载 ObjectStore，buf 可以是 bytes、mmap 或 memoryview"""
+    magic, version, length = _HEADER.unpack_from(buf, 0)
+    assert magic == _MAGIC, 'Not an ObjectStore snapshot'
+    assert version == _VERSION, f'Unsupported snapshot version {version}'
+    # 反序列化完成后需要及时释放 view，否则 mmap 与共享内存无法关闭
+    view = memoryview(buf)[_HEADER.size:_HEADER.size + length]
+    try:
+        records, conflicts, index = pickle.loads(view)
+    finally:
+        view.release()
+
+    objects = []
+    for data, source_path, source_index, projected, digest, duplicate_sources in records:
+        obj = Object.from_dict(data)
+        obj.source_path = _to_path(source_path)
+        obj.source_index = source_index
+        obj.projected = projected
+        obj._digest = digest
+        obj.duplicate_sources = [(_to_path(path), index) for path, index in duplicate_sources]
+        objects.append(obj)
+
+    conflicts = [
+        ObjectConflict(kind, namespace, name, [objects[pos] for pos in positions])
+        for kind, namespace, name, positions in conflicts
+    ]
+    store = ObjectStore(objects, index=index, conflicts=conflicts)
+    for obj in objects:
+        obj.bind_store(store)
+    return store
+
+
+def _path_str(path: Optional[Path]) -> Optional[str]:
+    return str(path) if path is not None else None
+
+
+def _to_path(path: Optional[str]) -> Optional[Path]:
+    return Path(path) if path is not None else None
+
+
+def save(store: ObjectStore, path: Path):
+    """保存快照到文件"""
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(dumps(store))
+    tmp_path.replace(path)
+
+
+def load(path: Path) -> ObjectStore:
+    """通过内存映射从文件加载快照"""
+    with path.open('rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        return loads(buf)
+
+
+class SharedSnapshot:
+    """
+    放在共享内存中的快照，用于将 ObjectStore 交给进程池中的 worker
+
+    ```python
+    with SharedSnapshot(store) as shared:
+        executor.map(func, [shared.name] * n, ...)
+
+    # worker 中
+    store = attach(name)
+    ```
+    """
+
+    def __init__(self, store: ObjectStore):
+        buf = dumps(store)
+        self._shm = shared_memory.SharedMemory(create=True, size=len(buf))
+        self._shm.buf[:len(buf)] = buf
+        debug('store snapshot shared', name=self._shm.name, size=len(buf))
+
+    @property
+    def name(self) -> str:
+        return self._shm.name
+
+    def close(self):
+        if self._shm is None:
+            return
+        self._shm.close()
+        self._shm.unlink()
+        self._shm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+# 当前进程已经加载的共享快照
+_attached: dict[str, ObjectStore] = {}
+
+
+def attach(name: str) -> ObjectStore:
+    """在 worker 中加载共享内存中的快照，同一进程中只加载一次"""
+    store = _attached.get(name, None)
+    if store is not None:
+        return store
+
+    shm = _open_shared_memory(name)
+    try:
+        store = loads(shm.buf)
+    finally:
+        shm.close()
+    _attached[name] = store
+    return store
+
+
+def detach(name: Optional[str] = None):
+    """释放已加载的共享快照，name 为 None 则释放全部"""
+    if name is None:
+        _attached.clear()
+    else:
+        _attached.pop(name, None)
+
+
+def _open_shared_memory(name: str) -> shared_memory.SharedMemory:
+    try:
+        # 共享内存由创建者负责释放
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python 3.13 之前不支持 track 参数。进程池中的 worker 与创建者共用同一个 resource tracker，重复注册没有影响
+        return shared_memory.SharedMemory(name=name)
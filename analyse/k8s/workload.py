@@ -4,8 +4,6 @@
 import typing
 from pathlib import PurePosixPath
 
-from tinydb.queries import Query
-
 from analyse.k8s.basic import Object
 from analyse.k8s.rbac import ServiceAccount, get_service_account_by_name
 from utils import docker_image
@@ -23,6 +21,8 @@ WORKLOAD_RESOURCES = 'pods', 'deployments', 'statefulsets', 'daemonsets', 'jobs'
 
 
 class Container:
+    __slots__ = ('type', 'data')
+
     def __init__(self, typ: ContainerType, data: dict):
         self.type = typ
         self.data = data
@@ -136,8 +136,19 @@ class Container:
 
 
 class ContainerCarrier(Object):
+    __slots__ = ('_cached_containers',)
+
+    def __init__(self, data: dict, store=None, source_path=None):
+        super().__init__(data, store, source_path)
+        self._cached_containers: typing.Optional[tuple[Container, ...]] = None
 
-    def containers(self) -> typing.Iterable[Container]:
+    def containers(self) -> typing.Sequence[Container]:
+        """所有容器，结果会被缓存"""
+        if self._cached_containers is None:
+            self._cached_containers = tuple(self._iter_containers())
+        return self._cached_containers
+
+    def _iter_containers(self) -> typing.Iterable[Container]:
         raise NotImplementedError
 
     @property
@@ -145,17 +156,20 @@ class ContainerCarrier(Object):
         raise NotImplementedError
 
     def get_sa(self) -> ServiceAccount:
-        return get_service_account_by_name(self.store, self.sa_name)
+        return get_service_account_by_name(self.store, self.sa_name, self.namespace)
 
 
 class Pod(ContainerCarrier):
+    __slots__ = ()
+    RESIDENT_FIELDS = ContainerCarrier.RESIDENT_FIELDS + ('spec',)
+
     @staticmethod
     def from_dict(data: dict):
         if data['kind'] != 'Pod':
             return None
         return Pod(data)
 
-    def containers(self):
+    def _iter_containers(self):
         for container in self.data['spec']['containers']:
             yield Container(CONTAINER, container)
         for container in self.data['spec'].get('initContainers', None) or []:
@@ -170,6 +184,7 @@ class Pod(ContainerCarrier):
 
 class Workload(ContainerCarrier):
     """所有工作负载对象的公共基类"""
+    __slots__ = ()
 
     @staticmethod
     def from_dict(data: dict):
@@ -179,13 +194,20 @@ class Workload(ContainerCarrier):
             return None
         return Workload(data)
 
+    def projected_data(self) -> dict:
+        result = super().projected_data()
+        # 只保留 Pod 模板
+        spec = self.data.get('spec', None) or {}
+        result['spec'] = {k: spec[k] for k in ('template', 'jobTemplate') if k in spec}
+        return result
+
     def get_pod_template(self):
         if self.kind == 'CronJob':
             return self.data['spec']['jobTemplate']['spec']['template']
         else:
             return self.data['spec']['template']
 
-    def containers(self):
+    def _iter_containers(self):
         templateSpec = self.get_pod_template()['spec']
         for container in templateSpec['containers']:
             yield Container(CONTAINER, container)
@@ -208,18 +230,24 @@ def _get_sa_from_pod_spec(spec: dict) -> str:
     return sa_name
 
 
+def _get_path(data, *keys):
+    """按路径读取嵌套字段，路径上不是 dict 时返回 None"""
+    for key in keys:
+        if not isinstance(data, dict):
+            return None
+        data = data.get(key, None)
+    return data
+
+
 def find_pods_by_service_account(store, service_account_name) -> list[Pod]:
-    """根据 ServiceAccount 查找关联的 Pod"""
-    return store.search(
-        Query().spec.serviceAccountName == service_account_name
-    )
+    """根据 ServiceAccount 查找关联的 Pod，即 spec.serviceAccountName 匹配的任意对象"""
+    return [obj for obj in store if _get_path(obj.data, 'spec', 'serviceAccountName') == service_account_name]
 
 
 def find_workloads_by_service_account(store, service_account_name) -> list[Workload]:
-    """根据 ServiceAccount 查找关联的 Workload"""
-    return store.search(
-        Query().spec.template.spec.serviceAccountName == service_account_name
-    )
+    """根据 ServiceAccount 查找关联的 Workload，即 spec.template.spec.serviceAccountName 匹配的任意对象"""
+    return [obj for obj in store
+            if _get_path(obj.data, 'spec', 'template', 'spec', 'serviceAccountName') == service_account_name]
 
 
 def _test():
@@ -44,5 +44,5 @@ class Issue:
             'rule': self.rule.name,
             'case': self.case,
             'reasons': self.reasons,
-            'objects': [obj.data for obj in self.objects]
+            'objects': [obj.full_data for obj in self.objects]
         }
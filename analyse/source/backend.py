@@ -0,0 +1,223 @@
+# backend.py -- 执行 CodeQL 命令的后端
+#
+# Copyright (C) 2024 KAAAsS
+import json
+import os
+import select
+import subprocess
+import threading
+from pathlib import Path
+from typing import Optional
+
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+
+def _binary(binary: Optional[str]) -> str:
+    if binary is not None:
+        return binary
+    from analyse.source import codeql
+    return codeql.CODEQL_BINARY
+
+
+class CodeQLBackend:
+    """执行 CodeQL 命令的后端，命令失败时抛出 AssertionError"""
+
+    def run(self, args: list[str], log_path: Optional[Path] = None):
+        """
+        执行 `codeql {args}`
+        :param log_path: 命令输出保存的位置
+        """
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+class ProcessBackend(CodeQLBackend):
+    """每个命令启动一个 CodeQL 进程"""
+
+    def __init__(self, binary: Optional[str] = None):
+        self.binary = binary
+
+    def run(self, args: list[str], log_path: Optional[Path] = None):
+        cmd = [_binary(self.binary), *args]
+        debug("exec cmd", cmd=cmd)
+        if log_path is None:
+            ret = subprocess.run(cmd, stdin=subprocess.DEVNULL).returncode
+        else:
+            with log_path.open('wb') as log:
+                ret = subprocess.run(cmd, stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT).returncode
+        assert ret == 0, f"CodeQL command {args[:2]} failed with code {ret}"
+
+
+class CliServerSession:
+    """
+    一个常驻的 `codeql execute cli-server` 进程。命令以 JSON 数组加 NUL 的形式写入 stdin，
+    命令的输出写到 stdout 并以 NUL 结束。命令失败时进程退出。
+
+    进程的 stderr（CodeQL 的进度与错误信息）在命令执行期间与 stdout 一起写入该命令的 log_path，与 ProcessBackend 一致；
+    同时写入进程的日志，其中每个命令以一行 `==> codeql ...` 开始
+    """
+
+    def __init__(self, binary: Optional[str] = None, log_path: Optional[Path] = None):
+        self._log = log_path.open('ab') if log_path is not None else None
+        self.process = subprocess.Popen([_binary(binary), 'execute', 'cli-server'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        self._stdout = self.process.stdout.fileno()
+        self._stderr = self.process.stderr.fileno()
+
+    @property
+    def alive(self) -> bool:
+        return self.process.poll() is None
+
+    def run(self, args: list[str], log_path: Optional[Path] = None):
+        debug("exec cmd in cli-server", cmd=args, pid=self.process.pid)
+        # 空闲时的输出只写入进程的日志
+        self._drain_stderr(None)
+        self._write_stderr(f'==> codeql {" ".join(args)}{f" > {log_path}" if log_path is not None else ""}\n'
+                           .encode(), None)
+        if log_path is None:
+            self._execute(args, None)
+            return
+        with log_path.open('wb') as log:
+            self._execute(args, log)
+
+    def _execute(self, args: list[str], log):
+        try:
+            self.process.stdin.write(json.dumps(args).encode() + b'\0')
+            self.process.stdin.flush()
+        except BrokenPipeError:
+            pass
+
+        output = bytearray()
+        while True:
+            readable, _, _ = select.select([self._stdout, self._stderr], [], [])
+            if self._stderr in readable:
+                self._drain_stderr(log)
+            if self._stdout not in readable:
+                continue
+            chunk = os.read(self._stdout, 65536)
+            if not chunk:
+                code = self.process.wait()
+                self._drain_stderr(log, until_eof=True)
+                assert False, f"CodeQL cli-server exited with code {code} when running {args[:2]}"
+            end = chunk.find(b'\0')
+            if end >= 0:
+                output += chunk[:end]
+                break
+            output += chunk
+
+        # 在返回结果之前写出的 stderr 已经在管道中
+        self._drain_stderr(log)
+        if log is not None:
+            log.write(output)
+
+    def _drain_stderr(self, log, until_eof: bool = False):
+        """读取 stderr 中已有的输出，until_eof 时读到进程关闭 stderr 为止"""
+        while select.select([self._stderr], [], [], None if until_eof else 0)[0]:
+            chunk = os.read(self._stderr, 65536)
+            if not chunk:
+                return
+            self._write_stderr(chunk, log)
+
+    def _write_stderr(self, data: bytes, log):
+        if self._log is not None:
+            self._log.write(data)
+            self._log.flush()
+        if log is not None:
+            log.write(data)
+
+    def close(self):
+        if self.alive:
+            try:
+                self.process.stdin.write(json.dumps(['shutdown']).encode() + b'\0')
+                self.process.stdin.close()
+                self.process.wait(timeout=10)
+            except (OSError, subprocess.TimeoutExpired):
+                self.process.kill()
+                self.process.wait()
+        self._drain_stderr(None)
+        self.process.stdout.close()
+        self.process.stderr.close()
+        if self._log is not None:
+            self._log.close()
+
+
+class CliServerBackend(CodeQLBackend):
+    """
+    常驻 cli-server 进程池，避免每个命令都冷启动 JVM。进程在查询、DB 与项目之间复用，
+    最多同时存在 max_sessions 个进程（与调度器的并发任务数一致即可）。进程退出（命令失败）后被丢弃，
+    下一个命令启动新的进程
+    """
+
+    def __init__(self, max_sessions: int = 1, binary: Optional[str] = None, log_dir: Optional[Path] = None):
+        """
+        :param log_dir: cli-server 进程日志的保存目录，为 None 则 stderr 只写入各命令的日志
+        """
+        assert max_sessions > 0, f'Invalid max_sessions: {max_sessions}'
+        self.max_sessions = max_sessions
+        self.binary = binary
+        self.log_dir = log_dir
+        self._idle: list[CliServerSession] = []
+        self._count = 0
+        self._started = 0
+        self.restarts = 0
+        self._cond = threading.Condition()
+
+    def _acquire(self) -> CliServerSession:
+        with self._cond:
+            self._cond.wait_for(lambda: self._idle or self._count < self.max_sessions)
+            while self._idle:
+                session = self._idle.pop()
+                if session.alive:
+                    return session
+                # 空闲时意外退出的进程
+                session.close()
+                self._count -= 1
+                self.restarts += 1
+            self._count += 1
+            self._started += 1
+            index = self._started
+        log_path = self.log_dir / f'cli_server_{index}.log' if self.log_dir is not None else None
+        try:
+            return CliServerSession(self.binary, log_path)
+        except BaseException:
+            with self._cond:
+                self._count -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, session: CliServerSession):
+        with self._cond:
+            if session.alive:
+                self._idle.append(session)
+            else:
+                session.close()
+                self._count -= 1
+                self.restarts += 1
+                warn('CodeQL cli-server exited, will restart', restarts=self.restarts)
+            self._cond.notify()
+
+    def run(self, args: list[str], log_path: Optional[Path] = None):
+        session = self._acquire()
+        try:
+            session.run(args, log_path)
+        finally:
+            self._release(session)
+
+    def close(self):
+        with self._cond:
+            sessions, self._idle = self._idle, []
+            self._count -= len(sessions)
+        for session in sessions:
+            session.close()
+        debug('CodeQL cli-servers closed', started=self._started, restarts=self.restarts)
+
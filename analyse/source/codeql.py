@@ -3,12 +3,15 @@
 # Copyright (C) 2024 Tanxin
 # Copyright (C) 2024 KAAAsS
 
-import os
-import subprocess
+import shutil
+import threading
 import time
 from pathlib import Path
-from typing import NamedTuple
+from typing import NamedTuple, Optional
 
+from analyse.source.backend import CodeQLBackend, ProcessBackend
+from analyse.source.result_cache import ResultCache
+from analyse.source.scheduler import Resources
 from utils.log import log_funcs
 
 debug, info, warn, error, fatal = log_funcs(from_file=__file__)
@@ -20,6 +23,17 @@ CODEQL_THREAD_NUM = 0  # Core 数
 CODEQL_RAM = 102400
 CODEQL_BINARY = "codeql"
 
+# DB 的真实路径 -> 锁。使用 DB 缓存时多个项目的 DB 链接到同一个目录，run-queries 的输出需要互斥
+_db_locks: dict[Path, threading.Lock] = {}
+_db_locks_lock = threading.Lock()
+
+
+def _resource_flags(resources: Optional[Resources]) -> list[str]:
+    """由调度器分配的资源生成 --threads 与 --ram 参数，未分配时使用全局配置"""
+    if resources is None:
+        return [f"--threads={CODEQL_THREAD_NUM}", f"--ram={CODEQL_RAM}"]
+    return [f"--threads={resources.threads}", f"--ram={resources.ram}"]
+
 
 class Query(NamedTuple):
     name: str
@@ -79,50 +93,52 @@ def run_query(
         result_path: Path,
         disable_cache: bool = False,
         query_name: str = '',
+        resources: Optional[Resources] = None,
+        backend: Optional[CodeQLBackend] = None,
+        result_cache: Optional[ResultCache] = None,
 ):
-    """执行 CodeQL 查询"""
+    """
+    执行 CodeQL 查询
+    :param resources: 调度器分配的资源，见 CodeQLScheduler
+    :param backend: 执行 CodeQL 命令的后端，为 None 则每个命令启动一个进程
+    :param result_cache: 按查询与 DB 内容寻址的结果缓存，为 None 则按文件名复用 cache_dir 中的 BQRS
+    """
+    backend = backend if backend is not None else ProcessBackend()
     log_codeql = log_dir / f"run_{query.identifier}_{query_name}.log"
-    log_decode = log_dir / f"decode_{query.identifier}_{query_name}.log"
-    bqrs = cache_dir / f"result_{query.identifier}_{query_name}.bqrs"
+    bqrs = _bqrs_path(query, cache_dir, query_name)
     start = time.time()
 
     # 检查 DB 是否存在
     go_db = db_path / "db-go"
     assert go_db.exists(), f"CodeQL DB {go_db} not found"
 
-    if not bqrs.exists() or disable_cache:
-        cmd = [
-            CODEQL_BINARY,
+    key = result_cache.key_of(query.identifier, query.path, db_path) if result_cache is not None else None
+    cached = None
+    if key is not None and not disable_cache:
+        if result_cache.is_current(result_path, key):
+            info("Query result is up to date, skip", result_path=result_path)
+            return
+        cached = result_cache.get(key)
+
+    if cached is not None:
+        info("Query result found in result cache", bqrs=cached)
+        bqrs = cached
+    elif key is None and bqrs.exists() and not disable_cache:
+        info("Query result already exists, use cache", bqrs=bqrs)
+    else:
+        backend.run([
             "query",
             "run",
             f"--database={db_path}",
             f"--output={bqrs}",
-            f"--threads={CODEQL_THREAD_NUM}",
-            f"--ram={CODEQL_RAM}",
+            *_resource_flags(resources),
             "--",
             str(query.path),
-            f"> {log_codeql}",
-            "2>&1",
-        ]
-        cmd = " ".join(cmd)
-        debug("exec cmd", cmd=cmd)
-        assert os.system(cmd) == 0
-    else:
-        info("Query result already exists, use cache", bqrs=bqrs)
+        ], log_codeql)
+        if key is not None:
+            bqrs = result_cache.put(key, bqrs)
 
-    cmd = [
-        CODEQL_BINARY,
-        "bqrs",
-        "decode",
-        str(bqrs),
-        "--format=csv",
-        f"--output={result_path}",
-        f"> {log_decode}",
-        "2>&1",
-    ]
-    cmd = " ".join(cmd)
-    debug("exec cmd", cmd=cmd)
-    assert os.system(cmd) == 0
+    _decode_cached(query, bqrs, db_path, log_dir, result_path, query_name, backend, result_cache, key)
 
     end = time.time()
     info("query end",
@@ -132,6 +148,121 @@ def run_query(
          elapsed=end - start
          )
 
+
+def run_queries(
+        queries: list[Query],
+        db_path: Path,
+        log_dir: Path,
+        cache_dir: Path,
+        result_paths: list[Path],
+        disable_cache: bool = False,
+        query_name: str = '',
+        resources: Optional[Resources] = None,
+        backend: Optional[CodeQLBackend] = None,
+        result_cache: Optional[ResultCache] = None,
+):
+    """
+    在一次 `codeql database run-queries` 中执行多个查询，共享的谓词（RefGraph、k8sapi 等）只计算一次。
+    参数同 run_query，result_paths 与 queries 一一对应。
+    结果先写入 DB 的 results 目录，因此同一个 DB（包括链接到同一个缓存 DB 的不同项目）上的调用在进程内互斥
+    """
+    assert len(queries) == len(result_paths), "queries and result_paths must have the same length"
+    backend = backend if backend is not None else ProcessBackend()
+    log_codeql = log_dir / f"run_queries_{query_name}.log"
+    start = time.time()
+
+    go_db = db_path / "db-go"
+    assert go_db.exists(), f"CodeQL DB {go_db} not found"
+
+    results = {query.identifier: path for query, path in zip(queries, result_paths)}
+    bqrs = {query.identifier: _bqrs_path(query, cache_dir, query_name) for query in queries}
+    keys = {}
+    if result_cache is not None:
+        keys = {query.identifier: result_cache.key_of(query.identifier, query.path, db_path) for query in queries}
+        if not disable_cache:
+            current = [query for query in queries
+                       if result_cache.is_current(results[query.identifier], keys[query.identifier])]
+            if current:
+                info("Query results are up to date, skip", queries=current)
+            queries = [query for query in queries if query not in current]
+    if not queries:
+        return
+
+    # 在锁内查找结果缓存，等待的任务可以直接使用前一个任务在同一个 DB 上的结果
+    with _db_lock(db_path):
+        hits = set()
+        if result_cache is not None and not disable_cache:
+            for query in queries:
+                cached = result_cache.get(keys[query.identifier])
+                if cached is not None:
+                    bqrs[query.identifier] = cached
+                    hits.add(query.identifier)
+
+        if result_cache is not None:
+            # 使用结果缓存时不信任 cache_dir 中的旧 BQRS
+            pending = [query for query in queries if query.identifier not in hits]
+        else:
+            pending = [query for query in queries if disable_cache or not bqrs[query.identifier].exists()]
+        if pending:
+            # 中断的任务可能在 DB 中留下旧的结果，run-queries 会直接使用它们
+            for query in pending:
+                _db_bqrs_path(query, db_path).unlink(missing_ok=True)
+            backend.run([
+                "database",
+                "run-queries",
+                *_resource_flags(resources),
+                *(["--rerun"] if disable_cache else []),
+                "--",
+                str(db_path),
+                *[str(query.path) for query in pending],
+            ], log_codeql)
+            # 结果保存在 DB 的 results 目录中，移动到缓存目录以便复用
+            for query in pending:
+                db_bqrs = _db_bqrs_path(query, db_path)
+                assert db_bqrs.exists(), f"BQRS of {query} not found in {db_path}"
+                if result_cache is not None:
+                    bqrs[query.identifier] = result_cache.put(keys[query.identifier], db_bqrs)
+                else:
+                    shutil.move(db_bqrs, bqrs[query.identifier])
+        else:
+            info("Query results already exist, use cache", queries=queries)
+
+    for query in queries:
+        _decode_cached(query, bqrs[query.identifier], db_path, log_dir, results[query.identifier], query_name,
+                       backend, result_cache, keys.get(query.identifier, None))
+
+    end = time.time()
+    info("queries end",
+         queries=queries,
+         evaluated=len(pending),
+         db_path=db_path,
+         elapsed=end - start
+         )
+
+
+def _decode_cached(query: Query, bqrs: Path, db_path: Path, log_dir: Path, result_path: Path, query_name: str,
+                   backend: CodeQLBackend, result_cache: Optional[ResultCache], key):
+    """解码结果，使用结果缓存时记录结果对应的键"""
+    if result_cache is not None:
+        result_cache.unmark(result_path)
+    decode_result(query, bqrs, db_path, log_dir, result_path, query_name, backend=backend)
+    if result_cache is not None:
+        result_cache.mark(result_path, key)
+
+
+def decode_result(query: Query, bqrs: Path, db_path: Path, log_dir: Path, result_path: Path, query_name: str = '',
+                  backend: Optional[CodeQLBackend] = None):
+    """将 BQRS 解码为 CSV，并去除结果中的源码路径前缀"""
+    backend = backend if backend is not None else ProcessBackend()
+    log_decode = log_dir / f"decode_{query.identifier}_{query_name}.log"
+    backend.run([
+        "bqrs",
+        "decode",
+        str(bqrs),
+        "--format=csv",
+        f"--output={result_path}",
+    ], log_decode)
+
     # 去除结果中的源码路径前缀
     source_prefix = get_db_source_prefix(db_path)
     with open(result_path) as f:
@@ -142,6 +273,30 @@ def run_query(
     debug("remove source prefix in db", source_prefix=source_prefix)
 
 
+def _bqrs_path(query: Query, cache_dir: Path, query_name: str) -> Path:
+    return cache_dir / f"result_{query.identifier}_{query_name}.bqrs"
+
+
+def _db_bqrs_path(query: Query, db_path: Path) -> Path:
+    """`database run-queries` 输出的 BQRS 路径：results/{pack 名称}/{查询相对 pack 的路径}.bqrs"""
+    relative = query.path.relative_to(QUERIES_DIR).with_suffix('.bqrs')
+    return db_path / "results" / get_pack_name() / relative
+
+
+def _db_lock(db_path: Path) -> threading.Lock:
+    with _db_locks_lock:
+        return _db_locks.setdefault(db_path.resolve(), threading.Lock())
+
+
+def get_pack_name() -> str:
+    """查询所在 CodeQL pack 的名称"""
+    with open(QUERIES_DIR / "codeql-pack.yml") as f:
+        for line in f:
+            if line.startswith("name:"):
+                return line.split(":", 1)[1].strip()
+    raise ValueError(f"pack name not found in {QUERIES_DIR}")
+
+
 def get_db_source_prefix(db_path: Path) -> Path:
     """获取 CodeQL DB 的源码前缀"""
     assert db_path.is_dir(), f"{db_path} is not a directory"
@@ -152,25 +307,25 @@ def get_db_source_prefix(db_path: Path) -> Path:
     raise ValueError(f"sourceLocationPrefix not found in {db_path}")
 
 
-def build_db(source_path: Path, dest_path: Path, log_path: Path):
-    """构建 CodeQL 数据库"""
+def build_db(source_path: Path, dest_path: Path, log_path: Path, resources: Optional[Resources] = None,
+             backend: Optional[CodeQLBackend] = None):
+    """
+    构建 CodeQL 数据库
+    :param resources: 调度器分配的资源，见 CodeQLScheduler
+    :param backend: 执行 CodeQL 命令的后端，为 None 则启动一个进程
+    """
     assert source_path.is_dir(), f"{source_path} is not a directory"
     assert not dest_path.exists(), f"{dest_path} already exists"
+    backend = backend if backend is not None else ProcessBackend()
     start = time.time()
-    cmd = [
-        CODEQL_BINARY,
+    backend.run([
         "database",
         "create",
         str(dest_path),
         "--language=go",
         f"--source-root={source_path}",
-        f"--threads={CODEQL_THREAD_NUM}",
-        f"> {log_path}",
-        "2>&1",
-    ]
-    cmd = " ".join(cmd)
-    debug("exec cmd", cmd=cmd)
-    assert os.system(cmd) == 0
+        *_resource_flags(resources),
+    ], log_path)
     end = time.time()
     info("build CodeQL DB finished", source_path=source_path, dest_path=dest_path, elapsed=end - start)
 
@@ -178,18 +333,13 @@ def build_db(source_path: Path, dest_path: Path, log_path: Path):
 _MARK_FILE = '.codeql_prepared'
 
 
-def prepare_queries():
+def prepare_queries(backend: Optional[CodeQLBackend] = None):
     """准备 CodeQL 查询"""
 
     mark_file = QUERIES_DIR / _MARK_FILE
     if mark_file.exists():
         info("CodeQL env already prepared")
         return
-    cmd = [
-        CODEQL_BINARY,
-        "pack",
-        "install",
-    ]
-    ret = subprocess.check_call(cmd, cwd=QUERIES_DIR)
-    assert ret == 0
+    backend = backend if backend is not None else ProcessBackend()
+    backend.run(["pack", "install", str(QUERIES_DIR)])
     mark_file.touch()
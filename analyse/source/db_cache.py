@@ -0,0 +1,171 @@
+# db_cache.py -- 按内容寻址、在项目之间共享的 CodeQL DB 缓存
+#
+# Copyright (C) 2024 KAAAsS
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from analyse.source import codeql
+from analyse.source.backend import CodeQLBackend, ProcessBackend
+from analyse.source.scheduler import Resources
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 缓存的 DB 中记录键的文件
+KEY_FILE = 'ep-scan-db-key.json'
+# 影响提取结果的环境变量前缀
+_EXTRACTOR_ENV_PREFIX = 'CODEQL_EXTRACTOR_'
+
+
+class DbKey(NamedTuple):
+    """CodeQL DB 的缓存键，任何一项变化都需要重新构建"""
+    # 仓库标识，git 仓库为 origin 的地址，否则为目录名
+    repo: str
+    # 源码内容的摘要，干净的 git 仓库为 HEAD 的 tree 哈希
+    tree: str
+    codeql_version: str
+    # 提取器选项
+    options: tuple[str, ...]
+
+    @property
+    def digest(self) -> str:
+        return hashlib.blake2b(json.dumps(self).encode(), digest_size=16).hexdigest()
+
+
+def _git(source_path: Path, *args) -> Optional[str]:
+    try:
+        proc = subprocess.run(['git', '-C', str(source_path), *args], capture_output=True, text=True)
+    except OSError:
+        return None
+    return proc.stdout.strip() if proc.returncode == 0 else None
+
+
+def _content_digest(source_path: Path) -> str:
+    """源码目录中所有文件（不包括 .git）的内容摘要"""
+    h = hashlib.blake2b(digest_size=20)
+    for root, dirs, files in os.walk(source_path):
+        dirs[:] = sorted(d for d in dirs if d != '.git')
+        for name in sorted(files):
+            path = Path(root) / name
+            if path.is_symlink() or not path.is_file():
+                continue
+            h.update(str(path.relative_to(source_path)).encode() + b'\0')
+            with path.open('rb') as f:
+                h.update(hashlib.blake2b(f.read(), digest_size=20).digest())
+    return h.hexdigest()
+
+
+def source_identity(source_path: Path) -> tuple[str, str]:
+    """源码的 (仓库标识, 内容摘要)。有未提交修改的 git 仓库按内容计算摘要"""
+    toplevel = _git(source_path, 'rev-parse', '--show-toplevel')
+    if toplevel is None or Path(toplevel).resolve() != source_path.resolve():
+        # 不是 git 仓库，或者只是某个仓库中的子目录
+        return source_path.name, f'content:{_content_digest(source_path)}'
+    repo = _git(source_path, 'config', '--get', 'remote.origin.url') or source_path.name
+    tree = _git(source_path, 'rev-parse', 'HEAD^{tree}')
+    if tree is not None and _git(source_path, 'status', '--porcelain') == '':
+        return repo, f'git:{tree}'
+    return repo, f'content:{_content_digest(source_path)}'
+
+
+def extractor_options() -> tuple[str, ...]:
+    env = sorted(f'{k}={v}' for k, v in os.environ.items() if k.startswith(_EXTRACTOR_ENV_PREFIX))
+    return ('--language=go', *env)
+
+
+class DbCache:
+    """
+    以 DbKey 为键的 CodeQL DB 缓存，项目中的 DB 目录是指向缓存的符号链接。
+    相同仓库的相同版本在所有项目中只构建一次，源码或 CodeQL 版本变化后自动重新构建
+
+    缓存目录的格式：
+    - {digest[:2]}/{digest}/   CodeQL DB，其中的 ep-scan-db-key.json 记录了键
+    - tmp/                     构建中的 DB
+    """
+
+    def __init__(self, root: Path, backend: Optional[CodeQLBackend] = None):
+        self.root = root
+        self.backend = backend if backend is not None else ProcessBackend()
+        self._codeql_version: Optional[str] = None
+        self._locks: dict[str, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def codeql_version(self) -> str:
+        if self._codeql_version is None:
+            with tempfile.TemporaryDirectory() as tmp:
+                output = Path(tmp) / 'version'
+                self.backend.run(['version', '--format=terse'], output)
+                self._codeql_version = output.read_text().strip()
+        return self._codeql_version
+
+    def key_of(self, source_path: Path) -> DbKey:
+        repo, tree = source_identity(source_path)
+        return DbKey(repo, tree, self.codeql_version, extractor_options())
+
+    def path_of(self, key: DbKey) -> Path:
+        digest = key.digest
+        return self.root / digest[:2] / digest
+
+    def _key_lock(self, digest: str) -> threading.Lock:
+        with self._lock:
+            return self._locks.setdefault(digest, threading.Lock())
+
+    def ensure(self, source_path: Path, link_path: Path, log_path: Path,
+               resources: Optional[Resources] = None) -> bool:
+        """
+        确保 link_path 指向与源码匹配的 DB，缓存中没有时构建。
+        link_path 是直接构建在项目中的 DB（不是符号链接）时不做修改，继续使用该 DB
+        :return: link_path 指向的 DB 是否发生了变化，变化时 DB 上的查询结果不再有效
+        """
+        if link_path.exists() and not link_path.is_symlink():
+            warn("DB built in project is not managed by cache, remove it to use cached DB", db=link_path)
+            return False
+        key = self.key_of(source_path)
+        db_path = self.path_of(key)
+        with self._key_lock(key.digest):
+            if not (db_path / KEY_FILE).exists():
+                self._build(key, source_path, db_path, log_path, resources)
+            else:
+                debug("db found in cache", db=db_path)
+        return self._link(link_path, db_path)
+
+    def _build(self, key: DbKey, source_path: Path, db_path: Path, log_path: Path, resources: Optional[Resources]):
+        info("build CodeQL DB into cache", repo=key.repo, tree=key.tree, db=db_path)
+        tmp_root = self.root / 'tmp'
+        tmp_root.mkdir(parents=True, exist_ok=True)
+        tmp_dir = Path(tempfile.mkdtemp(prefix=f'{key.digest}-', dir=tmp_root))
+        try:
+            tmp_db = tmp_dir / 'db'
+            codeql.build_db(source_path, tmp_db, log_path, resources=resources, backend=self.backend)
+            with (tmp_db / KEY_FILE).open('w') as f:
+                json.dump(key._asdict(), f, indent=2)
+            db_path.parent.mkdir(parents=True, exist_ok=True)
+            if db_path.exists():
+                # 其他进程构建的残缺 DB（没有键文件）
+                shutil.rmtree(db_path)
+            try:
+                os.replace(tmp_db, db_path)
+            except OSError:
+                # 其他进程已经构建完成
+                if not (db_path / KEY_FILE).exists():
+                    raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _link(link_path: Path, db_path: Path) -> bool:
+        target = db_path.resolve()
+        if link_path.is_symlink():
+            if link_path.resolve() == target:
+                return False
+            link_path.unlink()
+        link_path.symlink_to(target, target_is_directory=True)
+        return True
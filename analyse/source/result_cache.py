@@ -0,0 +1,203 @@
+# result_cache.py -- 按查询与 DB 内容寻址的 CodeQL 查询结果缓存
+#
+# Copyright (C) 2024 KAAAsS
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 默认的缓存大小上限（MB）
+DEFAULT_MAX_SIZE = 4096
+# 查询结果 CSV 旁记录结果键的文件后缀
+STAMP_SUFFIX = '.key'
+
+_IMPORT_RE = re.compile(r'^\s*(?:private\s+)?import\s+([\w.:]+)', re.MULTILINE)
+
+
+class ResultKey(NamedTuple):
+    """查询结果的缓存键，任何一项变化都需要重新执行查询"""
+    # 查询的标识，包括 Query.version
+    query: str
+    # 查询文件及其在 pack 内传递 import 的 .qll 的摘要
+    query_hash: str
+    # DB 的指纹，见 db_fingerprint
+    db: str
+
+    @property
+    def digest(self) -> str:
+        return hashlib.blake2b(json.dumps(self).encode(), digest_size=16).hexdigest()
+
+
+def _pack_root(query_path: Path) -> Path:
+    """查询所在 CodeQL pack 的根目录，即包含 codeql-pack.yml 的目录"""
+    for parent in query_path.parents:
+        if (parent / 'codeql-pack.yml').exists():
+            return parent
+    return query_path.parent
+
+
+def _resolve_import(module: str, importer: Path, root: Path) -> Optional[Path]:
+    """
+    import 对应的 pack 内文件，先相对 import 所在的目录，再相对 pack 根目录查找。
+    pack 外的库（如 go）返回 None，其版本由 codeql-pack.lock.yml 决定
+    """
+    # A.B::C 中的 C 是 A/B.qll 中的模块
+    parts = module.split('::')[0].split('.')
+    for base in (importer.parent, root):
+        # import A.B 也可能引用 A.qll 中的模块 B
+        for n in range(len(parts), 0, -1):
+            path = base.joinpath(*parts[:n]).with_suffix('.qll')
+            if path.is_file():
+                return path
+    return None
+
+
+def query_hash(query_path: Path) -> str:
+    """查询文件、其在 pack 内传递 import 的所有 .qll 以及 pack 依赖锁文件的摘要"""
+    root = _pack_root(query_path)
+    h = hashlib.blake2b(digest_size=20)
+    seen = set()
+    stack = [query_path]
+    while stack:
+        path = stack.pop()
+        if path in seen:
+            continue
+        seen.add(path)
+        text = path.read_bytes()
+        h.update(str(path.relative_to(root)).encode() + b'\0')
+        h.update(hashlib.blake2b(text, digest_size=20).digest())
+        for module in _IMPORT_RE.findall(text.decode(errors='replace')):
+            imported = _resolve_import(module, path, root)
+            if imported is not None:
+                stack.append(imported)
+    lock = root / 'codeql-pack.lock.yml'
+    if lock.exists():
+        h.update(hashlib.blake2b(lock.read_bytes(), digest_size=20).digest())
+    return h.hexdigest()
+
+
+def db_fingerprint(db_path: Path) -> str:
+    """
+    DB 的指纹。由 DbCache 构建的 DB 为其键文件的摘要（包括源码版本与 CodeQL 版本），
+    其他 DB 为其路径与 codeql-database.yml 的修改时间，重新构建后变化
+    """
+    from analyse.source.db_cache import KEY_FILE
+
+    key_file = db_path / KEY_FILE
+    if key_file.exists():
+        return 'key:' + hashlib.blake2b(key_file.read_bytes(), digest_size=16).hexdigest()
+    meta = db_path / 'codeql-database.yml'
+    mtime = meta.stat().st_mtime_ns if meta.exists() else 0
+    return f'path:{db_path.resolve()}@{mtime}'
+
+
+def _stamp_path(result_path: Path) -> Path:
+    return result_path.with_name(result_path.name + STAMP_SUFFIX)
+
+
+class ResultCache:
+    """
+    以 ResultKey 为键的查询结果（BQRS）缓存，在项目之间共享，超过大小上限时按最近使用时间淘汰。
+    解码后的 CSV 旁记录其结果键，键不变时不需要再调用 CodeQL
+
+    缓存目录的格式：
+    - {digest[:2]}/{digest}.bqrs  查询结果，修改时间为最近使用时间
+    - tmp/                        写入中的结果
+    """
+
+    def __init__(self, root: Path, max_size: int = DEFAULT_MAX_SIZE):
+        """
+        :param max_size: 缓存大小上限（MB）
+        """
+        self.root = root
+        self.max_size = max_size * 1024 * 1024
+        self._lock = threading.Lock()
+
+    def key_of(self, identifier: str, query_path: Path, db_path: Path) -> ResultKey:
+        return ResultKey(identifier, query_hash(query_path), db_fingerprint(db_path))
+
+    def path_of(self, key: ResultKey) -> Path:
+        digest = key.digest
+        return self.root / digest[:2] / f'{digest}.bqrs'
+
+    def get(self, key: ResultKey) -> Optional[Path]:
+        """缓存的结果，不存在时返回 None"""
+        path = self.path_of(key)
+        with self._lock:
+            try:
+                # 更新最近使用时间
+                os.utime(path)
+            except FileNotFoundError:
+                return None
+        debug("query result found in cache", query=key.query, bqrs=path)
+        return path
+
+    def put(self, key: ResultKey, bqrs: Path) -> Path:
+        """将 bqrs 移动到缓存中，返回缓存中的路径"""
+        path = self.path_of(key)
+        tmp_root = self.root / 'tmp'
+        tmp_root.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=f'{key.digest}-', suffix='.bqrs', dir=tmp_root)
+        os.close(fd)
+        try:
+            shutil.move(bqrs, tmp_path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep: Optional[Path] = None):
+        """按最近使用时间淘汰结果，直到缓存大小不超过上限"""
+        with self._lock:
+            entries = []
+            for path in self.root.glob('??/*.bqrs'):
+                try:
+                    stat = path.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, path))
+            total = sum(size for _, size, _ in entries)
+            evicted = 0
+            for _, size, path in sorted(entries, key=lambda e: e[0]):
+                if total <= self.max_size:
+                    break
+                if path == keep:
+                    continue
+                path.unlink(missing_ok=True)
+                total -= size
+                evicted += 1
+        if evicted:
+            info("query results evicted from cache", count=evicted, size=total)
+
+    @staticmethod
+    def is_current(result_path: Path, key: ResultKey) -> bool:
+        """解码后的结果是否由 key 对应的查询结果生成"""
+        stamp = _stamp_path(result_path)
+        if not result_path.exists() or not stamp.exists():
+            return False
+        return stamp.read_text().strip() == key.digest
+
+    @staticmethod
+    def unmark(result_path: Path):
+        """在重新解码前删除记录，避免中断时留下与键不符的结果"""
+        _stamp_path(result_path).unlink(missing_ok=True)
+
+    @staticmethod
+    def mark(result_path: Path, key: ResultKey):
+        """记录解码后的结果对应的 key"""
+        stamp = _stamp_path(result_path)
+        tmp_path = stamp.with_name(stamp.name + '.tmp')
+        tmp_path.write_text(key.digest + '\n')
+        os.replace(tmp_path, stamp)
@@ -0,0 +1,178 @@
+# scheduler.py -- CodeQL 任务的资源调度
+#
+# Copyright (C) 2024 KAAAsS
+import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple, Optional, Callable, Iterable
+
+from utils.log import log_funcs, log_ctx, get_current_ctx
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+# 调度预算的环境变量，未设置时使用所有核心与 CODEQL_RAM
+ENV_CODEQL_THREADS = 'EP_SCAN_CODEQL_THREADS'
+ENV_CODEQL_RAM = 'EP_SCAN_CODEQL_RAM'
+ENV_CODEQL_JOBS = 'EP_SCAN_CODEQL_JOBS'
+
+# 单个任务至少分配的内存（MB），CodeQL 在更少的内存下很容易失败
+MIN_JOB_RAM = 2048
+
+
+class Resources(NamedTuple):
+    """一次 CodeQL 调用可以使用的资源，对应 --threads 与 --ram（MB）"""
+    threads: int
+    ram: int
+
+    def fits(self, other: 'Resources') -> bool:
+        return other.threads <= self.threads and other.ram <= self.ram
+
+    def __sub__(self, other: 'Resources') -> 'Resources':
+        return Resources(self.threads - other.threads, self.ram - other.ram)
+
+    def __add__(self, other: 'Resources') -> 'Resources':
+        return Resources(self.threads + other.threads, self.ram + other.ram)
+
+
+class ResourceBudget:
+    """
+    CPU 与内存的总预算，平均分给最多 jobs 个并发任务。预算不足时申请资源的任务等待其他任务释放。
+    同一台机器上运行多个扫描时，应为每个扫描配置各自的预算
+    """
+
+    def __init__(self, threads: int, ram: int, jobs: Optional[int] = None):
+        """
+        :param threads: 总线程数
+        :param ram: 总内存（MB）
+        :param jobs: 最大并发任务数，为 None 则按 MIN_JOB_RAM 与线程数推算
+        """
+        assert threads > 0 and ram > 0, f'Invalid CodeQL budget: threads={threads}, ram={ram}'
+        if jobs is None:
+            jobs = max(1, min(threads, ram // MIN_JOB_RAM))
+        jobs = max(1, min(jobs, threads))
+        self.total = Resources(threads, ram)
+        self.jobs = jobs
+        # 每个任务的默认份额
+        self.share = Resources(threads // jobs, ram // jobs)
+        self._free = self.total
+        self._cond = threading.Condition()
+
+    @staticmethod
+    def from_env(threads: Optional[int] = None, ram: Optional[int] = None,
+                 jobs: Optional[int] = None) -> 'ResourceBudget':
+        """由参数或环境变量构造预算，参数优先"""
+        from analyse.source import codeql
+
+        def pick(value, env, default):
+            if value is not None:
+                return value
+            env_value = os.environ.get(env, None)
+            return int(env_value) if env_value else default
+
+        return ResourceBudget(pick(threads, ENV_CODEQL_THREADS, os.cpu_count() or 1),
+                              pick(ram, ENV_CODEQL_RAM, codeql.CODEQL_RAM),
+                              pick(jobs, ENV_CODEQL_JOBS, None))
+
+    def acquire(self, request: Optional[Resources] = None) -> Resources:
+        """申请资源，超出总预算的申请被截断到总预算"""
+        request = request if request is not None else self.share
+        request = Resources(min(request.threads, self.total.threads), min(request.ram, self.total.ram))
+        with self._cond:
+            self._cond.wait_for(lambda: self._free.fits(request))
+            self._free -= request
+        return request
+
+    def release(self, resources: Resources):
+        with self._cond:
+            self._free += resources
+            self._cond.notify_all()
+
+    @property
+    def free(self) -> Resources:
+        with self._cond:
+            return self._free
+
+
+class CodeQLScheduler:
+    """
+    在预算内并发执行 CodeQL 任务（DB 构建、查询），任务可以依赖其他任务的完成。
+    任务函数以关键字参数 resources 接收分配到的资源，据此生成 --threads 与 --ram
+
+    ```python
+    scheduler = CodeQLScheduler(ResourceBudget.from_env())
+    build = scheduler.submit(codeql.build_db, source_path, db_path, log_path)
+    scheduler.submit(query.run, db_path=db_path, ..., after=[build])
+    scheduler.wait()
+    ```
+    """
+
+    def __init__(self, budget: Optional[ResourceBudget] = None):
+        self.budget = budget if budget is not None else ResourceBudget.from_env()
+        self._executor = ThreadPoolExecutor(max_workers=self.budget.jobs, thread_name_prefix='codeql')
+        self._futures: list[Future] = []
+        self._lock = threading.Lock()
+
+    def submit(self, fn: Callable, *args, after: Iterable[Future] = (), request: Optional[Resources] = None,
+               **kwargs) -> Future:
+        """
+        提交任务
+        :param after: 依赖的任务，全部完成后才开始执行。依赖的任务失败时，该任务以相同的异常失败
+        :param request: 申请的资源，为 None 则使用预算的默认份额
+        """
+        future = Future()
+        deps = list(after)
+        # 在工作线程中沿用提交时的日志 ctx
+        ctx = get_current_ctx().copy()
+        remaining = [len(deps)]
+
+        def start():
+            if not future.set_running_or_notify_cancel():
+                return
+            for dep in deps:
+                if dep.exception() is not None:
+                    future.set_exception(dep.exception())
+                    return
+            self._executor.submit(self._run, future, fn, args, kwargs, request, ctx)
+
+        def on_dep_done(_):
+            with self._lock:
+                remaining[0] -= 1
+                ready = remaining[0] == 0
+            if ready:
+                start()
+
+        with self._lock:
+            self._futures.append(future)
+        if not deps:
+            start()
+        for dep in deps:
+            dep.add_done_callback(on_dep_done)
+        return future
+
+    def _run(self, future: Future, fn: Callable, args, kwargs, request: Optional[Resources], ctx: dict):
+        with log_ctx(**ctx):
+            resources = self.budget.acquire(request)
+            debug('CodeQL job started', job=getattr(fn, '__name__', fn), threads=resources.threads,
+                  ram=resources.ram)
+            try:
+                future.set_result(fn(*args, resources=resources, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                self.budget.release(resources)
+
+    def wait(self, futures: Optional[Iterable[Future]] = None) -> list:
+        """等待任务完成并返回结果，为 None 则等待所有已提交的任务。任务失败时抛出其异常"""
+        if futures is None:
+            with self._lock:
+                futures = list(self._futures)
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.shutdown()
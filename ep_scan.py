@@ -1,15 +1,27 @@
+import hashlib
 import json
 from pathlib import Path
 from pprint import pprint
+from typing import Optional
 
 import typer
 
+from analyse.k8s import loader
 from analyse.k8s.basic import ObjectStore
+from analyse.k8s.rbac import PermissionScope
+from analyse.k8s.rbac.matrix import UniverseCache
+from analyse.k8s.rbac.memo import PermissionMemo
+from analyse.source.backend import CliServerBackend, ProcessBackend
+from analyse.source.db_cache import DbCache
+from analyse.source.result_cache import ResultCache, DEFAULT_MAX_SIZE
+from analyse.source.scheduler import CodeQLScheduler, ResourceBudget
 from modules.config_analyse import PodPermAnalyser
 from modules.perm_compare import PermComparer
 from modules.pod_source_match import PodSourceMatcher
 from modules.source_analyse import ApiCallScanner
-from modules.storage import ProjectFolder
+from modules.storage import ProjectFolder, FILENAME_CONF_CACHE, FILENAME_PERM_MEMO, FILENAME_WHO_CAN, \
+    FILENAME_PERM_UNIVERSE, FILENAME_CODEQL_DB_CACHE, FILENAME_CODEQL_RESULT_CACHE
+from modules.who_can import WhoCanIndex
 from utils.log import log_funcs, log_ctx, inject_global_timer, log_elapse
 
 debug, info, warn, error, fatal = log_funcs(from_file=__file__)
@@ -24,25 +36,141 @@ app = typer.Typer(
 def run(
         project_root: Path = typer.Argument(..., exists=True, help="扫描的目标路径"),
         project_name: str = typer.Argument(None, help="指定扫描的项目名称"),
+        projected: bool = typer.Option(False, help="只在内存中保留分析需要的配置字段，用于较大的配置"),
+        escalation: bool = typer.Option(False, help="将权限提升后能获得的权限计入 Pod 的权限"),
+        k8s_version: str = typer.Option(None, help="集群的 Kubernetes 版本，用于选择内置资源列表，如 1.28"),
+        codeql_threads: int = typer.Option(None, help="CodeQL 任务的总线程数，默认为所有核心"),
+        codeql_ram: int = typer.Option(None, help="CodeQL 任务的总内存（MB）"),
+        codeql_jobs: int = typer.Option(None, help="并发的 CodeQL 任务数，预算平均分给每个任务"),
+        batch_queries: bool = typer.Option(True, help="在一次 CodeQL 调用中执行一个仓库的所有查询"),
+        cli_server: bool = typer.Option(True, help="通过常驻的 CodeQL cli-server 执行命令，避免重复启动 JVM"),
+        db_cache: bool = typer.Option(False, help="在项目之间共享按源码版本缓存的 CodeQL DB，项目中已有的 DB 不受影响"),
+        result_cache: bool = typer.Option(True, help="按查询与 DB 内容缓存查询结果，查询或 DB 变化后重新执行"),
+        result_cache_size: int = typer.Option(DEFAULT_MAX_SIZE, help="查询结果缓存的大小上限（MB）"),
 ):
     proj = ProjectFolder(project_root)
+    # 有效权限缓存在项目之间共享
+    memo = PermissionMemo(proj.shared_cache(FILENAME_PERM_MEMO))
+    proj_names = [name for name in proj.projects() if not project_name or project_name == name]
+
+    budget = ResourceBudget.from_env(codeql_threads, codeql_ram, codeql_jobs)
+    if cli_server:
+        log_dir = proj.shared_cache('logs')
+        log_dir.mkdir(exist_ok=True)
+        backend = CliServerBackend(budget.jobs, log_dir=log_dir)
+    else:
+        backend = ProcessBackend()
+    with backend, CodeQLScheduler(budget) as scheduler:
+        # 先提交所有项目的 CodeQL 任务，在分析前面的项目时并发执行
+        cache = DbCache(proj.shared_cache(FILENAME_CODEQL_DB_CACHE), backend) if db_cache else None
+        results = ResultCache(proj.shared_cache(FILENAME_CODEQL_RESULT_CACHE), result_cache_size) \
+            if result_cache else None
+        acs = ApiCallScanner(proj, scheduler, batch=batch_queries, backend=backend, db_cache=cache,
+                             result_cache=results)
+        for proj_name in proj_names:
+            if not proj.source(proj_name, None).exists():
+                continue
+            try:
+                acs.submit(proj_name)
+            except Exception as e:
+                error(f"error in submitting CodeQL jobs", project=proj_name, exc_info=e)
+
+        for proj_name in proj_names:
+            try:
+                run_single(proj, proj_name, projected=projected, memo=memo, escalation=escalation,
+                           k8s_version=k8s_version, acs=acs)
+            except Exception as e:
+                error(f"error in project", project=proj_name, exc_info=e)
+            finally:
+                memo.save()
+    info("permission memo stats", **memo.stats())
+
+
+@app.command("who-can")
+def who_can(
+        project_root: Path = typer.Argument(..., exists=True, help="扫描的目标路径"),
+        resource: str = typer.Argument(..., help="资源，如 pods"),
+        verb: str = typer.Argument(..., help="操作，如 create"),
+        scope: str = typer.Option(None, help="最小权限范围：cluster、namespace 或 resource-specific"),
+        project_name: str = typer.Option(None, help="只查询指定的项目"),
+        rebuild: bool = typer.Option(False, help="忽略已保存的索引，重新进行配置分析"),
+        k8s_version: str = typer.Option(None, help="集群的 Kubernetes 版本，用于选择内置资源列表，如 1.28"),
+):
+    """查询所有项目中具有指定权限的工作负载与 ServiceAccount"""
+    proj = ProjectFolder(project_root)
+    min_scope = PermissionScope.from_str(scope)
+    memo = PermissionMemo(proj.shared_cache(FILENAME_PERM_MEMO))
 
     for proj_name in proj.projects():
         if project_name and project_name != proj_name:
             continue
         try:
-            run_single(proj, proj_name)
+            index = load_who_can(proj, proj_name, rebuild=rebuild, memo=memo, k8s_version=k8s_version)
         except Exception as e:
             error(f"error in project", project=proj_name, exc_info=e)
+            continue
+        for entry in index.query(resource, verb, min_scope=min_scope):
+            print(f"{proj_name}\t{entry.kind}\t{entry.namespace or '-'}/{entry.name}\t"
+                  f"{entry.service_account}\t{entry.scope}")
+    memo.save()
+
+
+def load_store(proj: ProjectFolder, proj_name: str, projected: bool = False) -> ObjectStore:
+    """加载项目的配置，配置中存在冲突的对象时保存到 conflicts.json"""
+    conf_path = proj.conf(proj_name)
+    assert conf_path.exists(), f"Config not found in {conf_path}"
+    store = ObjectStore.from_config_dir(conf_path, cache_path=proj.cache(proj_name, FILENAME_CONF_CACHE),
+                                        projected=projected)
+    if store.conflicts:
+        # 同名但内容不同的对象，分析结果可能取决于选中了哪一个
+        conflicts_path = proj.result(proj_name, 'conflicts.json')
+        with conflicts_path.open('w') as f:
+            json.dump([conflict.to_dict() for conflict in store.conflicts], f, indent=2)
+    return store
+
+
+def load_who_can(proj: ProjectFolder, proj_name: str, rebuild: bool = False,
+                 memo: Optional[PermissionMemo] = None, k8s_version: Optional[str] = None) -> WhoCanIndex:
+    """加载项目保存的 who-can 索引，不存在或配置变化后只进行配置分析并重新构建索引"""
+    index_path = proj.result(proj_name, FILENAME_WHO_CAN)
+    fingerprint = who_can_fingerprint(proj, proj_name, k8s_version=k8s_version)
+    if index_path.exists() and not rebuild:
+        index = WhoCanIndex.load(index_path)
+        if index.fingerprint == fingerprint:
+            return index
+        info("config changed since who-can index was built, rebuild", project=proj_name)
+
+    with log_ctx(project=proj_name):
+        store = load_store(proj, proj_name)
+        ppa = make_analyser(proj, proj_name, memo=memo, k8s_version=k8s_version)
+        index = WhoCanIndex.from_results(ppa.analyse(store))
+    index.fingerprint = fingerprint
+    index.save(index_path)
+    return index
+
+
+def who_can_fingerprint(proj: ProjectFolder, proj_name: str, escalation: bool = False,
+                        k8s_version: Optional[str] = None) -> str:
+    """who-can 索引的指纹，由项目的配置文件与影响配置分析结果的选项决定"""
+    conf_path = proj.conf(proj_name)
+    options = json.dumps([loader.config_fingerprint(loader.find_config_files(conf_path)), escalation, k8s_version])
+    return hashlib.sha256(options.encode()).hexdigest()
+
+
+def make_analyser(proj: ProjectFolder, proj_name: str, memo: Optional[PermissionMemo] = None,
+                  escalation: bool = False, k8s_version: Optional[str] = None) -> PodPermAnalyser:
+    """配置分析器，权限全集预编译到项目缓存中"""
+    universe_cache = UniverseCache(proj.cache(proj_name, FILENAME_PERM_UNIVERSE))
+    return PodPermAnalyser(memo=memo, escalation=escalation, k8s_version=k8s_version, universe_cache=universe_cache)
 
 
-def run_single(proj: ProjectFolder, proj_name: str):
+def run_single(proj: ProjectFolder, proj_name: str, projected: bool = False,
+               memo: Optional[PermissionMemo] = None, escalation: bool = False, k8s_version: Optional[str] = None,
+               acs: Optional[ApiCallScanner] = None):
     with log_ctx(project=proj_name):
         with log_elapse("scanning project"):
             # 加载配置
-            conf_path = proj.conf(proj_name)
-            assert conf_path.exists(), f"Config not found in {conf_path}"
-            store = ObjectStore.from_config_dir(conf_path)
+            store = load_store(proj, proj_name, projected=projected)
 
             if not proj.source(proj_name, None).exists():
                 error("source code not found")
@@ -50,7 +178,8 @@ def run_single(proj: ProjectFolder, proj_name: str):
 
             # 1. 源代码分析
             with log_elapse("source code analysis"):
-                acs = ApiCallScanner(proj)
+                if acs is None:
+                    acs = ApiCallScanner(proj)
                 with log_elapse("build db"):
                     acs.build_db(proj_name)
                 with log_elapse("scan callsites"):
@@ -68,12 +197,16 @@ def run_single(proj: ProjectFolder, proj_name: str):
 
             # 3. 配置分析
             with log_elapse("config analysis"):
-                ppa = PodPermAnalyser()
+                ppa = make_analyser(proj, proj_name, memo=memo, escalation=escalation, k8s_version=k8s_version)
                 lf_results = ppa.analyse(store)
+                who_can = WhoCanIndex.from_results(lf_results)
+                who_can.fingerprint = who_can_fingerprint(proj, proj_name, escalation=escalation,
+                                                          k8s_version=k8s_version)
+                who_can.save(proj.result(proj_name, FILENAME_WHO_CAN))
 
             # 4. 权限比较
             with log_elapse("permission compare"):
-                pc = PermComparer(lf_results, rt_results)
+                pc = PermComparer(lf_results, rt_results, who_can=who_can)
 
         # 保存 issues
         issues = pc.scan_ep()
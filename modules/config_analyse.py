@@ -2,10 +2,20 @@
 #
 # Copyright (C) 2024 KAAAsS
 
+from typing import Optional, Iterable, NamedTuple
+
 from analyse.k8s.rbac import ServiceAccount, PermissionScope
+from analyse.k8s.rbac.dependency import RbacDependencies, Identity, SaKey, RBAC_KINDS, identity_of, sa_key, \
+    requested_sa_key, sa_matches, changed_service_accounts, store_fingerprints, changed_identities
+from analyse.k8s.rbac.escalation import EscalationClosure
+from analyse.k8s.rbac.matrix import PermissionMatrix, PermissionUniverse, UniverseCache, get_store_universe
+from analyse.k8s.rbac.memo import PermissionMemo
 from analyse.k8s.rbac.permission import get_all_perms
 from analyse.k8s.workload import ContainerCarrier
 from modules.types import EPScanPermission, PodResult
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
 
 
 class PodPermAnalyser:
@@ -18,23 +28,161 @@ class PodPermAnalyser:
     ```
     """
 
-    def analyse(self, store) -> list[PodResult]:
-        """分析配置中的所有 Pod 及其具有的权限"""
+    def __init__(self, universe: Optional[PermissionUniverse] = None, memo: Optional[PermissionMemo] = None,
+                 escalation: bool = False, k8s_version: Optional[str] = None,
+                 universe_cache: Optional[UniverseCache] = None):
+        """
+        :param universe: 分析的权限全集，为 None 则使用 get_store_universe，即内置资源与 store 中 CRD 的权限
+        :param memo: 有效权限的缓存，为 None 则只在单次分析中按 Role 集合去重
+        :param escalation: 是否计算权限提升后的权限，见 EscalationClosure。提升后的权限依赖整个 store，不使用 memo
+        :param k8s_version: 内置资源对应的 K8s 版本，见 all_perms_csv
+        :param universe_cache: 预编译权限全集的缓存
+        """
+        self.universe = universe
+        self.memo = memo
+        self.escalation = escalation
+        self.k8s_version = k8s_version
+        self.universe_cache = universe_cache
+
+    def analyse(self, store, pods: Optional[Iterable[ContainerCarrier]] = None) -> list[PodResult]:
+        """
+        分析配置中的所有 Pod 及其具有的权限
+        :param pods: 只分析 store 中的这些 Pod，为 None 则分析所有 Pod
+        """
         results = []
+        memo = self.memo if self.memo is not None else PermissionMemo()
+        hits, misses = memo.hits, memo.misses
+        matrix = PermissionMatrix(self.get_universe(store), memo)
+        closure = EscalationClosure(store, matrix) if self.escalation else None
+
+        if pods is None:
+            pods = (obj for obj in store if isinstance(obj, ContainerCarrier))
+        for pod in pods:
+            sa = pod.get_sa()
+            if closure is not None:
+                perms = [EPScanPermission(resource, verb, scope) for (resource, verb), scope in closure.list_perms(sa)]
+            else:
+                perms = list_all_perms_by_matrix(sa, matrix)
+            results.append(PodResult(pod, perms))
+
+        debug('permission memo stats', hits=memo.hits - hits, misses=memo.misses - misses, entries=len(memo))
+        return results
+
+    def get_universe(self, store) -> PermissionUniverse:
+        """分析 store 使用的权限全集"""
+        if self.universe is not None:
+            return self.universe
+        return get_store_universe(store, self.k8s_version, self.universe_cache)
+
+
+class IncrementalUpdate(NamedTuple):
+    """一次增量分析的结果"""
+    # 所有 Pod 的结果，未受影响的 Pod 沿用上一次的权限
+    results: list[PodResult]
+    # 新增或重新计算的 Pod 的结果
+    changed: list[PodResult]
+    # 被删除或内容变化后被新版本替换的 Pod，来自上一次分析的 store
+    removed: list[ContainerCarrier]
+
+
+class IncrementalPodPermAnalyser:
+    """
+    保存上一次的分析结果与 ServiceAccount 的依赖（见 RbacDependencies），配置变化后只重新计算受影响的 Pod。
+    CRD 变化（权限全集变化）或计算权限提升时，任何 RBAC 对象的变化都可能影响所有 Pod，此时重新进行完整的分析
+
+    ```python
+    ipa = IncrementalPodPermAnalyser(PodPermAnalyser())
+    pc = PermComparer(ipa.analyse(store), rt_results)
+    pc.scan_ep()
+    update = ipa.update(ObjectStore.from_config_dir(conf_path, cache_path=cache_path))
+    issues = pc.update(update.changed, update.removed)
+    ```
+    """
+
+    def __init__(self, analyser: Optional[PodPermAnalyser] = None):
+        self.analyser = analyser if analyser is not None else PodPermAnalyser()
+        self.store = None
+        self._fingerprints = {}
+        self._deps = RbacDependencies()
+        # Pod 标识 -> (Pod 的结果, ServiceAccount 键)，标识冲突的 Pod 都保存
+        self._results: dict[Identity, list[tuple[PodResult, SaKey]]] = {}
 
+    def analyse(self, store) -> list[PodResult]:
+        """完整分析 store，并记录依赖"""
+        self._deps = RbacDependencies()
+        self._results = {}
+        results = self._analyse_pods(store, [obj for obj in store if isinstance(obj, ContainerCarrier)])
+        self._commit(store)
+        return results
+
+    def update(self, store) -> IncrementalUpdate:
+        """分析变化后的 store，只重新计算变化的 Pod 与 ServiceAccount 受影响的 Pod"""
+        assert self.store is not None, 'IncrementalPodPermAnalyser.analyse must be called before update'
+        fingerprints = store_fingerprints(store)
+        changed = changed_identities(self._fingerprints, fingerprints)
+        old_results = self._results
+
+        kinds = {kind for kind, _, _ in changed}
+        universe_changed = self.analyser.universe is None and 'CustomResourceDefinition' in kinds
+        if universe_changed or (self.analyser.escalation and not kinds.isdisjoint(RBAC_KINDS)):
+            debug('incremental analysis falls back to full analysis', universe_changed=universe_changed)
+            results = self.analyse(store)
+            return IncrementalUpdate(results, results, self._removed(old_results))
+
+        affected_sas, subjects = self._deps.affected(changed, store)
+        # 请求的 ServiceAccount 新增或删除时，查找结果可能变为另一个 ServiceAccount
+        changed_sas = changed_service_accounts(changed)
+        results, recompute = [], []
+        self._results = {}
         for pod in store:
             if not isinstance(pod, ContainerCarrier):
                 continue
-            sa = pod.get_sa()
-            perms = list_all_perms(sa)
-            results.append(PodResult(pod, perms))
+            identity = identity_of(pod)
+            if identity in changed:
+                recompute.append(pod)
+                continue
+            entries = old_results.get(identity, [])
+            # 内容未变化，与上一次分析的 Pod 相等
+            result, key = next((entry for entry in entries if entry[0].pod == pod), (None, None))
+            if result is None or key in affected_sas or sa_matches(key, subjects) \
+                    or sa_matches(requested_sa_key(pod), changed_sas):
+                recompute.append(pod)
+                continue
+            result = PodResult(pod, result.perms)
+            results.append(result)
+            self._results.setdefault(identity, []).append((result, key))
+
+        changed_results = self._analyse_pods(store, recompute)
+        results += changed_results
+        removed = self._removed(old_results)
+        self._commit(store, fingerprints)
+        debug('incremental analysis finished', changed_objects=len(changed), affected_sas=len(affected_sas),
+              recomputed=len(changed_results), removed=len(removed))
+        return IncrementalUpdate(results, changed_results, removed)
 
+    def _removed(self, old_results: dict[Identity, list[tuple[PodResult, SaKey]]]) -> list[ContainerCarrier]:
+        """上一次分析中不再存在的 Pod，包括内容变化后被新版本替换的 Pod"""
+        current = {result.pod for entries in self._results.values() for result, _ in entries}
+        return [result.pod for entries in old_results.values() for result, _ in entries
+                if result.pod not in current]
+
+    def _analyse_pods(self, store, pods: list[ContainerCarrier]) -> list[PodResult]:
+        results = self.analyser.analyse(store, pods)
+        for result in results:
+            sa = result.pod.get_sa()
+            self._deps.track(sa)
+            self._results.setdefault(identity_of(result.pod), []).append((result, sa_key(sa)))
         return results
 
+    def _commit(self, store, fingerprints: Optional[dict] = None):
+        self.store = store
+        self._fingerprints = fingerprints if fingerprints is not None else store_fingerprints(store)
+
 
 def list_all_perms(sa: ServiceAccount) -> list[EPScanPermission]:
     """
     列出 ServiceAccount 具有的所有权限。如果多个权限除 scope 之外都相同，则按偏序只列出一个 scope 最大的一个。
+    逐个权限检查，作为 list_all_perms_by_matrix 的参考实现
     :param sa: ServiceAccount 对象
     :return:
     """
@@ -51,3 +199,8 @@ def list_all_perms(sa: ServiceAccount) -> list[EPScanPermission]:
                     perms[key] = max(perms[key], ep_perm, key=lambda x: x.scope)
 
     return list(perms.values())
+
+
+def list_all_perms_by_matrix(sa: ServiceAccount, matrix: PermissionMatrix) -> list[EPScanPermission]:
+    """同 list_all_perms，但通过权限矩阵计算"""
+    return [EPScanPermission(resource, verb, scope) for (resource, verb), scope in matrix.list_perms(sa)]
@@ -1,11 +1,13 @@
 # __init__.py -- EP 分析模块
 #
 # Copyright (C) 2024 KAAAsS
+import collections
 from typing import Iterable, Optional
 
 from analyse.security.base import Issue, Rule
 from modules.perm_compare import permission
 from modules.types import PodResult, EPScanPermission
+from modules.who_can import WhoCanIndex
 from utils.log import log_funcs
 
 debug, info, warn, error, fatal = log_funcs(from_file=__file__)
@@ -20,51 +22,87 @@ class PermComparer:
     EP 分析模块的核心逻辑，主要用于比较两组 Pod 结果中的权限
     """
 
-    def __init__(self, left: list[PodResult], right: list[PodResult]):
+    def __init__(self, left: list[PodResult], right: list[PodResult], who_can: Optional[WhoCanIndex] = None):
+        """
+        :param who_can: 由 left 构建的 who-can 索引。指定时通过索引查找持有敏感权限的 Pod，不再逐个检查权限
+        """
         self.left = left
         self.right = right
+        self.who_can = who_can
+        # Pod -> 问题，scan_ep 后用于增量更新
+        self._issues: Optional[dict] = None
 
     def scan_ep(self) -> list[Issue]:
         """扫描过度的权限"""
-        issues = []
-
         sensitive_perms = permission.get_sensitive_perm_lookup_map()
+        sensitive_holders = self._find_sensitive_holders(sensitive_perms) if self.who_can is not None else None
 
+        self._issues = {}
         for lf, rt in self._align():
             if lf is None:
                 # 源码分析中得出多的 Pod，理论上不可能，因为都是匹配配置中的 Pod
                 continue
+            self._issues[lf.pod] = self._check_pod(lf, rt, sensitive_perms, sensitive_holders)
+        return [issue for issue in self._issues.values() if issue is not None]
+
+    def update(self, changed: list[PodResult], removed: Iterable = ()) -> list[Issue]:
+        """
+        配置变化后只重新检查变化的 Pod，返回所有 Pod 的问题。需要先调用 scan_ep
+        :param changed: 新增或权限变化的 Pod 的结果，见 IncrementalPodPermAnalyser.update
+        :param removed: 被删除或被新版本替换的 Pod
+        """
+        assert self._issues is not None, 'PermComparer.scan_ep must be called before update'
+        sensitive_perms = permission.get_sensitive_perm_lookup_map()
+        left = {lf.pod: lf for lf in self.left}
+        for pod in removed:
+            left.pop(pod, None)
+            self._issues.pop(pod, None)
 
+        r_map = {rt.pod: rt for rt in self.right}
+        # 内容变化的 Pod 与源码分析的结果不再相等，按 (kind, namespace, name) 对齐
+        r_by_name = {(rt.pod.kind, rt.pod.namespace, rt.pod.name): rt for rt in self.right}
+        for lf in changed:
             pod = lf.pod
-            lf_set = _result_to_perm_keys(lf)
-            if rt is None:
-                warn('source pod calls no API, maybe not a golang container or analysis error', pod=pod)
-            rt_set = _result_to_perm_keys(rt)
-
-            eps = lf_set - rt_set
-            exploitable_eps = set()
-            for ep in eps:
-                perm = _find_perm_by_key(lf.perms, ep)
-                matched_sensitive = sensitive_perms.get(perm.get_deduplicate_key(), None)
-
-                if not matched_sensitive:
-                    continue
-                if not perm.covers(matched_sensitive):
-                    continue
-
-                exploitable_eps.add(perm)
-
-            if not exploitable_eps:
-                continue
-
-            issue = Issue(RULE_EXCESSIVE_PERMISSIONS) \
-                .case_of(f'{pod.kind} have EP vulnerability') \
-                .object(pod)
-            for perm in exploitable_eps:
-                issue.reason(f'Pod: {pod.kind} {pod.name}, PERM: {perm}')
-            issues.append(issue)
-
-        return issues
+            left[pod] = lf
+            rt = r_map.get(pod, None) or r_by_name.get((pod.kind, pod.namespace, pod.name), None)
+            # who-can 索引由旧的结果构建，变化的 Pod 逐个检查
+            self._issues[pod] = self._check_pod(lf, rt, sensitive_perms, None)
+        self.left = list(left.values())
+        # 索引已经过期，之后的 scan_ep 也逐个检查
+        self.who_can = None
+        debug('permission compare updated', changed=len(changed), pods=len(self.left))
+        return [issue for issue in self._issues.values() if issue is not None]
+
+    def _check_pod(self, lf: PodResult, rt: Optional[PodResult], sensitive_perms: dict,
+                   sensitive_holders: Optional[dict]) -> Optional[Issue]:
+        """检查单个 Pod 的过度权限"""
+        pod = lf.pod
+        if rt is None:
+            warn('source pod calls no API, maybe not a golang container or analysis error', pod=pod)
+        rt_set = _result_to_perm_keys(rt)
+
+        if sensitive_holders is not None:
+            exploitable_eps = {perm for key, perm in sensitive_holders.get(pod, {}).items() if key not in rt_set}
+        else:
+            exploitable_eps = _find_exploitable_eps(lf, _result_to_perm_keys(lf) - rt_set, sensitive_perms)
+
+        if not exploitable_eps:
+            return None
+
+        issue = Issue(RULE_EXCESSIVE_PERMISSIONS) \
+            .case_of(f'{pod.kind} have EP vulnerability') \
+            .object(pod)
+        for perm in exploitable_eps:
+            issue.reason(f'Pod: {pod.kind} {pod.name}, PERM: {perm}')
+        return issue
+
+    def _find_sensitive_holders(self, sensitive_perms: dict) -> dict:
+        """通过 who-can 索引查找持有敏感权限的 Pod，返回 Pod -> {权限键: 权限}"""
+        holders = collections.defaultdict(dict)
+        for (resource, verb), sensitive in sensitive_perms.items():
+            for pod, scope in self.who_can.pods_with(resource, verb, min_scope=sensitive.scope).items():
+                holders[pod][(resource, verb)] = EPScanPermission(resource, verb, scope)
+        return holders
 
     def _align(self) -> Iterable[tuple[Optional[PodResult], Optional[PodResult]]]:
         """对齐两组 Pod 结果"""
@@ -75,6 +113,22 @@ class PermComparer:
             yield l_map.get(pod), r_map.get(pod)
 
 
+def _find_exploitable_eps(lf: PodResult, eps: set[tuple[str, str]], sensitive_perms: dict) -> set[EPScanPermission]:
+    """逐个检查过度权限是否为敏感权限"""
+    exploitable_eps = set()
+    for ep in eps:
+        perm = _find_perm_by_key(lf.perms, ep)
+        matched_sensitive = sensitive_perms.get(perm.get_deduplicate_key(), None)
+
+        if not matched_sensitive:
+            continue
+        if not perm.covers(matched_sensitive):
+            continue
+
+        exploitable_eps.add(perm)
+    return exploitable_eps
+
+
 def _result_to_perm_keys(result: Optional[PodResult]) -> set[tuple[str, str]]:
     if result is None:
         return set()
@@ -60,8 +60,11 @@ class PodSourceMatcher:
         cache_path = self.proj.cache(self.proj_name, 'matched_pod.json')
         if cache_path.exists():
             info('loading matched pod from cache', cache=cache_path)
-            self.matched_pod = _load_cache_matched_map(cache_path, self.pod_info, self.source_info)
-            return
+            matched_pod = _load_cache_matched_map(cache_path, self.pod_info, self.source_info)
+            if matched_pod is not None:
+                self.matched_pod = matched_pod
+                return
+            info('matched pod cache is stale, rematching', cache=cache_path)
 
         self.match_by_extract_executable()
         # Uncomment the following line to use heuristic matching as a fallback, which only works in very few cases.
@@ -213,28 +216,36 @@ class CacheEntry(NamedTuple):
     source_name: str
     source_main_file_path: str
     rule_name: Optional[str]
+    # 旧版本的缓存中没有以下字段
+    pod_namespace: Optional[str] = None
+    pod_digest: Optional[str] = None
 
 
 def _load_cache_matched_map(cache_path: Path, pod_infos: list[PodInfo],
-                            source_infos: list[ProgramEntrypointInfo]) -> MatchedMap:
+                            source_infos: list[ProgramEntrypointInfo]) -> Optional[MatchedMap]:
+    """加载缓存的匹配结果，Pod 被删除或内容发生变化时返回 None"""
     with cache_path.open() as f:
         data = json.load(f)
+
+    pod_map = {}
+    for p in pod_infos:
+        pod = p.get_pod()
+        pod_map[(pod.kind, pod.namespace, pod.name)] = p
+        pod_map.setdefault((pod.kind, None, pod.name), p)
+    source_map = {(s.source_name, str(s.main_file_path)): s for s in source_infos}
+
     matched_pod = collections.defaultdict(list)
     for d in data:
         entry = CacheEntry(*d)
 
-        pod_info = None
-        for p in pod_infos:
-            if p.get_pod().kind == entry.pod_kind and p.get_pod().name == entry.pod_name:
-                pod_info = p
-                break
-        assert pod_info is not None, f'pod not found: {entry.pod_kind} {entry.pod_name}'
+        pod_info = pod_map.get((entry.pod_kind, entry.pod_namespace, entry.pod_name), None)
+        if pod_info is None:
+            debug('cached pod not found', kind=entry.pod_kind, namespace=entry.pod_namespace, name=entry.pod_name)
+            return None
+        if entry.pod_digest is not None and entry.pod_digest != pod_info.get_pod().digest:
+            return None
 
-        source_info = None
-        for s in source_infos:
-            if s.source_name == entry.source_name and str(s.main_file_path) == entry.source_main_file_path:
-                source_info = s
-                break
+        source_info = source_map.get((entry.source_name, entry.source_main_file_path), None)
 
         rule_name = entry.rule_name
         rule = MatchingRule(rule_name, None) if rule_name else None
@@ -246,9 +257,11 @@ def _save_cache_matched_map(cache_path: Path, matched_pod: MatchedMap):
     data = []
     for pod_info, source_info_list in matched_pod.items():
         for source_info, rule in source_info_list:
-            data.append(CacheEntry(pod_info.get_pod().kind, pod_info.get_pod().name,
+            pod = pod_info.get_pod()
+            data.append(CacheEntry(pod.kind, pod.name,
                                    source_info.source_name, str(source_info.main_file_path),
-                                   rule.name if rule else None))
+                                   rule.name if rule else None,
+                                   pod.namespace, pod.digest))
     with cache_path.open('w') as f:
         json.dump(data, f, indent=2)
 
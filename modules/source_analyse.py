@@ -2,9 +2,15 @@
 #
 # Copyright (C) 2024 KAAAsS
 import csv
+from concurrent.futures import Future
 from pathlib import Path
+from typing import Optional, Iterable
 
 from analyse.source import codeql
+from analyse.source.backend import CodeQLBackend, ProcessBackend
+from analyse.source.db_cache import DbCache
+from analyse.source.result_cache import ResultCache
+from analyse.source.scheduler import CodeQLScheduler, Resources
 from modules.storage import ProjectFolder, FILENAME_CODEQL_ENTRYPOINTS
 from modules.types import CallSite
 from utils.log import log_ctx, log_funcs
@@ -23,9 +29,20 @@ def parse_query_result(result_path: Path) -> list['CallSite']:
         return [CallSite(*row) for row in reader]
 
 
+# 每个仓库执行的查询
+SCAN_QUERIES = (
+    codeql.QUERY_REACHABLE_API_CALLS,
+    # 顺便查询所有 API 调用便于结果校验
+    codeql.QUERY_API_CALLS,
+    # 查询所有入口点，作为后续 Pod-source 模块的输入
+    codeql.QUERY_ENTRYPOINTS,
+)
+
+
 class ApiCallScanner:
     """
-    源码分析模块的核心逻辑，主要用于扫描源码中的 K8s API 调用点
+    源码分析模块的核心逻辑，主要用于扫描源码中的 K8s API 调用点。
+    各仓库的 DB 构建与查询由 CodeQLScheduler 在资源预算内并发执行
 
     ```python
     acs = ApiCallScanner(proj_root)
@@ -34,43 +51,96 @@ class ApiCallScanner:
     ```
     """
 
-    def __init__(self, proj: ProjectFolder):
+    def __init__(self, proj: ProjectFolder, scheduler: Optional[CodeQLScheduler] = None, batch: bool = True,
+                 backend: Optional[CodeQLBackend] = None, db_cache: Optional[DbCache] = None,
+                 result_cache: Optional[ResultCache] = None):
+        """
+        :param scheduler: CodeQL 任务的调度器，可以在多个项目之间共享。为 None 则按环境变量的预算创建
+        :param batch: 是否在一次 CodeQL 调用中执行一个仓库的所有查询，见 codeql.run_queries
+        :param backend: 执行 CodeQL 命令的后端，如常驻的 CliServerBackend。为 None 则每个命令启动一个进程
+        :param db_cache: 在项目之间共享的 DB 缓存，项目中的 DB 链接到缓存。为 None 则 DB 存在时直接使用
+        :param result_cache: 在项目之间共享的查询结果缓存，查询或 DB 变化后重新执行。为 None 则结果存在时直接使用
+        """
         self.proj = proj
+        self.scheduler = scheduler if scheduler is not None else CodeQLScheduler()
+        self.batch = batch
+        self.backend = backend if backend is not None else ProcessBackend()
+        self.db_cache = db_cache
+        self.result_cache = result_cache
+        # (项目, 仓库, 查询) -> 已提交的任务，查询为 None 表示 DB 构建，批量执行时为所有查询的标识
+        self._jobs: dict[tuple, Future] = {}
 
     def build_db(self, proj_name) -> None:
-        info("check CodeQL environment")
-        codeql.prepare_queries()
         with log_ctx(project=proj_name):
             info("build CodeQL database for project")
+            self.scheduler.wait(self.submit(proj_name, queries=()))
+            info("done building CodeQL database")
 
+    def submit(self, proj_name, queries: Iterable[codeql.Query] = SCAN_QUERIES) -> list[Future]:
+        """
+        提交项目所有仓库的 DB 构建与查询任务，不等待完成。同一个任务只提交一次，
+        因此可以先为多个项目提交任务使其并发执行，之后再调用 build_db 与 scan 等待结果
+        """
+        info("check CodeQL environment")
+        codeql.prepare_queries(backend=self.backend)
+        queries = list(queries)
+        futures = []
+        with log_ctx(project=proj_name):
             for source in self.proj.sources(proj_name):
                 with log_ctx(source=source):
-                    source_path = source.local_path
-                    dest_path = self.proj.db(proj_name, source.name)
-                    log_path = self.proj.log(proj_name, f'codeql/build_db_{source.name}.log')
-
-                    if dest_path.exists():
-                        info("db already exists, skip building")
-                        continue
-                    try:
-                        codeql.build_db(source_path, dest_path, log_path)
-                    except AssertionError as e:
-                        warn("failed to build CodeQL database for source", source=source, error=e)
+                    build = self._submit_once((proj_name, source.name, None), self._build_source_db,
+                                              proj_name, source)
+                    futures.append(build)
+                    if self.batch and queries:
+                        key = (proj_name, source.name, tuple(query.identifier for query in queries))
+                        futures.append(self._submit_once(key, self.run_queries, proj_name, source.name, queries,
+                                                         after=[build]))
                         continue
+                    for query in queries:
+                        futures.append(self._submit_once((proj_name, source.name, query.identifier), self.run_query,
+                                                         proj_name, source.name, query, after=[build]))
+        return futures
 
-            info("done building CodeQL database")
+    def _submit_once(self, key: tuple, fn, *args, **kwargs) -> Future:
+        future = self._jobs.get(key, None)
+        if future is None:
+            future = self.scheduler.submit(fn, *args, **kwargs)
+            self._jobs[key] = future
+        return future
+
+    def _build_source_db(self, proj_name, source, resources: Optional[Resources] = None) -> None:
+        dest_path = self.proj.db(proj_name, source.name)
+        log_path = self.proj.log(proj_name, f'codeql/build_db_{source.name}.log')
+
+        if self.db_cache is not None:
+            try:
+                if self.db_cache.ensure(source.local_path, dest_path, log_path, resources=resources):
+                    self._clear_query_results(proj_name, source.name)
+            except AssertionError as e:
+                warn("failed to build CodeQL database for source", source=source, error=e)
+            return
+        if dest_path.exists():
+            info("db already exists, skip building")
+            return
+        try:
+            codeql.build_db(source.local_path, dest_path, log_path, resources=resources, backend=self.backend)
+        except AssertionError as e:
+            warn("failed to build CodeQL database for source", source=source, error=e)
+
+    def _clear_query_results(self, proj_name, source_name) -> None:
+        """删除 DB 变化前的查询结果"""
+        cache_dir = self.proj.cache(proj_name, None)
+        stale = list(cache_dir.glob(f'codeql_queries/*/repo_{source_name}.csv*'))
+        stale += cache_dir.glob(f'result_*_{proj_name}_{source_name}.bqrs')
+        for path in stale:
+            path.unlink()
+        if stale:
+            info("DB changed, stale query results removed", count=len(stale))
 
     def scan(self, proj_name) -> list['CallSite']:
         with log_ctx(project=proj_name):
             info("scan project for API calls")
-
-            for source in self.proj.sources(proj_name):
-                with log_ctx(source=source):
-                    self.run_query(proj_name, source.name, codeql.QUERY_REACHABLE_API_CALLS)
-                    # 顺便查询所有 API 调用便于结果校验
-                    self.run_query(proj_name, source.name, codeql.QUERY_API_CALLS)
-                    # 查询所有入口点，作为后续 Pod-source 模块的输入
-                    self.run_query(proj_name, source.name, codeql.QUERY_ENTRYPOINTS)
+            self.scheduler.wait(self.submit(proj_name))
 
             # 合并分仓库的结果
             result_reachable_path = self.proj.cache(proj_name, 'codeql.csv')
@@ -84,7 +154,7 @@ class ApiCallScanner:
             # 解析结果
             return parse_query_result(result_reachable_path)
 
-    def run_query(self, proj_name, source_name, query: codeql.Query) -> None:
+    def run_query(self, proj_name, source_name, query: codeql.Query, resources: Optional[Resources] = None) -> None:
         info("run CodeQL query for source", query=query)
 
         db_path = self.proj.db(proj_name, source_name)
@@ -97,7 +167,8 @@ class ApiCallScanner:
         try:
             result_dir = self.proj.cache_query_result(proj_name, query)
             result_file = result_dir / f"repo_{source_name}.csv"
-            if result_file.exists():
+            # 使用结果缓存时由 run_query 检查结果是否过期
+            if self.result_cache is None and result_file.exists():
                 info("query result already exists, skip running", result_file=result_file)
                 return
             query.run(
@@ -107,10 +178,49 @@ class ApiCallScanner:
                 result_path=result_file,
                 query_name=f"{proj_name}_{source_name}",
                 disable_cache=False,
+                resources=resources,
+                backend=self.backend,
+                result_cache=self.result_cache,
             )
         except AssertionError as e:
             warn("failed to run CodeQL query for source", source=source_name, error=e)
 
+    def run_queries(self, proj_name, source_name, queries: list[codeql.Query],
+                    resources: Optional[Resources] = None) -> None:
+        """同 run_query，但在一次 CodeQL 调用中执行所有查询"""
+        info("run CodeQL queries for source in batch", queries=queries)
+
+        db_path = self.proj.db(proj_name, source_name)
+        assert db_path.exists(), f"Database not found for {source_name}"
+        log_dir = self.proj.log(proj_name, 'codeql')
+        log_dir.mkdir(parents=True, exist_ok=True)
+        cache_dir = self.proj.cache(proj_name, None)
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
+        try:
+            result_files = {query.identifier: self.proj.cache_query_result(proj_name, query) / f"repo_{source_name}.csv"
+                            for query in queries}
+            # 使用结果缓存时由 run_queries 检查结果是否过期
+            pending = [query for query in queries
+                       if self.result_cache is not None or not result_files[query.identifier].exists()]
+            if not pending:
+                info("query results already exist, skip running", queries=queries)
+                return
+            codeql.run_queries(
+                pending,
+                db_path=db_path,
+                log_dir=log_dir,
+                cache_dir=cache_dir,
+                result_paths=[result_files[query.identifier] for query in pending],
+                query_name=f"{proj_name}_{source_name}",
+                disable_cache=False,
+                resources=resources,
+                backend=self.backend,
+                result_cache=self.result_cache,
+            )
+        except AssertionError as e:
+            warn("failed to run CodeQL queries for source", source=source_name, error=e)
+
     def merge_query_result(self, proj_name, query: codeql.Query, result_path: Path) -> None:
         info("merge CodeQL query results of all source repo for query", query=query)
 
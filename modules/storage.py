@@ -5,6 +5,12 @@ from analyse.source import codeql
 from modules.types import SourceCode
 
 FILENAME_CODEQL_ENTRYPOINTS = "codeql_entrypoints.csv"
+FILENAME_CONF_CACHE = "conf_cache.pickle"
+FILENAME_PERM_MEMO = "perm_memo.pickle"
+FILENAME_WHO_CAN = "who_can.json"
+FILENAME_PERM_UNIVERSE = "perm_universe.pickle"
+FILENAME_CODEQL_DB_CACHE = "codeql_db"
+FILENAME_CODEQL_RESULT_CACHE = "codeql_results"
 
 
 class ProjectFolder:
@@ -12,17 +18,25 @@ class ProjectFolder:
     Project 文件夹的常用函数
 
     proj_root 文件夹的格式：
+    - .cache/                所有项目共享的缓存
+      - perm_memo.pickle     按 Role 集合缓存的有效权限，运行配置分析后创建
+      - codeql_db/           按源码版本缓存的 CodeQL DB，见 DbCache
+      - codeql_results/      按查询与 DB 缓存的查询结果，见 ResultCache
+      - logs/                CodeQL cli-server 的日志
     - {project name}/        项目文件夹
       - conf/                K8s 配置文件目录
       - source/              项目源码
         - {repo name}/
       - db/                  CodeQL DB，运行 `ApiCallScanner.build_db` 后创建
-        - {repo name}/
+        - {repo name}/       使用 DB 缓存时为指向缓存的符号链接
       - cache/               缓存，运行分析后创建
         - codeql.csv         源代码分析中 CodeQL 查询的 CSV 结果，运行 `ApiCallScanner.scan` 后创建
+        - conf_cache.pickle  已解析的配置文件缓存，加载配置后创建
+        - perm_universe.pickle  预编译的权限全集（内置资源与 CRD），运行配置分析后创建
       - logs/                日志
       - result/              运行结果，运行分析后创建
         - issues.json        安全问题，运行 ep-scan 工具后创建
+        - who_can.json       权限到工作负载的倒排索引及其配置的指纹，运行配置分析后创建，配置变化后重新构建
     """
 
     def __init__(self, proj_root: Path):
@@ -47,6 +61,14 @@ class ProjectFolder:
         cache_path.parent.mkdir(parents=True, exist_ok=True)
         return cache_path
 
+    def shared_cache(self, cache_file) -> Path:
+        """所有项目共享的缓存"""
+        cache_path = self.root / ".cache"
+        if cache_file is not None:
+            cache_path /= cache_file
+        cache_path.parent.mkdir(parents=True, exist_ok=True)
+        return cache_path
+
     def cache_query_result(self, proj_name, query: codeql.Query) -> Path:
         """CodeQL 查询的结果目录"""
         result_path = self.cache(proj_name, f"codeql_queries/{query.identifier}/")
@@ -61,7 +83,8 @@ class ProjectFolder:
 
     def projects(self) -> Iterable[str]:
         for proj in self.root.iterdir():
-            if proj.is_dir():
+            # 跳过 .cache 等隐藏目录
+            if proj.is_dir() and not proj.name.startswith('.'):
                 yield proj.name
 
     def source(self, proj_name, source_name, no_check=False) -> Path:
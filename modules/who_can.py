@@ -0,0 +1,124 @@
+# who_can.py -- 权限到 ServiceAccount 与工作负载的倒排索引
+#
+# Copyright (C) 2024 KAAAsS
+import collections
+import json
+from pathlib import Path
+from typing import NamedTuple, Optional
+
+from analyse.k8s.rbac import PermissionScope
+from modules.types import PodResult, PermissionKey
+from utils.log import log_funcs
+
+debug, info, warn, error, fatal = log_funcs(from_file=__file__)
+
+
+class WhoCanEntry(NamedTuple):
+    """持有某个权限的工作负载"""
+    kind: str
+    name: str
+    namespace: Optional[str]
+    service_account: str
+    scope: Optional[PermissionScope]
+
+    def to_dict(self):
+        return {
+            'kind': self.kind,
+            'name': self.name,
+            'namespace': self.namespace,
+            'service_account': self.service_account,
+            'scope': str(self.scope) if self.scope is not None else None,
+        }
+
+    @staticmethod
+    def from_dict(data: dict):
+        return WhoCanEntry(data['kind'], data['name'], data['namespace'], data['service_account'],
+                           PermissionScope.from_str(data['scope']))
+
+
+class WhoCanIndex:
+    """
+    (resource, verb, scope) -> 持有该权限的工作负载及其 ServiceAccount 的倒排索引，由配置分析的结果构建
+
+    ```python
+    index = WhoCanIndex.from_results(ppa.analyse(store))
+    entries = index.query('pods', 'create', min_scope=CLUSTER)
+    ```
+    """
+
+    def __init__(self):
+        self.entries: list[WhoCanEntry] = []
+        # 构建索引的工作负载对象，与 entries 一一对应。从文件加载时为 None
+        self.pods: list = []
+        self._index: dict[tuple[str, str, Optional[PermissionScope]], list[int]] = collections.defaultdict(list)
+        # 构建索引的配置与选项的指纹，用于判断保存的索引是否过期
+        self.fingerprint: Optional[str] = None
+
+    def add(self, result: PodResult):
+        """加入一个工作负载的所有权限"""
+        pod = result.pod
+        sa = pod.get_sa()
+        for perm in result.perms:
+            self._add_entry(perm.get_deduplicate_key(),
+                            WhoCanEntry(pod.kind, pod.name, pod.namespace, sa.name, perm.scope), pod)
+
+    def _add_entry(self, key: PermissionKey, entry: WhoCanEntry, pod):
+        self._index[key + (entry.scope,)].append(len(self.entries))
+        self.entries.append(entry)
+        self.pods.append(pod)
+
+    def _lookup(self, resource: str, verb: str, min_scope: Optional[PermissionScope]) -> list[int]:
+        positions = []
+        # 与 EPScanPermission.covers 一致，权限范围未知（None）的条目总是匹配
+        for scope in list(PermissionScope) + [None]:
+            if min_scope is not None and scope is not None and not scope >= min_scope:
+                continue
+            positions += self._index.get((resource, verb, scope), [])
+        return sorted(positions)
+
+    def query(self, resource: str, verb: str, min_scope: Optional[PermissionScope] = None) -> list[WhoCanEntry]:
+        """
+        查询持有权限的工作负载
+        :param min_scope: 只返回权限范围不小于 min_scope（或范围未知）的结果，为 None 则不限制
+        """
+        return [self.entries[pos] for pos in self._lookup(resource, verb, min_scope)]
+
+    def pods_with(self, resource: str, verb: str, min_scope: Optional[PermissionScope] = None) -> dict:
+        """持有权限的工作负载对象 -> 权限范围，只能用于由分析结果构建的索引"""
+        return {self.pods[pos]: self.entries[pos].scope for pos in self._lookup(resource, verb, min_scope)}
+
+    def service_accounts(self, resource: str, verb: str, min_scope: Optional[PermissionScope] = None) -> list:
+        """持有权限的 ServiceAccount (namespace, name)，按名称排序"""
+        return sorted({(entry.namespace, entry.service_account)
+                       for entry in self.query(resource, verb, min_scope)},
+                      key=lambda x: (x[0] or '', x[1]))
+
+    def save(self, path: Path):
+        data = [
+            {'resource': resource, 'verb': verb, **self.entries[pos].to_dict()}
+            for (resource, verb, _), positions in self._index.items()
+            for pos in positions
+        ]
+        with path.open('w') as f:
+            json.dump({'fingerprint': self.fingerprint, 'entries': data}, f, indent=2)
+
+    @staticmethod
+    def load(path: Path) -> 'WhoCanIndex':
+        index = WhoCanIndex()
+        with path.open() as f:
+            saved = json.load(f)
+        # 旧版本的索引只有条目列表，没有指纹
+        if isinstance(saved, dict):
+            index.fingerprint = saved['fingerprint']
+            saved = saved['entries']
+        for data in saved:
+            index._add_entry((data['resource'], data['verb']), WhoCanEntry.from_dict(data), None)
+        return index
+
+    @staticmethod
+    def from_results(results: list[PodResult]) -> 'WhoCanIndex':
+        index = WhoCanIndex()
+        for result in results:
+            index.add(result)
+        debug('who-can index built', pods=len(results), entries=len(index.entries))
+        return index
@@ -0,0 +1,85 @@
+import pickle
+from unittest import TestCase
+
+from tinydb.queries import Query
+
+from analyse.k8s.basic import Object
+from analyse.k8s.rbac import RoleBinding
+from tests import load_single_objs
+
+
+class TestObjectStore(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.store = load_single_objs()
+
+    def test_index_matches_query(self):
+        cases = [
+            (self.store.search_by_kind('Role'), Query().kind == 'Role'),
+            (self.store.search_by_name('test_sa'), Query().metadata.name == 'test_sa'),
+        ]
+        for indexed, cond in cases:
+            with self.subTest(str(cond)):
+                self.assertEqual(indexed, self.store.search(cond))
+
+    def test_search_by_kind_and_name(self):
+        role = self.store.search_by_kind_and_name('Role', 'role-normal')
+        self.assertIsNotNone(role)
+        self.assertEqual(role.kind, 'Role')
+        # kind 条件不应被忽略
+        self.assertIsNone(self.store.search_by_kind_and_name('ClusterRole', 'role-normal'))
+
+    def test_find_bindings(self):
+        binds = self.store.find_bindings_by_subject('ServiceAccount', 'test_sa')
+        self.assertEqual({b.name for b in binds}, {'test_sa_role_binding', 'test_sa_cluster_role_binding'})
+        self.assertTrue(all(isinstance(b, RoleBinding) for b in binds))
+
+        binds = self.store.find_bindings_by_role_ref('test_sa_cluster_role')
+        self.assertEqual([b.name for b in binds], ['test_sa_cluster_role_binding'])
+
+        self.assertEqual(self.store.find_bindings_by_subject('User', 'test_sa'), [])
+
+    def test_find_by_labels(self):
+        roles = self.store.find_by_labels({'rbac.example.com/aggregate-to-root': 'true'}, kind='ClusterRole')
+        self.assertEqual({r.name for r in roles}, {'agg-child-pods', 'agg-child-secrets'})
+
+        roles = self.store.find_by_labels({'rbac.example.com/aggregate-to-root': 'true',
+                                           'rbac.example.com/tier': 'reader'})
+        self.assertEqual([r.name for r in roles], ['agg-child-pods'])
+
+        self.assertEqual(self.store.find_by_labels({'rbac.example.com/tier': 'none'}), [])
+
+
+class TestObject(TestCase):
+
+    def test_digest(self):
+        a = Object.from_dict({'apiVersion': 'v1', 'kind': 'Pod', 'metadata': {'name': 'a', 'namespace': 'ns'},
+                              'spec': {'containers': []}})
+        b = Object.from_dict({'kind': 'Pod', 'spec': {'containers': []}, 'apiVersion': 'v1',
+                              'metadata': {'namespace': 'ns', 'name': 'a'}})
+        c = Object.from_dict({'apiVersion': 'v1', 'kind': 'Pod', 'metadata': {'name': 'c', 'namespace': 'ns'},
+                              'spec': {'containers': []}})
+        self.assertEqual(a.digest, b.digest)
+        self.assertEqual(a, b)
+        self.assertEqual(hash(a), hash(b))
+        self.assertNotEqual(a, c)
+        self.assertEqual(a.identity, ('Pod', 'ns', 'a', None))
+        self.assertEqual({a: 1, c: 2}[b], 1)
+
+
+class TestObjectStorePickle(TestCase):
+
+    def test_pickle_from_object(self):
+        # 从对象开始序列化时，store 会先于对象本身恢复，曾导致对象被当作空对象丢弃
+        store = load_single_objs()
+        pod = store.search_by_name('test_container')[0]
+
+        restored_pod = pickle.loads(pickle.dumps(pod))
+        restored_store = restored_pod.store
+        self.assertEqual(len(restored_store.objects), len(store.objects))
+        self.assertTrue(all(hasattr(obj, 'data') for obj in restored_store.objects))
+        self.assertIs(restored_store.search_by_name('test_container')[0], restored_pod)
+        self.assertEqual([b.name for b in restored_store.find_bindings_by_subject('ServiceAccount', 'test_sa')],
+                         [b.name for b in store.find_bindings_by_subject('ServiceAccount', 'test_sa')])
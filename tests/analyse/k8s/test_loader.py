@@ -0,0 +1,223 @@
+import io
+import json
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+import yaml
+
+from analyse.k8s import loader
+from analyse.k8s.basic import ObjectStore
+
+SA_TEMPLATE = '''apiVersion: v1
+kind: ServiceAccount
+metadata:
+  name: sa-{}
+'''
+
+
+class TestLoader(TestCase):
+
+    def test_suffixes(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / 'a.yaml').write_text(SA_TEMPLATE.format('yaml'))
+            (tmp / 'b.yml').write_text(SA_TEMPLATE.format('yml') + '---\n' + SA_TEMPLATE.format('yml-2'))
+            (tmp / 'c.json').write_text(json.dumps({
+                'apiVersion': 'v1',
+                'kind': 'ServiceAccount',
+                'metadata': {'name': 'sa-json'},
+            }))
+            (tmp / 'd.txt').write_text(SA_TEMPLATE.format('txt'))
+
+            store = ObjectStore.from_config_dir(tmp)
+            self.assertEqual([obj.name for obj in store], ['sa-yaml', 'sa-yml', 'sa-yml-2', 'sa-json'])
+            self.assertEqual(store.search_by_name('sa-json')[0].source_path, tmp.absolute() / 'c.json')
+
+    def test_parallel_order(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            for i in range(loader._PARALLEL_MIN_FILES * 2):
+                sub = tmp / f'dir{i % 3}'
+                sub.mkdir(exist_ok=True)
+                (sub / f'{i}.yaml').write_text(SA_TEMPLATE.format(i))
+
+            serial = ObjectStore.from_config_dir(tmp, workers=1)
+            parallel = ObjectStore.from_config_dir(tmp, workers=4)
+            self.assertEqual([(o.name, o.source_path) for o in serial],
+                             [(o.name, o.source_path) for o in parallel])
+
+
+class TestConfigCache(TestCase):
+
+    def test_reparse_changed_only(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            conf = tmp / 'conf'
+            conf.mkdir()
+            cache_path = tmp / 'conf_cache.pickle'
+            (conf / 'a.yaml').write_text(SA_TEMPLATE.format('a'))
+            (conf / 'b.yaml').write_text(SA_TEMPLATE.format('b'))
+
+            store = ObjectStore.from_config_dir(conf, cache_path=cache_path)
+            self.assertEqual([obj.name for obj in store], ['sa-a', 'sa-b'])
+            self.assertTrue(cache_path.exists())
+            digests = [obj.digest for obj in store]
+
+            (conf / 'b.yaml').write_text(SA_TEMPLATE.format('b-changed'))
+            parsed = []
+            origin_parse = loader.iter_config_file
+
+            def iter_config_file(path, projected=False):
+                parsed.append(path.name)
+                return origin_parse(path, projected)
+
+            loader.iter_config_file = iter_config_file
+            try:
+                store = ObjectStore.from_config_dir(conf, cache_path=cache_path, workers=1)
+            finally:
+                loader.iter_config_file = origin_parse
+
+            self.assertEqual(parsed, ['b.yaml'])
+            self.assertEqual([obj.name for obj in store], ['sa-a', 'sa-b-changed'])
+            self.assertEqual(store.objects[0].digest, digests[0])
+            self.assertNotEqual(store.objects[1].digest, digests[1])
+            self.assertEqual(store.search_by_kind_and_name('ServiceAccount', 'sa-a').source_path,
+                             (conf / 'a.yaml').absolute())
+
+
+class TestProjectedLoad(TestCase):
+
+    def test_projected(self):
+        base = Path(__file__).parent / '..' / '..' / 'resources' / 'config_analyse' / 'dex'
+        full = ObjectStore.from_config_dir(base)
+        projected = ObjectStore.from_config_dir(base, projected=True)
+        self.assertEqual([(o.kind, o.name) for o in full], [(o.kind, o.name) for o in projected])
+
+        for full_obj, projected_obj in zip(full, projected):
+            with self.subTest(f'{full_obj.kind} {full_obj.name}'):
+                self.assertEqual(full_obj.full_data, projected_obj.full_data)
+                self.assertEqual(full_obj.data, full_obj.full_data)
+                self.assertEqual(full_obj.digest, projected_obj.digest)
+
+        secret = projected.search_by_kind('Secret')[0]
+        self.assertNotIn('data', secret.data)
+        self.assertIn('data', secret.full_data)
+
+        deployment = projected.search_by_kind('Deployment')[0]
+        self.assertEqual(list(deployment.data['spec'].keys()), ['template'])
+        self.assertEqual(deployment.sa_name, full.search_by_kind('Deployment')[0].sa_name)
+
+
+class TestListDump(TestCase):
+
+    def test_list_dump(self):
+        items = [yaml.safe_load(SA_TEMPLATE.format(i)) for i in range(3)]
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / 'dump.json').write_text(json.dumps({'apiVersion': 'v1', 'items': items, 'kind': 'List'}))
+            (tmp / 'dump.yaml').write_text(yaml.safe_dump({'apiVersion': 'v1', 'kind': 'List', 'items': items}))
+
+            store = ObjectStore.from_files([tmp / 'dump.json'], projected=True)
+            self.assertEqual([obj.name for obj in store], ['sa-0', 'sa-1', 'sa-2'])
+            self.assertEqual(len(store.search_by_kind('ServiceAccount')), 3)
+            self.assertEqual(store.objects[2].full_data, items[2])
+
+            store = ObjectStore.from_config_dir(tmp, deduplicate=False)
+            self.assertEqual(len(store.search_by_kind('ServiceAccount')), 6)
+            self.assertEqual(store.objects[4].full_data, items[1])
+
+            # 两个文件中的对象相同，合并后记录两处来源
+            store = ObjectStore.from_config_dir(tmp)
+            self.assertEqual(len(store.search_by_kind('ServiceAccount')), 3)
+            self.assertEqual(store.objects[1].source_paths, [tmp.absolute() / 'dump.json', tmp.absolute() / 'dump.yaml'])
+
+    def test_yaml_list_streaming(self):
+        items = [yaml.safe_load(SA_TEMPLATE.format(i)) for i in range(5000)]
+        # safe_dump 按键排序，kind 在 items 之后
+        data = yaml.safe_dump({'apiVersion': 'v1', 'items': items, 'kind': 'List'}).encode()
+        f = io.BytesIO(data)
+        docs = loader.iter_yaml_documents(f, reopen=lambda: io.BytesIO(data))
+        self.assertEqual(next(docs), items[0])
+        # 第一个元素在读完整个文件之前产生
+        self.assertLess(f.tell(), len(data) // 2)
+        self.assertEqual(list(docs), items[1:])
+
+    def test_items_before_kind(self):
+        items = [yaml.safe_load(SA_TEMPLATE.format(i)) for i in range(2)]
+        # 非 List 文档的 items 在 kind 之前时不展开
+        obj = {'apiVersion': 'example.com/v1', 'items': [{'name': 'a'}], 'kind': 'Inventory',
+               'metadata': {'name': 'inv'}}
+        dump = {'apiVersion': 'v1', 'items': items, 'kind': 'List'}
+        # 没有 kind 的文档视为 List
+        no_kind = {'items': items}
+        expected = [obj, *items, *items]
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / 'a.json').write_text(''.join(json.dumps(doc) for doc in (obj, dump, no_kind)))
+            (tmp / 'b.yaml').write_text(yaml.safe_dump_all([obj, dump, no_kind]))
+            for path in (tmp / 'a.json', tmp / 'b.yaml'):
+                with self.subTest(path.name):
+                    self.assertEqual(list(loader.iter_config_file(path)), [(doc, loader.content_digest(doc))
+                                                                           for doc in expected])
+                    self.assertEqual(loader.load_document(path, 1), items[0])
+                    # 无法提前读取 kind 时整体读入 items
+                    if path.suffix == '.json':
+                        docs = loader.iter_json_documents(io.StringIO(path.read_text()))
+                    else:
+                        docs = loader.iter_yaml_documents(io.BytesIO(path.read_bytes()))
+                    self.assertEqual(list(docs), expected)
+
+            store = ObjectStore.from_config_dir(tmp)
+            self.assertEqual([obj.name for obj in store.search_by_kind('Inventory')], ['inv'])
+
+    def test_yaml_documents(self):
+        text = SA_TEMPLATE.format('a') + '''---
+defaults: &base {kind: Role, apiVersion: v1}
+<<: *base
+metadata: {name: sa-b}
+kind: ServiceAccount
+---
+kind: ConfigMapList
+items:
+- {kind: ConfigMap, metadata: {name: cm}}
+---
+[1, 2]
+---
+'''
+        expected = list(yaml.safe_load_all(text))
+        expected[2:3] = expected[2]['items']
+        self.assertEqual(list(loader.iter_yaml_documents(io.BytesIO(text.encode()))), expected)
+
+
+class TestDeduplicate(TestCase):
+
+    def test_duplicates_and_conflicts(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            role = {
+                'apiVersion': 'rbac.authorization.k8s.io/v1',
+                'kind': 'ClusterRole',
+                'metadata': {'name': 'shared'},
+                'rules': [{'apiGroups': [''], 'resources': ['pods'], 'verbs': ['get']}],
+            }
+            (tmp / 'a.yaml').write_text(yaml.safe_dump(role))
+            # key 顺序不同但内容相同
+            (tmp / 'b.json').write_text(json.dumps(dict(reversed(role.items()))))
+            (tmp / 'c.yaml').write_text(SA_TEMPLATE.format('x') + '---\n' + SA_TEMPLATE.format('x').replace(
+                'name: sa-x', 'name: sa-x\n  namespace: other'))
+            (tmp / 'd.yaml').write_text(SA_TEMPLATE.format('x').replace('name: sa-x', 'name: sa-x\n  labels: {a: b}'))
+
+            store = ObjectStore.from_config_dir(tmp)
+            role = store.search_by_kind_and_name('ClusterRole', 'shared')
+            self.assertEqual(role.source_paths, [tmp.absolute() / 'a.yaml', tmp.absolute() / 'b.json'])
+            self.assertEqual(len(store.objects), 4)
+
+            self.assertEqual(len(store.conflicts), 1)
+            conflict = store.conflicts[0]
+            self.assertEqual((conflict.kind, conflict.namespace, conflict.name), ('ServiceAccount', None, 'sa-x'))
+            self.assertEqual([obj.source_path.name for obj in conflict.objects], ['c.yaml', 'd.yaml'])
+
+            store = ObjectStore.from_config_dir(tmp, deduplicate=False)
+            self.assertEqual(len(store.objects), 5)
+            self.assertEqual(store.conflicts, [])
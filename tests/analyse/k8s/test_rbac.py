@@ -1,7 +1,14 @@
+import tempfile
+from pathlib import Path
 from unittest import TestCase
 
 from analyse.k8s import rbac
+from analyse.k8s.basic import ObjectStore
 from analyse.k8s.rbac import permission, PermissionScope
+from analyse.k8s.rbac.aggregation import AggregationGraph, strongly_connected_components
+from analyse.k8s.rbac.escalation import EscalationClosure
+from analyse.k8s.rbac.graph import RbacGraph
+from analyse.k8s.rbac.matrix import PermissionMatrix
 from tests import load_single_objs
 
 
@@ -139,6 +146,112 @@ class TestRole(TestCase):
                                              f"Role {case['role']} should not have permission {perm} in scope {scope}")
 
 
+def _can_i_by_rules(role, api_group, verb, resource, resource_name, scope) -> bool:
+    """逐条匹配规则的参考实现"""
+    for rule in role.list_rules(scope=scope):
+        norm_rule = rbac._normalize_rule(rule)
+        if norm_rule is None:
+            continue
+        if not all(rbac._check_rule(norm_rule, field, value) for field, value in
+                   (('apiGroups', api_group), ('resources', resource), ('verbs', verb))):
+            continue
+        if resource_name is not None and not rbac._check_rule(norm_rule, 'resourceNames', resource_name):
+            continue
+        return True
+    return False
+
+
+class TestRuleTable(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.store = load_single_objs()
+
+    def test_same_as_rules(self):
+        perms = sorted(permission.get_all_perms())
+        scopes = [None] + list(PermissionScope)
+        for role in self.store.search_by_kind('Role') + self.store.search_by_kind('ClusterRole'):
+            with self.subTest(role.name):
+                for perm in perms + [permission.Permission('pods', 'get', api_group=None)]:
+                    for scope in scopes:
+                        for resource_name in (None, 'test_container', 'agg-secret', 'not-exists'):
+                            self.assertEqual(
+                                _can_i_by_rules(role, perm.api_group, perm.verb, perm.resource, resource_name, scope),
+                                role.can_i(perm.api_group, perm.verb, perm.resource, resource_name, scope),
+                                f'{perm} {scope} {resource_name}')
+
+    def test_invalidate(self):
+        store = load_single_objs()
+        role = store.search_by_name('role-normal')[0]
+        self.assertTrue(role.can_i(api_group='', resource='pods', verb='get'))
+        self.assertIs(role.rule_table(), role.rule_table())
+
+        role.data['rules'] = []
+        self.assertTrue(role.can_i(api_group='', resource='pods', verb='get'))
+        store.invalidate()
+        self.assertFalse(role.can_i(api_group='', resource='pods', verb='get'))
+
+
+CYCLE_ROLE_TEMPLATE = '''apiVersion: rbac.authorization.k8s.io/v1
+kind: ClusterRole
+metadata:
+  name: cycle-{name}
+  labels:
+    example.com/aggregate-to-{name}: "true"
+aggregationRule:
+  clusterRoleSelectors:
+  - matchLabels:
+      example.com/aggregate-to-{target}: "true"
+rules:
+- apiGroups: [""]
+  resources: ["{resource}"]
+  verbs: ["get"]
+'''
+
+
+class TestAggregation(TestCase):
+
+    def test_strongly_connected_components(self):
+        edges = [[1], [2], [0, 3], [], [4]]
+        components = strongly_connected_components(edges)
+        self.assertEqual(sorted(sorted(c) for c in components), [[0, 1, 2], [3], [4]])
+        # 后继先于前驱
+        self.assertLess(components.index([3]), [sorted(c) for c in components].index([0, 1, 2]))
+
+    def test_aggregated_rules(self):
+        store = load_single_objs()
+        root = store.search_by_kind_and_name('ClusterRole', 'agg-root')
+        graph = store.cached('aggregation', AggregationGraph)
+        self.assertIs(graph, store.cached('aggregation', AggregationGraph))
+        self.assertEqual([r.name for r in graph.closure(root)], ['agg-child-pods', 'agg-child-secrets'])
+        self.assertEqual(graph.cycles, [])
+
+        self.assertTrue(root.can_i(api_group='', resource='pods', verb='list', strict_scope=PermissionScope.CLUSTER))
+        self.assertTrue(root.can_i(api_group='', resource='secrets', verb='create'))
+        # resource-specific 规则与 Role 都不会被聚合
+        self.assertFalse(root.can_i(api_group='', resource='secrets', verb='delete'))
+        self.assertEqual(root.list_rules(PermissionScope.RESOURCE_SPECIFIC), [])
+        self.assertFalse(root.can_i(api_group='', resource='configmaps', verb='get'))
+
+    def test_cycle(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            (tmp / 'a.yaml').write_text(CYCLE_ROLE_TEMPLATE.format(name='a', target='b', resource='pods'))
+            (tmp / 'b.yaml').write_text(CYCLE_ROLE_TEMPLATE.format(name='b', target='a', resource='secrets'))
+            (tmp / 'c.yaml').write_text(CYCLE_ROLE_TEMPLATE.format(name='c', target='c', resource='configmaps'))
+            store = ObjectStore.from_config_dir(tmp)
+
+            role_a = store.search_by_kind_and_name('ClusterRole', 'cycle-a')
+            self.assertTrue(role_a.can_i(api_group='', resource='secrets', verb='get'))
+            self.assertEqual(len(role_a.list_rules()), 2)
+            role_c = store.search_by_kind_and_name('ClusterRole', 'cycle-c')
+            self.assertEqual(len(role_c.list_rules()), 1)
+
+            graph = store.cached('aggregation', AggregationGraph)
+            self.assertEqual(sorted(graph.cycles), [['cycle-a', 'cycle-b'], ['cycle-c']])
+
+
 class TestServiceAccount(TestCase):
 
     def __init__(self, *args, **kwargs):
@@ -156,3 +269,89 @@ class TestServiceAccount(TestCase):
 
         self.assertTrue(sa.can_i(api_group='', resource='pods', verb='get'))
         self.assertTrue(sa.can_i(api_group='', resource='pods', verb='watch'))
+
+
+class TestRbacGraph(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.store = load_single_objs()
+
+    def test_intern_default_sa(self):
+        sa = rbac.get_service_account_by_name(self.store, 'default')
+        self.assertIs(sa, rbac.get_service_account_by_name(self.store, ''))
+        self.assertIsNot(sa, rbac.get_service_account_by_name(self.store, 'default', 'other'))
+        # 单独创建的默认 ServiceAccount 与驻留的对象共享节点
+        self.assertEqual(rbac.DefaultServiceAccount(self.store).find_roles(), sa.find_roles())
+
+    def test_sa_in_other_namespace(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            # ServiceAccount 显式指定了与工作负载不同的命名空间
+            (Path(tmp) / 'sa.yaml').write_text('''apiVersion: v1
+kind: ServiceAccount
+metadata:
+  name: operator
+  namespace: release-ns
+''')
+            store = ObjectStore.from_config_dir(Path(tmp))
+            sa = rbac.get_service_account_by_name(store, 'operator', 'release-ns')
+            self.assertEqual((sa.namespace, sa.name), ('release-ns', 'operator'))
+            # 不使用其他命名空间中的同名 ServiceAccount，而是工作负载所在命名空间的默认 ServiceAccount
+            sa = rbac.get_service_account_by_name(store, 'operator', 'default')
+            self.assertEqual((sa.namespace, sa.name), ('default', 'default'))
+            self.assertIs(sa, rbac.get_service_account_by_name(store, 'missing', 'default'))
+            # 未指定命名空间时按名称查找
+            sa = rbac.get_service_account_by_name(store, 'operator')
+            self.assertEqual((sa.namespace, sa.name), ('release-ns', 'operator'))
+
+    def test_lookups(self):
+        graph = self.store.cached('rbac', RbacGraph)
+        self.assertIs(graph, self.store.cached('rbac', RbacGraph))
+
+        sa = rbac.get_service_account_by_name(self.store, 'test_sa')
+        binds = sa.find_role_bindings()
+        self.assertEqual(binds, graph.bindings_of(sa))
+        self.assertEqual(sum((bind.find_role() for bind in binds), []), sa.find_roles())
+        for bind in binds:
+            self.assertEqual(bind.find_role(), bind.resolve_roles())
+
+        root = self.store.search_by_kind_and_name('ClusterRole', 'agg-root')
+        self.assertEqual([r.name for r in graph.aggregated_roles(root)], ['agg-child-pods', 'agg-child-secrets'])
+
+
+class TestEscalationClosure(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.store = ObjectStore.from_config_dir(
+            Path(__file__).parent / '..' / '..' / 'resources' / 'config_analyse' / 'escalation')
+        self.closure = EscalationClosure(self.store)
+
+    def sa(self, name: str, namespace: str):
+        return rbac.get_service_account_by_name(self.store, name, namespace)
+
+    def test_namespace_identity(self):
+        # 能在命名空间中创建 Pod 则能获得该命名空间中所有 ServiceAccount 的权限
+        deployer = self.sa('deployer', 'team-a')
+        reachable = {(sa.namespace, sa.name) for sa in self.closure.reachable(deployer)}
+        self.assertIn(('team-a', 'config-admin'), reachable)
+        self.assertNotIn(('team-b', 'service-admin'), reachable)
+        self.assertEqual(dict(self.closure.list_perms(deployer)), {
+            ('pods', 'create'): PermissionScope.NAMESPACE,
+            ('configmaps', 'update'): PermissionScope.NAMESPACE,
+        })
+
+    def test_transitive(self):
+        # 读取所有 secret 可以获得 escalator 的身份，进而获得任意权限
+        token_reader = self.sa('token-reader', 'team-b')
+        self.assertIn(self.sa('escalator', 'team-b'), self.closure.reachable(token_reader))
+        perms = dict(self.closure.list_perms(token_reader))
+        self.assertEqual(len(perms), len(PermissionMatrix().universe.keys))
+        self.assertTrue(all(scope == PermissionScope.CLUSTER for scope in perms.values()))
+
+    def test_no_escalation(self):
+        service_admin = self.sa('service-admin', 'team-b')
+        self.assertEqual(self.closure.reachable(service_admin), [])
+        self.assertEqual(self.closure.list_perms(service_admin), PermissionMatrix().list_perms(service_admin))
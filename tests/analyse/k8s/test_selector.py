@@ -0,0 +1,69 @@
+from unittest import TestCase
+
+from analyse.k8s.basic import Object, ObjectStore
+from analyse.k8s.selector import LabelSelector
+
+
+def _role(name: str, labels: dict, aggregation: list = None) -> dict:
+    data = {
+        'apiVersion': 'rbac.authorization.k8s.io/v1',
+        'kind': 'ClusterRole',
+        'metadata': {'name': name, 'labels': labels},
+        'rules': [{'apiGroups': [''], 'resources': [name], 'verbs': ['get']}],
+    }
+    if aggregation is not None:
+        data['aggregationRule'] = {'clusterRoleSelectors': aggregation}
+    return data
+
+
+class TestLabelSelector(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        objects = [Object.from_dict(data) for data in [
+            _role('a', {'tier': 'reader', 'team': 'x'}),
+            _role('b', {'tier': 'writer'}),
+            _role('c', {'team': 'y'}),
+            _role('d', {}),
+            _role('root', {}, aggregation=[
+                {'matchExpressions': [{'key': 'tier', 'operator': 'In', 'values': ['reader', 'writer']},
+                                      {'key': 'team', 'operator': 'NotIn', 'values': ['x']}]},
+                {'matchLabels': {'team': 'y'}, 'matchExpressions': [{'key': 'tier', 'operator': 'DoesNotExist'}]},
+            ]),
+        ]]
+        self.store = ObjectStore(objects)
+        for obj in objects:
+            obj.bind_store(self.store)
+
+    def assertSelect(self, selector: dict, names: list[str]):
+        compiled = LabelSelector.compile(selector)
+        self.assertEqual([r.name for r in self.store.find_by_selector(compiled, kind='ClusterRole')], names)
+        # 通过索引查找与逐个匹配的结果一致
+        self.assertEqual([r.name for r in self.store.search_by_kind('ClusterRole')
+                          if compiled.matches(r.data['metadata'].get('labels', None))], names)
+
+    def test_operators(self):
+        cases = [
+            ({'matchLabels': {'tier': 'reader'}}, ['a']),
+            ({'matchExpressions': [{'key': 'tier', 'operator': 'In', 'values': ['reader', 'writer']}]}, ['a', 'b']),
+            ({'matchExpressions': [{'key': 'tier', 'operator': 'NotIn', 'values': ['reader']}]},
+             ['b', 'c', 'd', 'root']),
+            ({'matchExpressions': [{'key': 'team', 'operator': 'Exists'}]}, ['a', 'c']),
+            ({'matchExpressions': [{'key': 'team', 'operator': 'DoesNotExist'}]}, ['b', 'd', 'root']),
+            ({'matchLabels': {'team': 'x'}, 'matchExpressions': [{'key': 'tier', 'operator': 'Exists'}]}, ['a']),
+            ({}, ['a', 'b', 'c', 'd', 'root']),
+        ]
+        for selector, names in cases:
+            with self.subTest(selector=selector):
+                self.assertSelect(selector, names)
+
+    def test_invalid_operator(self):
+        with self.assertRaises(ValueError):
+            LabelSelector.compile({'matchExpressions': [{'key': 'tier', 'operator': 'Gt', 'values': ['1']}]})
+
+    def test_aggregation(self):
+        root = self.store.search_by_kind_and_name('ClusterRole', 'root')
+        self.assertEqual([r.name for r in root.find_matched_aggregation_roles()], ['b', 'c'])
+        self.assertTrue(root.can_i(api_group='', resource='c', verb='get'))
+        self.assertFalse(root.can_i(api_group='', resource='a', verb='get'))
@@ -0,0 +1,48 @@
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+
+from analyse.k8s import snapshot
+from tests import load_single_objs
+
+
+def _count_bindings(name: str, sa_name: str) -> int:
+    store = snapshot.attach(name)
+    return len(store.find_bindings_by_subject('ServiceAccount', sa_name))
+
+
+class TestSnapshot(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.store = load_single_objs()
+
+    def assertStoreEqual(self, expected, actual):
+        self.assertEqual([o.identity for o in expected], [o.identity for o in actual])
+        self.assertEqual([o.digest for o in expected], [o.digest for o in actual])
+        self.assertEqual([type(o) for o in expected], [type(o) for o in actual])
+        self.assertTrue(all(o.store is actual for o in actual))
+        self.assertEqual([o.source_paths for o in expected], [o.source_paths for o in actual])
+        self.assertEqual([c.to_dict() for c in expected.conflicts], [c.to_dict() for c in actual.conflicts])
+        self.assertEqual(expected.find_by_labels({'rbac.example.com/aggregate-to-root': 'true'}),
+                         actual.find_by_labels({'rbac.example.com/aggregate-to-root': 'true'}))
+
+    def test_round_trip(self):
+        restored = snapshot.loads(snapshot.dumps(self.store))
+        self.assertStoreEqual(self.store, restored)
+        self.assertEqual(restored.search_by_name('test_sa')[0].find_roles(),
+                         self.store.search_by_name('test_sa')[0].find_roles())
+
+    def test_file(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'store.snapshot'
+            snapshot.save(self.store, path)
+            self.assertStoreEqual(self.store, snapshot.load(path))
+
+    def test_shared_memory(self):
+        with snapshot.SharedSnapshot(self.store) as shared:
+            with ProcessPoolExecutor(max_workers=2) as executor:
+                results = list(executor.map(_count_bindings, [shared.name] * 4, ['test_sa'] * 4))
+        self.assertEqual(results, [2] * 4)
@@ -3,8 +3,9 @@ from unittest import TestCase
 
 from tinydb.queries import Query
 
-from analyse.k8s.basic import Object
-from analyse.k8s.workload import Container, ContainerCarrier
+from analyse.k8s.basic import Object, ObjectStore
+from analyse.k8s.workload import Container, ContainerCarrier, find_pods_by_service_account, \
+    find_workloads_by_service_account
 from tests import load_single_objs
 
 
@@ -153,3 +154,55 @@ class TestContainerCarrier(TestCase):
                 pod = Object.from_dict(case['pod'])
                 self.assertIsInstance(pod, ContainerCarrier)
                 self.assertEqual(case['expected_sa'], pod.sa_name)
+
+
+class TestObjectModel(TestCase):
+    def test_compact(self):
+        store = load_single_objs()
+        for obj in store:
+            with self.subTest(f'{obj.kind} {obj.name}'):
+                self.assertFalse(hasattr(obj, '__dict__'), f'{type(obj).__name__} should use __slots__')
+
+        pod = store.search_by_name('test_container')[0]
+        self.assertIs(pod.containers(), pod.containers())
+        self.assertFalse(hasattr(pod.containers()[0], '__dict__'))
+
+    def test_interned(self):
+        store = load_single_objs()
+        roles = [store.search_by_name(name)[0] for name in ('role-normal', 'role-wildcard-verb')]
+        self.assertIs(roles[0].data['kind'], roles[1].data['kind'])
+        self.assertIs(roles[0].data['rules'][0]['resources'][0], roles[1].data['rules'][0]['resources'][0])
+
+
+class TestSharedServiceAccount(TestCase):
+
+    def test_default_sa_shared(self):
+        store = load_single_objs()
+        carriers = [obj for obj in store if isinstance(obj, ContainerCarrier) and obj.get_sa().name == 'default']
+        self.assertGreater(len(carriers), 1)
+        sas = {id(carrier.get_sa()) for carrier in carriers if carrier.namespace is None}
+        self.assertEqual(len(sas), 1)
+
+
+class TestFindByServiceAccount(TestCase):
+
+    def test_find(self):
+        def obj(kind, name, spec=None):
+            data = {'apiVersion': 'v1', 'kind': kind, 'metadata': {'name': name}}
+            if spec is not None:
+                data['spec'] = spec
+            return data
+
+        template = {'template': {'spec': {'serviceAccountName': 'operator', 'containers': []}}}
+        store = ObjectStore([Object.from_dict(data) for data in [
+            obj('Pod', 'pod', {'serviceAccountName': 'operator', 'containers': []}),
+            obj('Deployment', 'deploy', template),
+            # 与基线的查询一致，不限定 kind
+            obj('Rollout', 'rollout', template),
+            obj('CronJob', 'cron', {'jobTemplate': {'spec': template}}),
+            obj('Pod', 'other', {'serviceAccountName': 'other', 'containers': []}),
+            obj('ConfigMap', 'cm'),
+        ]])
+        self.assertEqual([o.name for o in find_pods_by_service_account(store, 'operator')], ['pod'])
+        self.assertEqual([o.name for o in find_workloads_by_service_account(store, 'operator')],
+                         ['deploy', 'rollout'])
@@ -0,0 +1,82 @@
+import sys
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from analyse.source.backend import CliServerBackend, ProcessBackend
+
+# 模拟 codeql 命令：echo 输出参数，fail 以非零值退出，两者都在 stderr 输出进度。cli-server 模式下按 NUL 分隔读取命令
+FAKE_CODEQL = f'''#!{sys.executable}
+import json, os, sys
+
+def execute(args):
+    sys.stderr.write(f'progress of {{args[0]}}\\n')
+    sys.stderr.flush()
+    if args[0] == 'fail':
+        sys.exit(3)
+    return f'{{os.getpid()}} {{" ".join(args)}}'.encode()
+
+if sys.argv[1:] == ['execute', 'cli-server']:
+    buffer = b''
+    while True:
+        chunk = os.read(0, 4096)
+        if not chunk:
+            break
+        buffer += chunk
+        while b'\\0' in buffer:
+            command, buffer = buffer.split(b'\\0', 1)
+            args = json.loads(command)
+            if args == ['shutdown']:
+                sys.exit(0)
+            sys.stdout.buffer.write(execute(args) + b'\\0')
+            sys.stdout.flush()
+else:
+    sys.stdout.buffer.write(execute(sys.argv[1:]))
+'''
+
+
+class TestBackend(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        self.binary = self.dir / 'codeql'
+        self.binary.write_text(FAKE_CODEQL)
+        self.binary.chmod(0o755)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _run(self, backend, *args) -> list[str]:
+        log_path = self.dir / 'out.log'
+        backend.run(list(args), log_path)
+        # stderr 与 stdout 都写入命令的日志
+        progress, output = log_path.read_text().split('\n', 1)
+        self.assertEqual(progress, f'progress of {args[0]}')
+        return output.split(' ', 1)
+
+    def test_process(self):
+        backend = ProcessBackend(str(self.binary))
+        first, second = self._run(backend, 'echo', 'a'), self._run(backend, 'echo', 'b')
+        self.assertEqual((first[1], second[1]), ('echo a', 'echo b'))
+        self.assertNotEqual(first[0], second[0])
+        with self.assertRaises(AssertionError):
+            backend.run(['fail'])
+
+    def test_cli_server(self):
+        with CliServerBackend(binary=str(self.binary), log_dir=self.dir) as backend:
+            first, second = self._run(backend, 'echo', 'a'), self._run(backend, 'echo', 'b')
+            self.assertEqual((first[1], second[1]), ('echo a', 'echo b'))
+            # 命令之间复用同一个进程
+            self.assertEqual(first[0], second[0])
+
+            # 命令失败后进程退出，下一个命令启动新的进程
+            with self.assertRaises(AssertionError):
+                backend.run(['fail'], self.dir / 'fail.log')
+            self.assertEqual((self.dir / 'fail.log').read_text(), 'progress of fail\n')
+            third = self._run(backend, 'echo', 'c')
+            self.assertEqual(third[1], 'echo c')
+            self.assertNotEqual(third[0], first[0])
+            self.assertEqual(backend.restarts, 1)
+        # 进程的日志中记录了每个命令
+        log = (self.dir / 'cli_server_1.log').read_text().splitlines()
+        self.assertEqual(log[:2], [f'==> codeql echo a > {self.dir / "out.log"}', 'progress of echo'])
@@ -0,0 +1,85 @@
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from unittest import TestCase
+from unittest import mock
+
+from analyse.source import codeql
+
+# 模拟 codeql 命令：run-queries 为每个查询写出 BQRS，bqrs decode 输出带源码前缀的 CSV
+FAKE_CODEQL = '''#!/bin/sh
+echo "$1 $2" >> "$FAKE_CODEQL_LOG"
+if [ "$1" = database ]; then
+  while [ "$1" != "--" ]; do shift; done
+  shift; db=$1; shift
+  for q in "$@"; do
+    out="$db/results/kaaass/k8s-app-scan/$(basename "$q" .ql).bqrs"
+    mkdir -p "$(dirname "$out")"
+    basename "$q" .ql > "$out"
+  done
+elif [ "$1" = bqrs ]; then
+  out=${5#--output=}
+  { echo "name,location"; echo "$(cat "$3"),/src/prefix/main.go:1"; } > "$out"
+fi
+'''
+
+
+class TestRunQueries(TestCase):
+    def test_run_queries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            binary = tmp / 'codeql'
+            binary.write_text(FAKE_CODEQL)
+            binary.chmod(0o755)
+            db_path = tmp / 'db'
+            (db_path / 'db-go').mkdir(parents=True)
+            (db_path / 'codeql-database.yml').write_text('sourceLocationPrefix: /src/prefix\n')
+            queries = [codeql.QUERY_REACHABLE_API_CALLS, codeql.QUERY_API_CALLS, codeql.QUERY_ENTRYPOINTS]
+            result_paths = [tmp / f'{query.name}.csv' for query in queries]
+            log_path = tmp / 'calls.log'
+
+            with mock.patch.object(codeql, 'CODEQL_BINARY', str(binary)), \
+                    mock.patch.dict(os.environ, {'FAKE_CODEQL_LOG': str(log_path)}):
+                for _ in range(2):
+                    codeql.run_queries(queries, db_path, tmp, tmp, result_paths, query_name='test')
+
+            # 只调用一次 run-queries，第二次直接使用缓存的 BQRS
+            calls = log_path.read_text().splitlines()
+            self.assertEqual(calls.count('database run-queries'), 1)
+            self.assertEqual(calls.count('bqrs decode'), 6)
+            for query, path in zip(queries, result_paths):
+                self.assertEqual(path.read_text().splitlines()[1], f'{query.path.stem},main.go:1')
+
+    def test_shared_db(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            binary = tmp / 'codeql'
+            # run-queries 较慢，使两个项目的调用重叠
+            fake = FAKE_CODEQL.replace('if [ "$1" = database ]; then', 'if [ "$1" = database ]; then\n  sleep 0.2')
+            binary.write_text(fake)
+            binary.chmod(0o755)
+            db_path = tmp / 'db'
+            (db_path / 'db-go').mkdir(parents=True)
+            (db_path / 'codeql-database.yml').write_text('sourceLocationPrefix: /src/prefix\n')
+            queries = [codeql.QUERY_REACHABLE_API_CALLS, codeql.QUERY_API_CALLS]
+            log_path = tmp / 'calls.log'
+
+            def run(proj):
+                proj_dir = tmp / proj
+                proj_dir.mkdir()
+                # 两个项目的 DB 链接到同一个目录
+                (proj_dir / 'db').symlink_to(db_path, target_is_directory=True)
+                codeql.run_queries(queries, proj_dir / 'db', proj_dir, proj_dir,
+                                   [proj_dir / f'{query.name}.csv' for query in queries], query_name=proj)
+
+            with mock.patch.object(codeql, 'CODEQL_BINARY', str(binary)), \
+                    mock.patch.dict(os.environ, {'FAKE_CODEQL_LOG': str(log_path)}):
+                with ThreadPoolExecutor(max_workers=2) as executor:
+                    for future in [executor.submit(run, proj) for proj in ('a', 'b')]:
+                        future.result()
+
+            for proj in ('a', 'b'):
+                for query in queries:
+                    result = (tmp / proj / f'{query.name}.csv').read_text().splitlines()[1]
+                    self.assertEqual(result, f'{query.path.stem},main.go:1')
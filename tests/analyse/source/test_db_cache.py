@@ -0,0 +1,87 @@
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+
+from analyse.source.backend import ProcessBackend
+from analyse.source.db_cache import DbCache, KEY_FILE
+
+# 模拟 codeql 命令：version 输出 $FAKE_VERSION 文件的内容，database create 创建 DB 目录并记录次数
+FAKE_CODEQL = '''#!/bin/sh
+dir=$(dirname "$0")
+if [ "$1" = version ]; then
+  cat "$dir/version"
+elif [ "$1" = database ] && [ "$2" = create ]; then
+  mkdir -p "$3/db-go"
+  echo "$3" >> "$dir/builds.log"
+fi
+'''
+
+
+class TestDbCache(TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.dir = Path(self.tmp.name)
+        binary = self.dir / 'codeql'
+        binary.write_text(FAKE_CODEQL)
+        binary.chmod(0o755)
+        (self.dir / 'version').write_text('2.15.0\n')
+        self.backend = ProcessBackend(str(binary))
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _source(self, proj: str, content: str) -> Path:
+        source = self.dir / proj / 'source' / 'operator'
+        source.mkdir(parents=True, exist_ok=True)
+        (source / 'main.go').write_text(content)
+        return source
+
+    def _builds(self) -> int:
+        log = self.dir / 'builds.log'
+        return len(log.read_text().splitlines()) if log.exists() else 0
+
+    def test_shared_across_projects(self):
+        cache = DbCache(self.dir / 'cache', self.backend)
+        links = []
+        for proj in ('a', 'b'):
+            source = self._source(proj, 'package main\n')
+            link = self.dir / proj / 'db' / 'operator'
+            link.parent.mkdir(parents=True)
+            self.assertTrue(cache.ensure(source, link, self.dir / f'{proj}.log'))
+            links.append(link)
+
+        self.assertEqual(self._builds(), 1)
+        self.assertEqual(links[0].resolve(), links[1].resolve())
+        self.assertTrue((links[0] / KEY_FILE).exists())
+        # 再次检查时 DB 没有变化
+        self.assertFalse(cache.ensure(self.dir / 'a' / 'source' / 'operator', links[0], self.dir / 'a.log'))
+
+    def test_rebuild_on_change(self):
+        cache = DbCache(self.dir / 'cache', self.backend)
+        source = self._source('a', 'package main\n')
+        link = self.dir / 'a' / 'db' / 'operator'
+        link.parent.mkdir(parents=True)
+        cache.ensure(source, link, self.dir / 'a.log')
+        first = link.resolve()
+
+        # 源码变化
+        self._source('a', 'package main\n\nfunc main() {}\n')
+        self.assertTrue(cache.ensure(source, link, self.dir / 'a.log'))
+        self.assertNotEqual(link.resolve(), first)
+
+        # CodeQL 版本变化
+        (self.dir / 'version').write_text('2.16.0\n')
+        cache = DbCache(self.dir / 'cache', self.backend)
+        self.assertTrue(cache.ensure(source, link, self.dir / 'a.log'))
+        self.assertEqual(self._builds(), 3)
+
+    def test_keep_db_in_project(self):
+        cache = DbCache(self.dir / 'cache', self.backend)
+        source = self._source('a', 'package main\n')
+        # 直接构建在项目中的 DB 不被删除或替换
+        db = self.dir / 'a' / 'db' / 'operator'
+        (db / 'db-go').mkdir(parents=True)
+        self.assertFalse(cache.ensure(source, db, self.dir / 'a.log'))
+        self.assertFalse(db.is_symlink())
+        self.assertTrue((db / 'db-go').exists())
+        self.assertEqual(self._builds(), 0)
@@ -0,0 +1,103 @@
+import os
+import tempfile
+import time
+from pathlib import Path
+from unittest import TestCase
+from unittest import mock
+
+from analyse.source import codeql
+from analyse.source.db_cache import KEY_FILE
+from analyse.source.result_cache import ResultCache, ResultKey, query_hash
+from tests.analyse.source.test_codeql import FAKE_CODEQL
+
+
+class TestQueryHash(TestCase):
+    def test_transitive_imports(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            root = Path(tmp)
+            (root / 'codeql-pack.yml').write_text('name: test/pack\n')
+            (root / 'lib' / 'internal').mkdir(parents=True)
+            query = root / 'query.ql'
+            query.write_text('import go\nimport lib.Api\n')
+            (root / 'lib' / 'Api.qll').write_text('import internal.Common\n')
+            (root / 'lib' / 'internal' / 'Common.qll').write_text('predicate p() { any() }\n')
+            (root / 'lib' / 'Other.qll').write_text('import go\n')
+
+            first = query_hash(query)
+            # 未被 import 的库变化不影响
+            (root / 'lib' / 'Other.qll').write_text('import go\n// changed\n')
+            self.assertEqual(query_hash(query), first)
+            # 传递 import 的库变化
+            (root / 'lib' / 'internal' / 'Common.qll').write_text('predicate p() { none() }\n')
+            self.assertNotEqual(query_hash(query), first)
+
+    def test_builtin_queries(self):
+        hashes = {query_hash(query.path) for query in
+                  (codeql.QUERY_REACHABLE_API_CALLS, codeql.QUERY_API_CALLS, codeql.QUERY_ENTRYPOINTS)}
+        self.assertEqual(len(hashes), 3)
+
+
+class TestResultCache(TestCase):
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            cache = ResultCache(tmp / 'cache')
+            cache.max_size = 25
+            keys = [ResultKey(f'q{i}', 'hash', 'db') for i in range(3)]
+            for i, key in enumerate(keys[:2]):
+                bqrs = tmp / f'{i}.bqrs'
+                bqrs.write_bytes(b'x' * 10)
+                cache.put(key, bqrs)
+                self.assertFalse(bqrs.exists())
+                time.sleep(0.01)
+            # 最近使用 q0 后，q1 最先被淘汰
+            self.assertIsNotNone(cache.get(keys[0]))
+            time.sleep(0.01)
+            bqrs = tmp / '2.bqrs'
+            bqrs.write_bytes(b'x' * 10)
+            cache.put(keys[2], bqrs)
+
+            self.assertIsNotNone(cache.get(keys[0]))
+            self.assertIsNone(cache.get(keys[1]))
+            self.assertIsNotNone(cache.get(keys[2]))
+            self.assertEqual(list((tmp / 'cache' / 'tmp').iterdir()), [])
+
+    def test_run_queries(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            tmp = Path(tmp)
+            binary = tmp / 'codeql'
+            binary.write_text(FAKE_CODEQL)
+            binary.chmod(0o755)
+            db_path = tmp / 'db'
+            (db_path / 'db-go').mkdir(parents=True)
+            (db_path / 'codeql-database.yml').write_text('sourceLocationPrefix: /src/prefix\n')
+            (db_path / KEY_FILE).write_text('{"tree": "v1"}')
+            cache = ResultCache(tmp / 'cache')
+            queries = [codeql.QUERY_REACHABLE_API_CALLS, codeql.QUERY_API_CALLS, codeql.QUERY_ENTRYPOINTS]
+            log_path = tmp / 'calls.log'
+
+            def run(proj):
+                result_paths = [tmp / proj / f'{query.name}.csv' for query in queries]
+                result_paths[0].parent.mkdir(exist_ok=True)
+                codeql.run_queries(queries, db_path, tmp, tmp, result_paths, query_name=proj, result_cache=cache)
+                return result_paths
+
+            def calls():
+                return log_path.read_text().splitlines() if log_path.exists() else []
+
+            with mock.patch.object(codeql, 'CODEQL_BINARY', str(binary)), \
+                    mock.patch.dict(os.environ, {'FAKE_CODEQL_LOG': str(log_path)}):
+                run('a')
+                self.assertEqual(calls().count('database run-queries'), 1)
+                # 结果未过期，不调用 CodeQL
+                run('a')
+                self.assertEqual(calls().count('bqrs decode'), 3)
+                # 其他项目使用相同的 DB，只需要解码
+                result_paths = run('b')
+                self.assertEqual(calls().count('database run-queries'), 1)
+                self.assertEqual(calls().count('bqrs decode'), 6)
+                self.assertEqual(result_paths[1].read_text().splitlines()[1], 'api_calls,main.go:1')
+                # DB 变化后重新执行
+                (db_path / KEY_FILE).write_text('{"tree": "v2"}')
+                run('a')
+                self.assertEqual(calls().count('database run-queries'), 2)
@@ -0,0 +1,70 @@
+import threading
+import time
+from unittest import TestCase
+
+from analyse.source.codeql import _resource_flags
+from analyse.source.scheduler import ResourceBudget, Resources, CodeQLScheduler
+
+
+class TestResourceBudget(TestCase):
+    def test_share(self):
+        budget = ResourceBudget(16, 32768, jobs=4)
+        self.assertEqual(budget.share, Resources(4, 8192))
+        self.assertEqual(_resource_flags(budget.share), ['--threads=4', '--ram=8192'])
+
+        # 默认的并发数受内存限制
+        self.assertEqual(ResourceBudget(16, 4096).jobs, 2)
+        # 并发数不超过线程数
+        self.assertEqual(ResourceBudget(2, 32768, jobs=8).share, Resources(1, 16384))
+
+    def test_acquire(self):
+        budget = ResourceBudget(4, 4096, jobs=2)
+        first = budget.acquire()
+        self.assertEqual(budget.free, Resources(2, 2048))
+        budget.release(first)
+        # 超出总预算的申请被截断
+        self.assertEqual(budget.acquire(Resources(1, 1 << 20)), Resources(1, 4096))
+        self.assertEqual(budget.free, Resources(3, 0))
+
+
+class TestCodeQLScheduler(TestCase):
+    def test_budget(self):
+        lock = threading.Lock()
+        running = [0, 0]
+
+        def job(resources):
+            with lock:
+                running[0] += 1
+                running[1] = max(running[1], running[0])
+            time.sleep(0.02)
+            with lock:
+                running[0] -= 1
+            return resources
+
+        with CodeQLScheduler(ResourceBudget(4, 8192, jobs=2)) as scheduler:
+            results = scheduler.wait([scheduler.submit(job) for _ in range(6)])
+        self.assertEqual(running[1], 2)
+        self.assertEqual(set(results), {Resources(2, 4096)})
+
+    def test_dependency(self):
+        order = []
+
+        def job(name, resources):
+            time.sleep(0.01)
+            order.append(name)
+
+        def fail(resources):
+            raise AssertionError('build failed')
+
+        with CodeQLScheduler(ResourceBudget(4, 8192, jobs=4)) as scheduler:
+            build = scheduler.submit(job, 'build')
+            queries = [scheduler.submit(job, f'query{i}', after=[build]) for i in range(3)]
+            scheduler.wait(queries)
+            self.assertEqual(order[0], 'build')
+            self.assertEqual(len(order), 4)
+
+            # 依赖失败时任务以相同的异常失败
+            failed = scheduler.submit(job, 'never', after=[scheduler.submit(fail)])
+            with self.assertRaises(AssertionError):
+                failed.result()
+            self.assertNotIn('never', order)
@@ -1,6 +1,9 @@
+import tempfile
 from unittest import TestCase
+from unittest import mock
 
 from modules.pod_source_match import *
+from modules.pod_source_match import _load_cache_matched_map, _save_cache_matched_map
 from modules.pod_source_match.rules import get_last_nontrivial_part
 from modules.storage import ProjectFolder
 
@@ -92,3 +95,27 @@ class TestPodSourceMatcher(TestCase):
         perms = pod_result.perms
         self.assertEqual(len(perms), 1)
         self.assertEqual(perms[0], EPScanPermission('pods', 'get', None))
+
+
+class TestMatchedMapCache(TestCase):
+
+    def test_stale_cache(self):
+        def pod_info(name):
+            pod = mock.Mock(kind='Deployment', namespace='default', digest=name + '-v1')
+            pod.name = name
+            return mock.Mock(get_pod=mock.Mock(return_value=pod))
+
+        pods = [pod_info('a'), pod_info('b')]
+        source = mock.Mock(source_name='operator', main_file_path=Path('cmd/main.go'))
+        matched_pod = {pod: [(source, MatchingRule('rule', None))] for pod in pods}
+        with tempfile.TemporaryDirectory() as tmp:
+            cache_path = Path(tmp) / 'matched_pod.json'
+            _save_cache_matched_map(cache_path, matched_pod)
+            loaded = _load_cache_matched_map(cache_path, pods, [source])
+            self.assertEqual(list(loaded.keys()), pods)
+
+            # Pod 被删除
+            self.assertIsNone(_load_cache_matched_map(cache_path, pods[:1], [source]))
+            # Pod 内容变化
+            pods[1].get_pod().digest = 'b-v2'
+            self.assertIsNone(_load_cache_matched_map(cache_path, pods, [source]))
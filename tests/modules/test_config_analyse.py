@@ -1,8 +1,13 @@
+import shutil
+import tempfile
 from pathlib import Path
 from unittest import TestCase
 
 from analyse.k8s.basic import ObjectStore
-from analyse.k8s.rbac import CLUSTER, NAMESPACE
+from analyse.k8s import rbac
+from analyse.k8s.rbac import CLUSTER, NAMESPACE, permission
+from analyse.k8s.rbac.matrix import get_store_universe, get_default_universe
+from analyse.k8s.rbac.memo import role_set_fingerprint
 from modules.config_analyse import *
 from modules.types import EPScanPermission
 from tests import load_single_objs
@@ -96,6 +101,258 @@ class TestPodPermAnalyser(TestCase):
                           EPScanPermission('customresourcedefinitions', 'list', CLUSTER)}
         self.assertEqual(expected_perms, perms)
 
+    def test_multi_namespace(self):
+        store = ObjectStore.from_config_dir(BASE_PATH / 'multi_namespace')
+
+        ppa = PodPermAnalyser()
+        results = ppa.analyse(store)
+        self.assertEqual(len(results), 2)
+
+        perms = {result.pod.namespace: set(result.perms) for result in results}
+        self.assertEqual({'tenant-a': {EPScanPermission('configmaps', 'get', NAMESPACE)},
+                          'tenant-b': {EPScanPermission('secrets', 'get', NAMESPACE)}}, perms)
+
+    def test_escalation(self):
+        store = ObjectStore.from_config_dir(BASE_PATH / 'escalation')
+
+        results = PodPermAnalyser().analyse(store)
+        self.assertEqual(set(results[0].perms), {EPScanPermission('pods', 'create', NAMESPACE)})
+
+        results = PodPermAnalyser(escalation=True).analyse(store)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(set(results[0].perms), {EPScanPermission('pods', 'create', NAMESPACE),
+                                                 EPScanPermission('configmaps', 'update', NAMESPACE)})
+
+    def test_crd(self):
+        store = ObjectStore.from_config_dir(BASE_PATH / 'crd')
+
+        results = PodPermAnalyser().analyse(store)
+        self.assertEqual(len(results), 1)
+        self.assertEqual(set(results[0].perms), {EPScanPermission('widgets', verb, CLUSTER)
+                                                 for verb in ('get', 'list', 'watch', 'update')}
+                         | {EPScanPermission('configmaps', 'get', CLUSTER)})
+
+        # 不含 CRD 的全集中看不到自定义资源
+        results = PodPermAnalyser(universe=get_default_universe()).analyse(store)
+        self.assertEqual(set(results[0].perms), {EPScanPermission('configmaps', 'get', CLUSTER)})
+
+
+class TestIncrementalPodPermAnalyser(TestCase):
+
+    def _assert_same_as_full(self, update, store):
+        expected = {(r.pod.namespace, r.pod.name): set(r.perms) for r in PodPermAnalyser().analyse(store)}
+        self.assertEqual(expected, {(r.pod.namespace, r.pod.name): set(r.perms) for r in update.results})
+
+    def test_role_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf = Path(tmp) / 'conf'
+            shutil.copytree(BASE_PATH / 'multi_namespace', conf)
+            ipa = IncrementalPodPermAnalyser()
+            ipa.analyse(ObjectStore.from_config_dir(conf))
+
+            # 没有变化时不重新计算
+            update = ipa.update(ObjectStore.from_config_dir(conf))
+            self.assertEqual((update.changed, update.removed), ([], []))
+
+            # 只有 tenant-a 中的 Pod 受影响
+            path = conf / 'tenant-a.yaml'
+            path.write_text(path.read_text().replace('verbs: ["get"]', 'verbs: ["get", "list"]'))
+            store = ObjectStore.from_config_dir(conf)
+            update = ipa.update(store)
+            self.assertEqual([r.pod.namespace for r in update.changed], ['tenant-a'])
+            self.assertIn(EPScanPermission('configmaps', 'list', NAMESPACE), update.changed[0].perms)
+            self._assert_same_as_full(update, store)
+
+            # 删除工作负载
+            (conf / 'tenant-b.yaml').unlink()
+            update = ipa.update(ObjectStore.from_config_dir(conf))
+            self.assertEqual(update.changed, [])
+            self.assertEqual([pod.namespace for pod in update.removed], ['tenant-b'])
+            self.assertEqual(len(update.results), 1)
+
+    def test_pod_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf = Path(tmp) / 'conf'
+            shutil.copytree(BASE_PATH / 'multi_namespace', conf)
+            ipa = IncrementalPodPermAnalyser()
+            old = {r.pod.namespace: r.pod for r in ipa.analyse(ObjectStore.from_config_dir(conf))}
+
+            # 内容变化的 Pod 被新版本替换，旧版本计入 removed
+            path = conf / 'tenant-a.yaml'
+            path.write_text(path.read_text().replace('nginx:1.14.2', 'nginx:1.16.0'))
+            store = ObjectStore.from_config_dir(conf)
+            update = ipa.update(store)
+            self.assertEqual([r.pod.namespace for r in update.changed], ['tenant-a'])
+            self.assertEqual(update.removed, [old['tenant-a']])
+            self.assertNotIn(old['tenant-a'], [r.pod for r in update.results])
+            self._assert_same_as_full(update, store)
+
+    def test_requested_sa_added(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf = Path(tmp) / 'conf'
+            shutil.copytree(BASE_PATH / 'multi_namespace', conf)
+            path = conf / 'tenant-a.yaml'
+            sa, rest = path.read_text().split('---\n', 1)
+            path.write_text(rest)
+            ipa = IncrementalPodPermAnalyser()
+            ipa.analyse(ObjectStore.from_config_dir(conf))
+
+            # tenant-a 中加入 Pod 请求的 ServiceAccount 后，Pod 需要重新计算
+            path.write_text(sa + '---\n' + rest)
+            store = ObjectStore.from_config_dir(conf)
+            update = ipa.update(store)
+            self.assertEqual([r.pod.namespace for r in update.changed], ['tenant-a'])
+            self.assertNotIn(EPScanPermission('secrets', 'get', NAMESPACE), update.changed[0].perms)
+            self._assert_same_as_full(update, store)
+
+    def test_aggregation_changed(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            conf = Path(tmp) / 'conf'
+            shutil.copytree(BASE_PATH / 'multi_namespace', conf)
+            (conf / 'viewer.yaml').write_text('''
+apiVersion: rbac.authorization.k8s.io/v1
+kind: ClusterRole
+metadata:
+  name: viewer
+aggregationRule:
+  clusterRoleSelectors:
+  - matchLabels:
+      example.com/aggregate-to-viewer: "true"
+rules: []
+---
+apiVersion: rbac.authorization.k8s.io/v1
+kind: RoleBinding
+metadata:
+  name: viewer
+  namespace: tenant-b
+roleRef:
+  apiGroup: rbac.authorization.k8s.io
+  kind: ClusterRole
+  name: viewer
+subjects:
+- kind: ServiceAccount
+  name: app
+  namespace: tenant-b
+''')
+            ipa = IncrementalPodPermAnalyser()
+            ipa.analyse(ObjectStore.from_config_dir(conf))
+
+            # 新的 ClusterRole 被聚合选择器匹配，只影响绑定了 viewer 的 ServiceAccount
+            (conf / 'pods-viewer.yaml').write_text('''
+apiVersion: rbac.authorization.k8s.io/v1
+kind: ClusterRole
+metadata:
+  name: pods-viewer
+  labels:
+    example.com/aggregate-to-viewer: "true"
+rules:
+- apiGroups: [""]
+  resources: ["pods"]
+  verbs: ["list"]
+''')
+            store = ObjectStore.from_config_dir(conf)
+            update = ipa.update(store)
+            self.assertEqual([r.pod.namespace for r in update.changed], ['tenant-b'])
+            self.assertIn(('pods', 'list'), [p.get_deduplicate_key() for p in update.changed[0].perms])
+            self._assert_same_as_full(update, store)
+
+
+class TestPermissionUniverse(TestCase):
+
+    def test_crd_perms(self):
+        store = ObjectStore.from_config_dir(BASE_PATH / 'crd', projected=True)
+        crd = store.search_by_kind('CustomResourceDefinition')[0]
+        # 未提供服务的版本不产生权限
+        self.assertEqual({(p.api_group, p.api_version) for p in crd.permissions()}, {('example.com', 'v1')})
+        self.assertEqual(len(get_store_universe(store)), len(get_default_universe()) + 8)
+
+    def test_universe_cache(self):
+        store = ObjectStore.from_config_dir(BASE_PATH / 'crd')
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = UniverseCache(Path(tmp) / 'universe.pickle')
+            universe = get_store_universe(store, cache=cache)
+            self.assertTrue(cache.path.exists())
+
+            cached = get_store_universe(store, cache=cache)
+            self.assertIsNot(universe, cached)
+            self.assertEqual(universe.fingerprint, cached.fingerprint)
+            self.assertEqual(universe.perms_of_key('widgets', 'get'), cached.perms_of_key('widgets', 'get'))
+
+            # 来源变化时重新构建
+            other = get_store_universe(ObjectStore.from_config_dir(BASE_PATH / 'normal'), cache=cache)
+            self.assertEqual(other.fingerprint, get_default_universe().fingerprint)
+
+    def test_k8s_version(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            data_dir = Path(tmp)
+            (data_dir / 'all_perm.csv').touch()
+            (data_dir / 'all_perm-1.28.csv').touch()
+            self.assertEqual(permission.all_perms_csv('v1.28.3', data_dir), data_dir / 'all_perm-1.28.csv')
+            self.assertEqual(permission.all_perms_csv('1.28', data_dir), data_dir / 'all_perm-1.28.csv')
+            self.assertEqual(permission.all_perms_csv('1.20', data_dir), data_dir / 'all_perm.csv')
+            with self.assertRaises(AssertionError):
+                permission.all_perms_csv('latest', data_dir)
+
+        # 内置的 1.30 快照
+        self.assertEqual(permission.all_perms_csv('v1.30.2').name, 'all_perm-1.30.csv')
+        perms = permission.get_all_perms('1.30')
+        self.assertIn(permission.Permission('validatingadmissionpolicies', 'create', 'admissionregistration.k8s.io',
+                                            'v1'), perms)
+        self.assertNotIn(('validatingadmissionpolicies', 'create'), {(p.resource, p.verb) for p in get_all_perms()})
+        universe = get_default_universe('1.30')
+        self.assertIn(('validatingadmissionpolicies', 'create'), universe.keys)
+        self.assertNotIn(('helmcharts', 'create'), universe.keys)
+
+
+class TestPermissionMemo(TestCase):
+
+    def test_shared_across_stores(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            memo_path = Path(tmp) / 'memo.pickle'
+            memo = PermissionMemo(memo_path)
+            expected = PodPermAnalyser().analyse(ObjectStore.from_config_dir(BASE_PATH / 'normal'))
+
+            results = PodPermAnalyser(memo=memo).analyse(ObjectStore.from_config_dir(BASE_PATH / 'normal'))
+            self.assertEqual((memo.hits, memo.misses), (0, 1))
+            memo.save()
+
+            # 另一个 store 中内容相同的 Role 集合直接命中，缓存可以跨进程持久化
+            memo = PermissionMemo(memo_path)
+            self.assertEqual(len(memo), 1)
+            results_cached = PodPermAnalyser(memo=memo).analyse(ObjectStore.from_config_dir(BASE_PATH / 'normal'))
+            self.assertEqual((memo.hits, memo.misses), (1, 0))
+
+            for results in (results, results_cached):
+                self.assertEqual([set(r.perms) for r in expected], [set(r.perms) for r in results])
+
+    def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            memo_path = Path(tmp) / 'memo.pickle'
+            memo = PermissionMemo(memo_path, max_entries=2)
+            memo.put('a', 1)
+            memo.put('b', 2)
+            # 最近使用 a 后，b 最先被淘汰
+            self.assertEqual(memo.lookup('a'), 1)
+            memo.put('c', 3)
+            self.assertEqual(len(memo), 2)
+            self.assertIsNone(memo.lookup('b'))
+            memo.save()
+
+            # 持久化时保留使用顺序，加载时按新的上限淘汰
+            memo = PermissionMemo(memo_path, max_entries=1)
+            self.assertEqual((memo.lookup('a'), memo.lookup('c')), (None, 3))
+
+    def test_fingerprint(self):
+        store = load_single_objs()
+        universe = PermissionMatrix().universe
+        sa = rbac.get_service_account_by_name(store, 'test_sa')
+        default_sa = rbac.get_service_account_by_name(store, 'default')
+        self.assertEqual(role_set_fingerprint(sa, universe.fingerprint),
+                         role_set_fingerprint(load_single_objs().search_by_name('test_sa')[0], universe.fingerprint))
+        self.assertNotEqual(role_set_fingerprint(sa, universe.fingerprint),
+                            role_set_fingerprint(default_sa, universe.fingerprint))
+        self.assertNotEqual(role_set_fingerprint(sa, universe.fingerprint), role_set_fingerprint(sa, 'other'))
+
 
 class TestUtils(TestCase):
     def __init__(self, *args, **kwargs):
@@ -115,3 +372,14 @@ class TestUtils(TestCase):
         self.assertIn(EPScanPermission('pods', 'patch', PermissionScope.CLUSTER), perms)
         self.assertIn(EPScanPermission('pods', 'update', PermissionScope.CLUSTER), perms)
         self.assertIn(EPScanPermission('deployments', 'get', PermissionScope.RESOURCE_SPECIFIC), perms)
+
+    def test_matrix_same_as_list_all_perms(self):
+        stores = [self.store] + [ObjectStore.from_config_dir(path) for path in sorted(BASE_PATH.iterdir())]
+        for store in stores:
+            matrix = PermissionMatrix()
+            sas = store.search_by_kind('ServiceAccount') + [rbac.get_service_account_by_name(store, 'default')]
+            for sa in sas:
+                with self.subTest(sa.name):
+                    perms = list_all_perms_by_matrix(sa, matrix)
+                    self.assertEqual(len(perms), len(set(perms)))
+                    self.assertEqual(set(list_all_perms(sa)), set(perms))
@@ -96,3 +96,40 @@ class TestPermComparer(TestCase):
             pprint(issues)
             self.assertEqual(2, len(issues))
             self.assertIn(p2, issues[0].objects + issues[1].objects)
+
+    def test_update(self):
+        p = mk_pod('pod1')
+        p2 = mk_pod('pod2')
+        lf = [pret(p, [perm('pods', 'patch', NAMESPACE)]),
+              pret(p2, [perm('pods', 'get', NAMESPACE)])]
+        rt = [pret(p, [perm('pods', 'get', None)]),
+              pret(p2, [perm('pods', 'get', None)])]
+
+        pc = PermComparer(lf, rt)
+        self.assertEqual(1, len(pc.scan_ep()))
+
+        # 只重新检查变化的 Pod
+        issues = pc.update([pret(p2, [perm('pods', 'get', NAMESPACE), perm('pods', 'patch', NAMESPACE)])])
+        self.assertEqual(2, len(issues))
+        self.assertEqual({p, p2}, {issue.objects[0] for issue in issues})
+
+        issues = pc.update([], removed=[p])
+        self.assertEqual(1, len(issues))
+        self.assertEqual(p2, issues[0].objects[0])
+
+    def test_update_changed_pod(self):
+        p = mk_pod('pod1')
+        lf = [pret(p, [perm('pods', 'patch', NAMESPACE)])]
+        rt = [pret(p, [perm('pods', 'get', None)])]
+        pc = PermComparer(lf, rt)
+        self.assertEqual(1, len(pc.scan_ep()))
+
+        # Pod 内容变化，旧版本在 removed 中
+        p2 = ContainerCarrier({**p.data, 'spec': {'containers': [{'name': 'app', 'image': 'app:v2'}]}})
+        issues = pc.update([pret(p2, [perm('pods', 'patch', NAMESPACE)])], removed=[p])
+        self.assertEqual([p2], [issue.objects[0] for issue in issues])
+
+        # 不再持有敏感权限后没有问题
+        p3 = ContainerCarrier({**p.data, 'spec': {'containers': [{'name': 'app', 'image': 'app:v3'}]}})
+        issues = pc.update([pret(p3, [perm('pods', 'get', NAMESPACE)])], removed=[p2])
+        self.assertEqual([], issues)
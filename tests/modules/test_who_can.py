@@ -0,0 +1,77 @@
+import shutil
+import tempfile
+from pathlib import Path
+from unittest import TestCase
+from unittest import mock
+
+from analyse.k8s.basic import ObjectStore
+from analyse.k8s.rbac import CLUSTER, NAMESPACE, RESOURCE_SPECIFIC
+from modules.config_analyse import PodPermAnalyser
+from modules.perm_compare import PermComparer, permission
+from modules.storage import ProjectFolder
+from modules.types import EPScanPermission, PodResult
+from modules.who_can import WhoCanIndex
+
+BASE_PATH = Path(__file__).parent / '..' / 'resources' / 'config_analyse'
+
+
+class TestWhoCanIndex(TestCase):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.results = PodPermAnalyser().analyse(ObjectStore.from_config_dir(BASE_PATH / 'normal'))
+        self.index = WhoCanIndex.from_results(self.results)
+
+    def test_query(self):
+        entries = self.index.query('events', 'list')
+        self.assertEqual([(e.name, e.service_account, e.scope) for e in entries],
+                         [('nginx-deployment', 'example-service-account', CLUSTER)])
+        self.assertEqual(len(self.index.query('pods', 'get', min_scope=NAMESPACE)), 1)
+        self.assertEqual(self.index.query('pods', 'get', min_scope=CLUSTER), [])
+        self.assertEqual(self.index.query('pods', 'delete'), [])
+        self.assertEqual(self.index.service_accounts('secrets', 'get'), [(None, 'example-service-account')])
+
+    def test_save_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = Path(tmp) / 'who_can.json'
+            self.index.save(path)
+            loaded = WhoCanIndex.load(path)
+        for resource, verb in (('events', 'list'), ('pods', 'get'), ('deployments', 'create')):
+            for scope in (None, CLUSTER, NAMESPACE):
+                self.assertEqual(self.index.query(resource, verb, scope), loaded.query(resource, verb, scope))
+
+    def test_rebuild_on_config_change(self):
+        import ep_scan
+
+        with tempfile.TemporaryDirectory() as tmp:
+            proj = ProjectFolder(Path(tmp))
+            conf = proj.project('app', no_check=True) / 'conf'
+            shutil.copytree(BASE_PATH / 'multi_namespace', conf)
+            index = ep_scan.load_who_can(proj, 'app')
+            self.assertEqual(index.service_accounts('secrets', 'get'), [('tenant-b', 'app')])
+            # 配置没有变化时使用保存的索引
+            with mock.patch.object(WhoCanIndex, 'from_results', side_effect=AssertionError):
+                ep_scan.load_who_can(proj, 'app')
+
+            # 配置变化后重新构建
+            path = conf / 'tenant-a.yaml'
+            path.write_text(path.read_text().replace('configmaps', 'secrets'))
+            index = ep_scan.load_who_can(proj, 'app')
+            self.assertEqual(index.service_accounts('secrets', 'get'), [('tenant-a', 'app'), ('tenant-b', 'app')])
+
+    def test_perm_comparer(self):
+        sensitive = {
+            ('secrets', 'get'): EPScanPermission('secrets', 'get', NAMESPACE),
+            ('events', 'list'): EPScanPermission('events', 'list', CLUSTER),
+            ('pods', 'get'): EPScanPermission('pods', 'get', CLUSTER),
+            ('deployments', 'create'): EPScanPermission('deployments', 'create', RESOURCE_SPECIFIC),
+        }
+        pod = self.results[0].pod
+        rt = [PodResult(pod, [EPScanPermission('deployments', 'create', None)])]
+        with mock.patch.object(permission, 'get_sensitive_perm_lookup_map', return_value=sensitive):
+            expected = PermComparer(self.results, rt).scan_ep()
+            actual = PermComparer(self.results, rt, who_can=self.index).scan_ep()
+        self.assertEqual(len(expected), 1)
+        self.assertEqual(sorted(expected[0].reasons), sorted(actual[0].reasons))
+        self.assertEqual(len(actual[0].reasons), 2)
@@ -0,0 +1,43 @@
+import io
+import json
+from unittest import TestCase
+
+from analyse.k8s.loader import iter_json_documents
+from utils.json_stream import JsonStream
+
+
+def sa(name):
+    return {'apiVersion': 'v1', 'kind': 'ServiceAccount', 'metadata': {'name': name, 'labels': {'n': 12345}}}
+
+
+class TestJsonStream(TestCase):
+
+    def test_iter_array(self):
+        data = [sa(str(i)) for i in range(50)] + [1.5, 'str', None, [], {}]
+        for chunk_size in (1, 7, 1 << 20):
+            with self.subTest(chunk_size=chunk_size):
+                stream = JsonStream(io.StringIO(json.dumps(data, indent=2)), chunk_size=chunk_size)
+                self.assertEqual(list(stream.iter_array()), data)
+
+    def test_number_at_chunk_boundary(self):
+        stream = JsonStream(io.StringIO('[123456, 7]'), chunk_size=4)
+        self.assertEqual(list(stream.iter_array()), [123456, 7])
+
+    def test_list_documents(self):
+        items = [sa(str(i)) for i in range(20)]
+        cases = {
+            'kubectl list': {'apiVersion': 'v1', 'items': items, 'kind': 'List', 'metadata': {}},
+            'typed list': {'kind': 'ServiceAccountList', 'apiVersion': 'v1', 'items': items},
+            'top-level array': items,
+        }
+        for name, doc in cases.items():
+            with self.subTest(name):
+                self.assertEqual(list(iter_json_documents(io.StringIO(json.dumps(doc)))), items)
+
+        with self.subTest('concatenated'):
+            text = json.dumps(items[0]) + '\n' + json.dumps(cases['kubectl list'])
+            self.assertEqual(list(iter_json_documents(io.StringIO(text))), items[:1] + items)
+
+        with self.subTest('not a list'):
+            doc = {'kind': 'Foo', 'items': [1, 2]}
+            self.assertEqual(list(iter_json_documents(io.StringIO(json.dumps(doc)))), [doc])
@@ -0,0 +1,107 @@
+# json_stream.py -- 增量 JSON 解析，用于流式读取较大的 List 文档
+#
+# Copyright (C) 2024 KAAAsS
+import json
+from typing import Iterator, TextIO, Any
+
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',]}'
+
+
+class JsonStream:
+    """
+    按块读取文件的 JSON 词法流。容器的边界（{、[、:、,）由本类处理，叶子值交给 json 的 C 实现解析，
+    因此内存中只需要保留当前正在解析的值
+    """
+
+    def __init__(self, f: TextIO, chunk_size: int = 1 << 20):
+        self._f = f
+        self._chunk_size = chunk_size
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+        self._decoder = json.JSONDecoder()
+
+    def _fill(self) -> bool:
+        """读入更多数据，已到文件末尾时返回 False"""
+        if self._eof:
+            return False
+        chunk = self._f.read(self._chunk_size)
+        if not chunk:
+            self._eof = True
+            return False
+        self._buf = self._buf[self._pos:] + chunk
+        self._pos = 0
+        return True
+
+    def peek(self) -> str:
+        """跳过空白并返回下一个字符，文件结束时返回空串"""
+        while True:
+            while self._pos < len(self._buf) and self._buf[self._pos] in _WHITESPACE:
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            if not self._fill():
+                return ''
+
+    def expect(self, ch: str):
+        actual = self.peek()
+        if actual != ch:
+            raise ValueError(f'Expect {ch!r} but got {actual!r} in JSON stream')
+        self._pos += 1
+
+    def value(self) -> Any:
+        """解析一个完整的 JSON 值"""
+        self.peek()
+        while True:
+            try:
+                obj, end = self._decoder.raw_decode(self._buf, self._pos)
+            except json.JSONDecodeError:
+                # 值被截断在块的末尾，读入更多数据后重试
+                if not self._fill():
+                    raise
+                continue
+            if self._is_truncated_number(obj, end) and self._fill():
+                # 数字不是自界定的，可能恰好在块末尾被截断，需要读入更多数据后重新解析
+                continue
+            self._pos = end
+            return obj
+
+    def _is_truncated_number(self, obj, end: int) -> bool:
+        if not isinstance(obj, (int, float)) or isinstance(obj, bool):
+            return False
+        return end == len(self._buf) or self._buf[end] not in _DELIMITERS
+
+    def iter_array(self) -> Iterator:
+        """逐个解析数组中的元素"""
+        self.expect('[')
+        if self.peek() == ']':
+            self._pos += 1
+            return
+        while True:
+            yield self.value()
+            ch = self.peek()
+            self._pos += 1
+            if ch == ']':
+                return
+            if ch != ',':
+                raise ValueError(f'Expect \',\' or \']\' but got {ch!r} in JSON stream')
+
+    def iter_object(self) -> Iterator[str]:
+        """
+        逐个返回对象中的键，调用者需要在下一次迭代前通过 value() 等方法消费对应的值
+        """
+        self.expect('{')
+        if self.peek() == '}':
+            self._pos += 1
+            return
+        while True:
+            key = self.value()
+            self.expect(':')
+            yield key
+            ch = self.peek()
+            self._pos += 1
+            if ch == '}':
+                return
+            if ch != ',':
+                raise ValueError(f'Expect \',\' or \'}}\' but got {ch!r} in JSON stream')
@@ -0,0 +1,128 @@
+# yaml_stream.py -- 基于事件的 YAML 解析，用于流式读取较大的 List 文档
+#
+# Copyright (C) 2024 KAAAsS
+from typing import Iterator, BinaryIO, Any
+
+import yaml
+from yaml import events, nodes
+
+_MERGE_TAG = 'tag:yaml.org,2002:merge'
+
+
+class MergeKey:
+    """映射中的合并键 `<<`，其值为需要合并的映射或映射列表"""
+
+    def __repr__(self):
+        return '<<'
+
+
+MERGE_KEY = MergeKey()
+
+
+class YamlStream:
+    """
+    YAML 事件流。文档与容器的边界由本类处理，叶子值由事件组装为节点后交给 loader 的 constructor 构造，
+    因此内存中只需要保留当前正在解析的值（以及带锚点的节点）
+    """
+
+    def __init__(self, f: BinaryIO, loader_cls=yaml.SafeLoader):
+        self._loader = loader_cls(f)
+        # 当前文档中带锚点的节点
+        self._anchors: dict[str, nodes.Node] = {}
+        self._loader.get_event()  # StreamStart
+
+    def close(self):
+        self._loader.dispose()
+
+    def next_document(self) -> bool:
+        """进入下一个文档，没有更多文档时返回 False。文档的内容是一个值，消费后需要调用 end_document"""
+        if self._loader.check_event(events.StreamEndEvent):
+            return False
+        self._loader.get_event()  # DocumentStart
+        self._anchors = {}
+        return True
+
+    def end_document(self):
+        self._loader.get_event()  # DocumentEnd
+
+    def peek(self) -> str:
+        """
+        下一个值的类型：'mapping' 或 'sequence' 表示可以通过 iter_mapping 或 iter_sequence 逐个解析，
+        带锚点或显式标签的容器以及标量为 'value'，只能通过 value() 整体解析
+        """
+        event = self._loader.peek_event()
+        if isinstance(event, (events.MappingStartEvent, events.SequenceStartEvent)) \
+                and event.anchor is None and event.implicit:
+            return 'mapping' if isinstance(event, events.MappingStartEvent) else 'sequence'
+        return 'value'
+
+    def value(self) -> Any:
+        """解析一个完整的值"""
+        return self._loader.construct_document(self._compose())
+
+    def skip(self):
+        """跳过一个值，不组装节点，其中的锚点不会被记录"""
+        depth = 0
+        while True:
+            event = self._loader.get_event()
+            if isinstance(event, (events.MappingStartEvent, events.SequenceStartEvent)):
+                depth += 1
+            elif isinstance(event, (events.MappingEndEvent, events.SequenceEndEvent)):
+                depth -= 1
+            if depth == 0:
+                return
+
+    def iter_sequence(self) -> Iterator:
+        """逐个解析序列中的元素"""
+        self._loader.get_event()  # SequenceStart
+        while not self._loader.check_event(events.SequenceEndEvent):
+            yield self.value()
+        self._loader.get_event()
+
+    def iter_mapping(self) -> Iterator:
+        """
+        逐个返回映射中的键，调用者需要在下一次迭代前通过 value() 等方法消费对应的值。合并键返回 MERGE_KEY
+        """
+        self._loader.get_event()  # MappingStart
+        while not self._loader.check_event(events.MappingEndEvent):
+            key = self._compose()
+            yield MERGE_KEY if key.tag == _MERGE_TAG else self._loader.construct_document(key)
+        self._loader.get_event()
+
+    def _compose(self) -> nodes.Node:
+        """由事件组装一个节点，与 yaml.composer.Composer 相同"""
+        loader = self._loader
+        event = loader.get_event()
+        if isinstance(event, events.AliasEvent):
+            if event.anchor not in self._anchors:
+                raise yaml.composer.ComposerError(None, None, f'found undefined alias {event.anchor!r}',
+                                                  event.start_mark)
+            return self._anchors[event.anchor]
+
+        if isinstance(event, events.ScalarEvent):
+            tag = event.tag
+            if tag is None or tag == '!':
+                tag = loader.resolve(nodes.ScalarNode, event.value, event.implicit)
+            node = nodes.ScalarNode(tag, event.value, event.start_mark, event.end_mark, style=event.style)
+            if event.anchor is not None:
+                self._anchors[event.anchor] = node
+            return node
+
+        if isinstance(event, events.SequenceStartEvent):
+            node_cls, end_cls = nodes.SequenceNode, events.SequenceEndEvent
+        else:
+            node_cls, end_cls = nodes.MappingNode, events.MappingEndEvent
+        tag = event.tag
+        if tag is None or tag == '!':
+            tag = loader.resolve(node_cls, None, event.implicit)
+        node = node_cls(tag, [], event.start_mark, None, flow_style=event.flow_style)
+        # 先登记锚点，容器可以引用自身
+        if event.anchor is not None:
+            self._anchors[event.anchor] = node
+        while not loader.check_event(end_cls):
+            if node_cls is nodes.SequenceNode:
+                node.value.append(self._compose())
+            else:
+                node.value.append((self._compose(), self._compose()))
+        node.end_mark = loader.get_event().end_mark
+        return node